@@ -0,0 +1,294 @@
+"""
+Times every encode and decode path on synthetic images of several sizes.
+
+Each measurement runs in a fresh process, so its peak memory is not
+hidden by earlier runs. Results are written as JSON, and a previous
+results file can be given to print how much faster or slower each
+case got.
+
+Run from the repository root:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --sizes icon hd --compare results.json
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Callable, Optional
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from helper import decrypt, encrypt, mapped, probe, utility
+from helper.constant import MAX_DENSITY, ResizeMode
+from helper.parallel import DEFAULT_THREADS
+
+# Cover sizes, from icons to 50 MP
+SIZES = {
+    "icon": (32, 32),
+    "vga": (640, 480),
+    "hd": (1920, 1080),
+    "12mp": (4000, 3000),
+    "50mp": (8192, 6144),
+}
+MESSAGE_LENGTH = 1000
+
+
+def random_image(size: tuple[int, int], seed: int = 0) -> Image.Image:
+    """Creates an RGB image of random pixels"""
+    width, height = size
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+
+def random_message(length: int) -> str:
+    """Creates a random printable ASCII message"""
+    codes = np.random.default_rng(0).integers(ord(" "), ord("~"), length, dtype=np.uint8)
+    return codes.tobytes().decode("ascii")
+
+
+@dataclass(frozen=True)
+class Case:
+    """A function to benchmark and how to build its arguments for a cover size"""
+
+    name: str
+    setup: Callable[[tuple[int, int]], tuple]
+    run: Callable[..., Any]
+    # Slow paths are skipped on larger covers
+    max_pixels: Optional[int] = None
+
+
+def setup_decrypt_text(size: tuple[int, int]) -> tuple:
+    """An image with a message in its first pixels"""
+    message = random_message(min(MESSAGE_LENGTH, size[0] * size[1] - 5))
+    return (encrypt.encrypt_text_to_image(message, random_image(size)),)
+
+
+def setup_decrypt_image(size: tuple[int, int]) -> tuple:
+    """An image hiding another, saved and reopened with its EXIF metadata as the app does"""
+    secret = random_image(size, seed=1)
+    buffer = io.BytesIO()
+    exif = utility.exif_embed_ipp(secret.getexif(), secret.size)
+    encrypt.encrypt_image_to_image(random_image(size), secret).save(buffer, format="PNG", exif=exif)
+    image = Image.open(buffer)
+    image.load()
+    return (image,)
+
+
+def jpeg_file(image: Image.Image) -> io.BytesIO:
+    """Saves an image as a JPEG file in memory"""
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer
+
+
+def setup_probe(size: tuple[int, int]) -> tuple:
+    """A PNG file with a message in its first pixels"""
+    buffer = io.BytesIO()
+    setup_decrypt_text(size)[0].save(buffer, format="PNG")
+    return (buffer,)
+
+
+CASES = {
+    case.name: case
+    for case in (
+        Case(
+            "encrypt_text_to_image",
+            lambda size: (random_message(min(MESSAGE_LENGTH, size[0] * size[1] - 5)), random_image(size)),
+            encrypt.encrypt_text_to_image,
+        ),
+        Case(
+            "encrypt_image_to_image",
+            lambda size: (random_image(size), random_image(size, seed=1)),
+            encrypt.encrypt_image_to_image,
+        ),
+        Case("decrypt_text_from_image", setup_decrypt_text, decrypt.decrypt_text_from_image),
+        # Without a delimiter, the whole image is scanned
+        Case("decrypt_text_from_image_full_scan", lambda size: (random_image(size),), decrypt.decrypt_text_from_image),
+        Case("decrypt_image_from_image", setup_decrypt_image, decrypt.decrypt_image_from_image),
+        # The same paths on a thread per core, with a message filling the cover at the highest density
+        Case(
+            "encrypt_text_to_image_threads",
+            lambda size: (random_message(size[0] * size[1]), random_image(size)),
+            partial(encrypt.encrypt_text_to_image, density=MAX_DENSITY, threads=DEFAULT_THREADS),
+        ),
+        Case(
+            "encrypt_image_to_image_threads",
+            lambda size: (random_image(size), random_image(size, seed=1)),
+            partial(encrypt.encrypt_image_to_image, threads=DEFAULT_THREADS),
+        ),
+        Case(
+            "decrypt_image_from_image_threads",
+            setup_decrypt_image,
+            partial(decrypt.decrypt_image_from_image, threads=DEFAULT_THREADS),
+        ),
+        # In place, touching only the rows the message covers, as on a mapped cover
+        Case(
+            "encrypt_text_mapped",
+            lambda size: (random_message(min(MESSAGE_LENGTH, size[0] * size[1] - 5)), np.array(random_image(size))),
+            mapped.encrypt_text_mapped,
+        ),
+        Case("probe_file", setup_probe, probe.probe_file),
+        Case(
+            "image_resize",
+            lambda size: (random_image((size[0] * 2, size[1] * 2)), size, ResizeMode.SHRINK_TO_SCALE),
+            utility.image_resize,
+        ),
+        Case(
+            "load_resized_jpeg",
+            lambda size: (jpeg_file(random_image((size[0] * 2, size[1] * 2))), size, ResizeMode.SHRINK_TO_SCALE),
+            utility.load_resized,
+        ),
+        Case("pixels_to_binary", lambda size: (random_image(size),), utility.pixels_to_binary, max_pixels=2_000_000),
+    )
+}
+
+
+@dataclass
+class Result:
+    """Measurements of one case on one cover size"""
+
+    case: str
+    size: str
+    width: int
+    height: int
+    repeat: int
+    # Best and median wall time of the repeats, in seconds
+    best: float
+    median: float
+    # Peak memory allocated through Python (including NumPy) during a run
+    peak_traced_bytes: int
+    # Peak resident memory above the setup's during the runs (including Pillow)
+    peak_rss_growth_bytes: int
+
+
+def max_rss_bytes() -> int:
+    """Peak resident memory of the current process"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def reset_peak_rss() -> int:
+    """
+    Resets the peak resident memory of the current process to its current value, where Linux allows it.
+
+    :return: Baseline to subtract from `max_rss_bytes` after a run.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # The peak cannot be reset, so it includes the setup
+        return max_rss_bytes()
+
+
+def measure(name: str, size_name: str, repeat: int) -> Result:
+    """Runs one case on one cover size, in the current process"""
+    case, size = CASES[name], SIZES[size_name]
+    args = case.setup(size)
+    rss_before = reset_peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case.run(*args)
+        times.append(time.perf_counter() - start)
+    rss_growth = max(0, max_rss_bytes() - rss_before)
+    tracemalloc.start()
+    case.run(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return Result(name, size_name, *size, repeat, min(times), float(np.median(times)), peak, rss_growth)
+
+
+def environment() -> dict[str, str]:
+    """Describes the machine and versions the benchmarks ran on"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ""
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": str(multiprocessing.cpu_count()),
+    }
+
+
+def run(cases: list[str], sizes: list[str], repeat: int) -> list[Result]:
+    """Measures each case on each size, each in a fresh process"""
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for size_name in sizes:
+        width, height = SIZES[size_name]
+        for name in cases:
+            max_pixels = CASES[name].max_pixels
+            if max_pixels is not None and width * height > max_pixels:
+                continue
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(measure, name, size_name, repeat).result()
+            print(
+                f"{name:<36}{size_name:>6}  best {result.best * 1e3:10.2f} ms"
+                f"  median {result.median * 1e3:10.2f} ms  peak {result.peak_traced_bytes / 2 ** 20:9.1f} MiB"
+                f"  rss +{result.peak_rss_growth_bytes / 2 ** 20:9.1f} MiB",
+                flush=True,
+            )
+            results.append(result)
+    return results
+
+
+def compare(results: list[Result], previous: dict[str, Any]):
+    """Prints the change in best time and peak memory from previous results"""
+    old = {(result["case"], result["size"]): result for result in previous["results"]}
+    print(f"\nCompared with {previous['environment'].get('commit', '')[:10]} ({previous['environment']['timestamp']})")
+    for result in results:
+        if (before := old.get((result.case, result.size))) is None:
+            continue
+        speedup = before["best"] / result.best if result.best else float("inf")
+        memory = result.peak_traced_bytes / before["peak_traced_bytes"] if before["peak_traced_bytes"] else 1.0
+        print(f"{result.case:<36}{result.size:>6}  {speedup:6.2f}x faster  {memory:6.2f}x peak memory")
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    """Command line entry point, returns the exit status"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case (default: 3)")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON file of previous results to compare with")
+    args = parser.parse_args(argv)
+
+    results = run(args.cases, args.sizes, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": [asdict(result) for result in results]}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
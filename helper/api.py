@@ -0,0 +1,402 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, AsyncIterator, Callable, Optional
+
+import PIL.Image
+from fastapi import APIRouter, File, Form, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from .batch import (
+    FILE_TOO_LONG, PAYLOAD_INCOMPLETE, TEXT_TOO_LONG, InvalidFileError
+)
+from .constant import (
+    CHARACTER_DENSITY, MAX_DENSITY, MAX_UPLOAD_PIXELS, Codec, Operation,
+    OutputProfile, PayloadKind
+)
+from .decrypt import decrypt_bytes_from_file, decrypt_text_from_file
+from .output import ENCODERS
+from .parallel import DEFAULT_THREADS
+from .probe import Probe, probe_file
+from .scheduler import JobScheduler, QueueFullError, estimate_bytes
+from .tiled import (
+    decrypt_image_tiled, encrypt_file_tiled, encrypt_image_tiled,
+    encrypt_text_tiled
+)
+from .utility import reads_top_rows
+
+# Chunks of a response waiting to be sent before the worker writing it is paused
+PIPE_CHUNKS = 8
+BINARY_MEDIA_TYPE = "application/octet-stream"
+INVALID_IMAGE = "Could not load image!"
+ONE_PAYLOAD = "Give exactly one of text, file or secret!"
+
+
+class StreamPipe:
+    """
+    Binary file object written by a worker thread and read by the event loop as it is written.
+
+    Writes wait while `PIPE_CHUNKS` chunks are queued, so a slow client slows
+    the worker down instead of the response piling up in memory.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        # Chunks written, then None once the worker is done
+        self.queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue(PIPE_CHUNKS)
+        # Set once the client is gone, making further writes fail
+        self.abandoned = False
+
+    def write(self, data: bytes) -> int:
+        """Queues a chunk, from the worker thread"""
+        if self.abandoned:
+            raise BrokenPipeError("Client stopped reading the response")
+        if data:
+            asyncio.run_coroutine_threadsafe(self.queue.put(bytes(data)), self.loop).result()
+        return len(data)
+
+    def finish(self):
+        """Marks the end of the chunks, from the worker thread"""
+        asyncio.run_coroutine_threadsafe(self.queue.put(None), self.loop).result()
+
+    def abandon(self):
+        """Makes the next write of the worker fail, and unblocks the one in progress, from the event loop"""
+        self.abandoned = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class IncompleteBody(Exception):
+    """Raised after part of a response was sent, to cut it short so the client sees it is incomplete"""
+
+
+def error_response(message: str, status_code: int) -> JSONResponse:
+    """Response describing why a request failed"""
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+def busy_response(error: QueueFullError) -> JSONResponse:
+    """Response refusing a request while the server is full, telling the client when to retry"""
+    response = error_response(str(error), 503)
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def client_key(request: Request) -> str:
+    """Identifies the client of a request, to take turns with other clients, by header or by address"""
+    if client_id := request.headers.get("X-Client-Id"):
+        return client_id
+    return request.client.host if request.client is not None else ""
+
+
+def parse_codec(name: str) -> Optional[Codec]:
+    """
+    Parses a codec name as given to the batch command line.
+
+    :param name: "auto", "none" or the name of a codec, in any case.
+    :return: The codec, or `None` to pick the one needing the fewest pixels.
+    :raises ValueError: If there is no such codec.
+    """
+    if name.lower() == "auto":
+        return None
+    try:
+        return Codec[name.upper()]
+    except KeyError:
+        raise ValueError(f"Unknown codec {name}!") from None
+
+
+def probe_json(probe: Probe) -> dict:
+    """Findings of a probe as JSON"""
+    return {
+        "kind": probe.kind.value,
+        "size": list(probe.size),
+        "version": probe.version,
+        "length": probe.length,
+        "codec": None if probe.header is None else probe.header.codec.name.lower(),
+        "hidden_size": None if probe.hidden_size is None else list(probe.hidden_size),
+    }
+
+
+class Api:
+    """
+    HTTP endpoints to encrypt, decrypt and probe images, next to the GUI.
+
+    Uploads are spooled to temporary files as they arrive, and the work runs on
+    a pool of threads reading them, once admitted by a `JobScheduler`. Images
+    are encrypted and decrypted band by band (see `helper.tiled`) and each
+    compressed band is sent as soon as it is written, so nothing is stored on
+    the server between requests.
+    """
+
+    def __init__(
+        self,
+        profile: OutputProfile = OutputProfile.PNG,
+        max_pixels: int = MAX_UPLOAD_PIXELS,
+        workers: int = DEFAULT_THREADS,
+        scheduler: Optional[JobScheduler] = None,
+    ):
+        """
+        Creates the endpoints, served by including `router` in an app.
+
+        :param profile: Default PNG output profile, see `helper.output`.
+        :param max_pixels: Largest image accepted, refused before decoding.
+        :param workers: Number of threads processing requests.
+        :param scheduler: Scheduler admitting encryptions and decryptions, shared with
+        other work on the server, or `None` for one with a slot per thread.
+        """
+        self.profile = profile
+        self.max_pixels = max_pixels
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="api")
+        self.scheduler = JobScheduler(workers) if scheduler is None else scheduler
+        self.router = APIRouter(prefix="/api")
+        self.router.add_api_route("/encode", self.encode, methods=["POST"])
+        self.router.add_api_route("/decode", self.decode, methods=["POST"])
+        self.router.add_api_route("/probe", self.probe, methods=["POST"])
+        self.router.add_api_route("/queue", self.queue, methods=["GET"])
+
+    def shutdown(self):
+        """Waits for the requests in progress, then stops the worker threads"""
+        self.executor.shutdown()
+
+    def check_image(self, upload: UploadFile) -> tuple[int, Optional[JSONResponse]]:
+        """
+        Reads the size of an uploaded image from its header, without decoding its pixels.
+
+        :param upload: Uploaded image.
+        :return: Tuple of the number of pixels of the image, and an error response if
+        it is not an image or too large to decode, `None` otherwise.
+        """
+        try:
+            with PIL.Image.open(upload.file) as image:
+                width, height = image.size
+        except InvalidFileError:
+            return 0, error_response(INVALID_IMAGE, 400)
+        if width * height > self.max_pixels:
+            message = f"Image is too large! The limit is {self.max_pixels / 1e6:g} megapixels."
+            return width * height, error_response(message, 413)
+        return width * height, None
+
+    def output_profile(self, name: Optional[str]) -> OutputProfile:
+        """
+        Parses the output profile asked for by a request.
+
+        :param name: Name of a PNG output profile, or `None` for the default one.
+        :raises ValueError: If there is no such profile, or it does not write PNG files.
+        """
+        profile = self.profile if name is None else OutputProfile(name)
+        if ENCODERS[profile].format != "PNG":
+            raise ValueError(f"Images are streamed as PNG, the {profile.value} profile is not available!")
+        return profile
+
+    async def run(self, func: Callable, *args):
+        """Runs a function on a worker thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def stream(
+        self,
+        write: Callable[[IO[bytes]], Optional[bool]],
+        media_type: str,
+        error: str,
+        client: str,
+        cost: int,
+    ) -> Response:
+        """
+        Runs a function writing a response body on a worker thread once admitted, and sends the body as it is written.
+
+        :param write: Writes the body to a binary file object, returning False if it could not be written whole.
+        :param media_type: Media type of the body.
+        :param error: Error returned if the function fails before writing anything.
+        :param client: Client of the request, see `JobScheduler.acquire`.
+        :param cost: Estimated peak memory of the function.
+        :return: Response streaming the body, or describing the error.
+        :raises QueueFullError: If the scheduler refuses the work.
+        """
+        ticket = await self.scheduler.acquire(client, cost)
+        pipe = StreamPipe(asyncio.get_running_loop())
+
+        def run() -> bool:
+            try:
+                return write(pipe) is not False
+            finally:
+                pipe.finish()
+
+        done = asyncio.ensure_future(self.run(run))
+        # The slot is held until the worker is done, even after the client has left
+        done.add_done_callback(lambda _: self.scheduler.release(ticket))
+        try:
+            first = await pipe.queue.get()
+        except asyncio.CancelledError:
+            pipe.abandon()
+            raise
+        if first is None:
+            try:
+                if not await done:
+                    return error_response(error, 422)
+            except InvalidFileError:
+                return error_response(INVALID_IMAGE, 400)
+            return Response(b"", media_type=media_type)
+        return StreamingResponse(stream_body(pipe, first, done), media_type=media_type)
+
+    async def encode(
+        self,
+        request: Request,
+        cover: UploadFile = File(...),
+        text: Optional[str] = Form(None),
+        file: Optional[UploadFile] = File(None),
+        secret: Optional[UploadFile] = File(None),
+        codec: str = Form("auto"),
+        density: int = Form(CHARACTER_DENSITY),
+        profile: Optional[str] = Form(None),
+    ) -> Response:
+        """
+        Hides a text message, a file or an image in a cover image, and streams the PNG image back.
+
+        Unlike in the GUI, a secret image is not resized: only the part fitting in the cover is hidden.
+        """
+        if sum(payload is not None for payload in (text, file, secret)) != 1:
+            return error_response(ONE_PAYLOAD, 400)
+        if not CHARACTER_DENSITY <= density <= MAX_DENSITY:
+            return error_response(f"Density must be between {CHARACTER_DENSITY} and {MAX_DENSITY}!", 400)
+        try:
+            output = self.output_profile(profile)
+            chosen_codec = parse_codec(codec)
+        except ValueError as error:
+            return error_response(str(error), 400)
+        pixels, response = self.check_image(cover)
+        if response is not None:
+            return response
+        media_type = ENCODERS[output].media_type
+        client = client_key(request)
+        try:
+            if text is not None:
+                return await self.stream(
+                    lambda sink: encrypt_text_tiled(text, cover.file, sink, codec=chosen_codec, density=density,
+                                                    profile=output),
+                    media_type,
+                    TEXT_TOO_LONG,
+                    client,
+                    estimate_bytes(Operation.ENCRYPT_TEXT, pixels, payload_bytes=len(text.encode())),
+                )
+            if file is not None:
+                return await self.stream(
+                    lambda sink: encrypt_file_tiled(file.file, cover.file, sink, codec=chosen_codec, density=density,
+                                                    profile=output),
+                    media_type,
+                    FILE_TOO_LONG,
+                    client,
+                    estimate_bytes(Operation.ENCRYPT_FILE, pixels, payload_bytes=file.size or 0),
+                )
+            secret_pixels, response = self.check_image(secret)
+            if response is not None:
+                return response
+            return await self.stream(
+                lambda sink: encrypt_image_tiled(cover.file, secret.file, sink, profile=output),
+                media_type,
+                INVALID_IMAGE,
+                client,
+                estimate_bytes(Operation.ENCRYPT_IMAGE, pixels, secret_pixels),
+            )
+        except QueueFullError as error:
+            return busy_response(error)
+
+    async def decode(
+        self, request: Request, image: UploadFile = File(...), profile: Optional[str] = Form(None)
+    ) -> Response:
+        """
+        Recovers what an image hides.
+
+        Text messages are returned as JSON, files as a binary stream, and images as a PNG stream.
+        """
+        try:
+            output = self.output_profile(profile)
+        except ValueError as error:
+            return error_response(str(error), 400)
+        pixels, response = self.check_image(image)
+        if response is not None:
+            return response
+        client = client_key(request)
+        cost = estimate_bytes(Operation.DECRYPT, pixels)
+        try:
+            probe = await self.probe_upload(image, pixels, client)
+            if probe.kind is PayloadKind.FILE:
+                return await self.stream(
+                    lambda sink: decrypt_bytes_from_file(image.file, sink),
+                    BINARY_MEDIA_TYPE,
+                    PAYLOAD_INCOMPLETE,
+                    client,
+                    cost,
+                )
+            if probe.kind is not PayloadKind.IMAGE:
+                async with self.scheduler.admit(client, cost):
+                    text, end_code_found = await self.run(decrypt_text_from_file, image.file)
+                if end_code_found:
+                    return JSONResponse({"kind": PayloadKind.TEXT.value, "text": text})
+            return await self.stream(
+                lambda sink: decrypt_image_tiled(image.file, sink, profile=output),
+                ENCODERS[output].media_type,
+                INVALID_IMAGE,
+                client,
+                cost,
+            )
+        except InvalidFileError:
+            return error_response(INVALID_IMAGE, 400)
+        except QueueFullError as error:
+            return busy_response(error)
+
+    async def probe_upload(self, upload: UploadFile, pixels: int, client: str) -> Probe:
+        """
+        Probes an uploaded image, waiting for a slot only if the whole image must be decoded.
+
+        :param upload: Uploaded image.
+        :param pixels: Number of pixels of the image.
+        :param client: Client of the request, see `JobScheduler.acquire`.
+        :return: The probe's findings.
+        :raises QueueFullError: If the scheduler refuses the probe.
+        """
+        cost = estimate_bytes(Operation.PROBE, pixels, rows_only=reads_top_rows(upload.file))
+        if not cost:
+            return await self.run(probe_file, upload.file)
+        async with self.scheduler.admit(client, cost):
+            return await self.run(probe_file, upload.file)
+
+    async def probe(self, request: Request, image: UploadFile = File(...)) -> Response:
+        """
+        Reports what an image hides, from its metadata and first pixels only.
+
+        Only images whose first rows cannot be decoded on their own wait for a slot.
+        """
+        pixels, response = self.check_image(image)
+        if response is not None:
+            return response
+        try:
+            return JSONResponse(probe_json(await self.probe_upload(image, pixels, client_key(request))))
+        except InvalidFileError:
+            return error_response(INVALID_IMAGE, 400)
+        except QueueFullError as error:
+            return busy_response(error)
+
+    async def queue(self) -> Response:
+        """Reports how busy the server is, see `JobScheduler.snapshot`"""
+        return JSONResponse(self.scheduler.snapshot())
+
+
+async def stream_body(pipe: StreamPipe, first: bytes, done: asyncio.Future) -> AsyncIterator[bytes]:
+    """
+    Yields the chunks of a response body as a worker thread writes them.
+
+    :param pipe: Pipe the worker writes to.
+    :param first: First chunk, already taken from the pipe.
+    :param done: Future of the worker, giving whether the body was written whole.
+    :raises IncompleteBody: If the worker failed after sending part of the body.
+    """
+    try:
+        chunk = first
+        while chunk is not None:
+            yield chunk
+            chunk = await pipe.queue.get()
+        if not await done:
+            raise IncompleteBody(PAYLOAD_INCOMPLETE)
+    finally:
+        # The client may have disconnected, leaving the worker blocked on a write
+        pipe.abandon()
+        if not done.done():
+            done.add_done_callback(lambda future: future.exception())
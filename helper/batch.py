@@ -0,0 +1,552 @@
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field, replace
+from glob import glob
+from typing import IO, Callable, Iterable, Optional
+
+from PIL import Image, UnidentifiedImageError
+from PIL.Image import Exif
+
+from . import instrument, mapped, tiled
+from .constant import (
+    CHARACTER_DENSITY, MAX_DENSITY, Codec, Operation, OutputProfile,
+    PayloadKind, ResizeMode
+)
+from .decrypt import (
+    decrypt_bytes_from_file, decrypt_image_from_image, decrypt_text_from_file,
+    join_text
+)
+from .encrypt import (
+    encrypt_file_to_image, encrypt_image_to_image, encrypt_text_to_image
+)
+from .output import ENCODERS, write_image
+from .probe import Probe, probe_file
+from .utility import (
+    FileSource, exif_embed_ipp, list_images, load_resized, open_image
+)
+
+InvalidFileError = (OSError, UnidentifiedImageError, UnicodeDecodeError, Image.DecompressionBombError)
+Source = str | bytes
+TEXT_TOO_LONG = "Text message is too long for image!"
+FILE_TOO_LONG = "File is too large for image!"
+NOT_MAPPABLE = "Image is compressed, it cannot be mapped!"
+NO_EXIF = "Output format cannot hold the size of the hidden image!"
+NO_PAYLOAD = "Nothing to hide was given!"
+PAYLOAD_INCOMPLETE = "Hidden file is incomplete or corrupt!"
+ENCRYPT_OPERATIONS = (Operation.ENCRYPT_TEXT, Operation.ENCRYPT_FILE, Operation.ENCRYPT_IMAGE)
+
+
+@dataclass(frozen=True)
+class Job:
+    """A single encryption or decryption to run in a batch"""
+
+    operation: Operation
+    # Paths, or contents of files held in memory
+    cover: Source
+    # Path of the output, or None to return it in the result
+    output: Optional[str]
+    payload: Optional[Source] = None
+    # Message to hide instead of reading the payload file
+    text: Optional[str] = None
+    # Compression of text messages and files, None to pick the one needing the fewest pixels
+    codec: Optional[Codec] = Codec.NONE
+    # Bits per color plane holding text messages and files, or one character per pixel
+    density: int = CHARACTER_DENSITY
+    # Encoding of output images, see helper.output
+    profile: OutputProfile = OutputProfile.PNG
+    # Stream the images in bands instead of decoding them whole, see helper.tiled
+    tiled: bool = False
+    # Threads splitting the bands of a single image, see helper.parallel
+    threads: int = 1
+    # Map an uncompressed cover into memory, encrypting in the cover file itself, see helper.mapped
+    mapped: bool = False
+    # Record the time of each stage in the result, and its peak allocation too, see helper.instrument
+    instrument: bool = False
+    track_memory: bool = False
+
+
+@dataclass
+class JobResult:
+    """Outcome of a batch job"""
+
+    job: Job
+    ok: bool
+    pixels: int = 0
+    seconds: float = 0.0
+    output: Optional[str] = None
+    error: str = ""
+    # Outputs of jobs without an output path
+    data: Optional[bytes] = None
+    text: Optional[str] = None
+    file: Optional[bytes] = None
+    probe: Optional[Probe] = None
+    stages: list[instrument.StageRecord] = field(default_factory=list)
+
+
+@dataclass
+class BatchReport:
+    """Results and throughput of a batch run"""
+
+    results: list[JobResult] = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def failed(self) -> list[JobResult]:
+        """Results of the jobs that did not succeed"""
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def images_per_second(self) -> float:
+        """Number of covers processed per second of wall time"""
+        return len(self.results) / self.seconds if self.seconds else 0.0
+
+    @property
+    def megapixels_per_second(self) -> float:
+        """Number of cover megapixels processed per second of wall time"""
+        pixels = sum(result.pixels for result in self.results)
+        return pixels / 1e6 / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        """One line description of the run"""
+        return (
+            f"{len(self.results)} images, {len(self.failed)} failed in {self.seconds:.2f}s "
+            f"({self.images_per_second:.1f} images/s, {self.megapixels_per_second:.1f} MP/s)"
+        )
+
+
+def open_source(source: Source) -> FileSource:
+    """Wraps in-memory file contents in a file object, leaving paths as they are"""
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+def load_rgb(source: Source) -> Image.Image:
+    """
+    Fully loads an image file as RGB, as the GUI does for uploads.
+
+    :param source: Path or contents of the image file.
+    :return: Loaded RGB Image object.
+    """
+    with instrument.stage("load"), Image.open(open_source(source)) as image:
+        image.load()
+        return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def run_job(job: Job) -> JobResult:
+    """
+    Runs a single job, turning unreadable inputs into a failed result.
+
+    Encryption writes an image to the job's output path, PNG unless the job's
+    output profile says otherwise. Decryption writes the recovered text next
+    to it as a .txt file when a text message is found, the recovered file as
+    a .bin file when a file is found, and the recovered image otherwise. Jobs
+    without an output path return the image, text or file in the result instead.
+
+    :param job: Job to run.
+    :return: Result of the job.
+    """
+    start = time.perf_counter()
+    with instrument.capture(job.track_memory) if job.instrument else nullcontext() as recorder:
+        try:
+            with instrument.stage(job.operation.value):
+                result = run_operation(job)
+        except InvalidFileError as error:
+            result = JobResult(job, False, error=str(error))
+    result.seconds = time.perf_counter() - start
+    if recorder is not None:
+        result.stages = recorder.records
+    return result
+
+
+def run_operation(job: Job) -> JobResult:
+    """
+    Runs a job, letting errors propagate.
+
+    :param job: Job to run.
+    :return: Result of the job, failed if the text message or file is too long for the cover.
+    """
+    # Text messages may be given inline instead
+    if job.operation in ENCRYPT_OPERATIONS and job.payload is None and job.text is None:
+        return JobResult(job, False, error=NO_PAYLOAD)
+    if job.mapped:
+        return run_mapped(job)
+    if job.operation is Operation.PROBE:
+        probe = probe_file(open_source(job.cover))
+        return JobResult(job, True, probe.size[0] * probe.size[1], probe=probe)
+    if job.tiled:
+        return run_tiled(job)
+    match job.operation:
+        case Operation.ENCRYPT_TEXT:
+            cover = load_rgb(job.cover)
+            text = job.text
+            if text is None:
+                with open_payload(job.payload) as f:
+                    text = f.read()
+            output_image = encrypt_text_to_image(text, cover, job.codec, job.density, job.threads)
+            if output_image is None:
+                return JobResult(job, False, cover.width * cover.height, error=TEXT_TOO_LONG)
+            return save_image(job, cover.size, output_image)
+        case Operation.ENCRYPT_FILE:
+            cover = load_rgb(job.cover)
+            with open_binary(job.payload) as f:
+                output_image = encrypt_file_to_image(f, cover, job.codec, job.density)
+            if output_image is None:
+                return JobResult(job, False, cover.width * cover.height, error=FILE_TOO_LONG)
+            return save_image(job, cover.size, output_image)
+        case Operation.ENCRYPT_IMAGE:
+            if not ENCODERS[job.profile].holds_exif:
+                return JobResult(job, False, error=NO_EXIF)
+            cover = load_rgb(job.cover)
+            # Large JPEG secrets are decoded at a reduced scale
+            secret = load_resized(open_source(job.payload), cover.size, ResizeMode.SHRINK_TO_SCALE)
+            exif = exif_embed_ipp(secret.getexif(), secret.size)
+            return save_image(job, cover.size, encrypt_image_to_image(cover, secret, job.threads), exif=exif)
+        case Operation.DECRYPT:
+            # Go straight to the right decoder, instead of trying text first
+            probe = probe_file(open_source(job.cover))
+            if probe.kind is PayloadKind.FILE:
+                return save_file(job, probe.size, lambda sink: decrypt_bytes_from_file(open_source(job.cover), sink))
+            if probe.kind is not PayloadKind.IMAGE:
+                text, end_code_found = decrypt_text_from_file(open_source(job.cover))
+                if end_code_found:
+                    return save_text(job, probe.size, text)
+            cover = load_rgb(job.cover)
+            return save_image(job, cover.size, decrypt_image_from_image(cover, job.threads))
+
+
+def run_tiled(job: Job) -> JobResult:
+    """
+    Runs a job on image files too large for memory, letting errors propagate.
+
+    The secret image of an encrypt-image job is not resized, only the part
+    fitting in the cover is hidden.
+
+    :param job: Job to run, with paths for its cover, payload and output.
+    :return: Result of the job, failed if the text message or file is too long for the cover.
+    """
+    # Covers are read in bands, see `tiled.BandReader`, which limits the formats it decodes whole itself
+    with open_image(job.cover) as cover:
+        width, height = cover.size
+    match job.operation:
+        case Operation.ENCRYPT_TEXT:
+            text = job.text
+            if text is None:
+                with open_payload(job.payload) as f:
+                    text = f.read()
+            if not tiled.encrypt_text_tiled(
+                text, job.cover, job.output, codec=job.codec, density=job.density, profile=job.profile
+            ):
+                return JobResult(job, False, width * height, error=TEXT_TOO_LONG)
+        case Operation.ENCRYPT_FILE:
+            with open_binary(job.payload) as f:
+                if not tiled.encrypt_file_tiled(
+                    f, job.cover, job.output, codec=job.codec, density=job.density, profile=job.profile
+                ):
+                    return JobResult(job, False, width * height, error=FILE_TOO_LONG)
+        case Operation.ENCRYPT_IMAGE:
+            tiled.encrypt_image_tiled(job.cover, job.payload, job.output, profile=job.profile)
+        case Operation.DECRYPT:
+            # Only the rows holding the header are decoded
+            probe = probe_file(job.cover)
+            if probe.kind is PayloadKind.FILE:
+                return save_file(job, probe.size, lambda sink: tiled.decrypt_bytes_tiled(job.cover, sink))
+            if probe.kind is not PayloadKind.IMAGE:
+                text, end_code_found = join_text(tiled.stream_text_tiled(job.cover))
+                if end_code_found:
+                    return save_text(job, probe.size, text)
+            tiled.decrypt_image_tiled(job.cover, job.output, profile=job.profile)
+    return JobResult(job, True, width * height, output=job.output)
+
+
+def run_mapped(job: Job) -> JobResult:
+    """
+    Runs a job on an uncompressed cover mapped into memory, letting errors propagate.
+
+    Encryption writes into the cover file itself, touching only the pixels the
+    payload covers, and the cover is the output. Decryption and probes read only
+    the pages of the pixels they need. Hidden images are decrypted from the whole
+    cover, as PNG.
+
+    :param job: Job to run, with a path for its cover.
+    :return: Result of the job, failed if the cover cannot be mapped or the text message or file is too long for it.
+    """
+    writable = job.operation not in (Operation.DECRYPT, Operation.PROBE)
+    pixels = mapped.map_pixels(job.cover, writable)
+    if pixels is None:
+        return JobResult(job, False, error=NOT_MAPPABLE)
+    height, width = pixels.shape[:2]
+    match job.operation:
+        case Operation.PROBE:
+            return JobResult(job, True, width * height, probe=mapped.probe_mapped(pixels))
+        case Operation.ENCRYPT_TEXT:
+            text = job.text
+            if text is None:
+                with open_payload(job.payload) as f:
+                    text = f.read()
+            if not mapped.encrypt_text_mapped(text, pixels, job.codec, job.density):
+                return JobResult(job, False, width * height, error=TEXT_TOO_LONG)
+        case Operation.ENCRYPT_FILE:
+            with open_binary(job.payload) as f:
+                if not mapped.encrypt_file_mapped(f, pixels, job.codec, job.density):
+                    return JobResult(job, False, width * height, error=FILE_TOO_LONG)
+        case Operation.ENCRYPT_IMAGE:
+            mapped.encrypt_image_mapped(pixels, open_source(job.payload))
+        case Operation.DECRYPT:
+            probe = mapped.probe_mapped(pixels)
+            if probe.kind is PayloadKind.FILE:
+                return save_file(job, probe.size, lambda sink: mapped.decrypt_bytes_mapped(pixels, sink))
+            text, end_code_found = mapped.decrypt_text_mapped(pixels)
+            if end_code_found:
+                return save_text(job, probe.size, text)
+            with instrument.stage("save"):
+                if job.output is None:
+                    buffer = io.BytesIO()
+                    mapped.decrypt_image_mapped(pixels, buffer, profile=job.profile)
+                    return JobResult(job, True, width * height, data=buffer.getvalue())
+                mapped.decrypt_image_mapped(pixels, job.output, profile=job.profile)
+            return JobResult(job, True, width * height, output=job.output)
+    return JobResult(job, True, width * height, output=job.cover)
+
+
+def open_payload(payload: Source) -> IO[str]:
+    """Opens a text payload given as a path or as file contents"""
+    if isinstance(payload, bytes):
+        return io.StringIO(payload.decode("utf-8"))
+    return open(payload, encoding="utf-8")
+
+
+def open_binary(payload: Source) -> IO[bytes]:
+    """Opens a binary payload given as a path or as file contents"""
+    if isinstance(payload, bytes):
+        return io.BytesIO(payload)
+    return open(payload, "rb")
+
+
+def save_text(job: Job, size: tuple[int, int], text: str) -> JobResult:
+    """
+    Saves a job's decrypted text next to its output path as a .txt file, or in memory.
+
+    :param job: Decryption job.
+    :param size: Size of the job's image.
+    :param text: Decrypted text.
+    :return: Successful result of the job.
+    """
+    width, height = size
+    if job.output is None:
+        return JobResult(job, True, width * height, text=text)
+    output = os.path.splitext(job.output)[0] + ".txt"
+    with open(output, "w") as f:
+        f.write(text)
+    return JobResult(job, True, width * height, output=output)
+
+
+def save_file(job: Job, size: tuple[int, int], decrypt: Callable[[IO[bytes]], bool]) -> JobResult:
+    """
+    Decrypts a job's hidden file next to its output path as a .bin file, or in memory.
+
+    :param job: Decryption job.
+    :param size: Size of the job's image.
+    :param decrypt: Writes the hidden file to a binary file object, returning whether it was whole.
+    :return: Result of the job, failed without any output if the hidden file is incomplete.
+    """
+    width, height = size
+    with instrument.stage("save"):
+        if job.output is None:
+            buffer = io.BytesIO()
+            if not decrypt(buffer):
+                return JobResult(job, False, width * height, error=PAYLOAD_INCOMPLETE)
+            return JobResult(job, True, width * height, file=buffer.getvalue())
+        output = os.path.splitext(job.output)[0] + ".bin"
+        # Written aside first, so that an incomplete file never takes the output's place
+        with open(output + ".tmp", "wb") as f:
+            whole = decrypt(f)
+        if not whole:
+            os.remove(output + ".tmp")
+            return JobResult(job, False, width * height, error=PAYLOAD_INCOMPLETE)
+        os.replace(output + ".tmp", output)
+        return JobResult(job, True, width * height, output=output)
+
+
+def save_image(job: Job, size: tuple[int, int], image: Image.Image, exif: Optional[Exif] = None) -> JobResult:
+    """
+    Saves a job's output image with its output profile, to its output path or in memory.
+
+    The extension of the output path is replaced by the profile's.
+
+    :param job: Job that produced the image.
+    :param size: Size of the job's cover image.
+    :param image: Output image.
+    :param exif: Metadata to write along.
+    :return: Successful result of the job.
+    """
+    width, height = size
+    with instrument.stage("save"):
+        if job.output is None:
+            buffer = io.BytesIO()
+            write_image(image, buffer, job.profile, exif)
+            return JobResult(job, True, width * height, data=buffer.getvalue())
+        path = os.path.splitext(job.output)[0] + ENCODERS[job.profile].extension
+        write_image(image, path, job.profile, exif)
+        return JobResult(job, True, width * height, output=path)
+
+
+def output_paths(covers: list[str], output_dir: str) -> list[str]:
+    """
+    Builds the output paths of cover images: same name, PNG, in `output_dir`.
+
+    Covers whose names differ only by their extension keep it in their output's
+    name, e.g. a.jpg.png and a.png.png, so that no output overwrites another.
+
+    :param covers: Paths of the cover images.
+    :param output_dir: Directory for the outputs.
+    :raises ValueError: If covers in different directories have the same name.
+    :return: Output path of each cover.
+    """
+    names = [os.path.basename(cover) for cover in covers]
+    stems = Counter(os.path.splitext(name)[0] for name in names)
+    names = [name if stems[os.path.splitext(name)[0]] > 1 else os.path.splitext(name)[0] for name in names]
+    if duplicates := sorted(name for name, count in Counter(names).items() if count > 1):
+        raise ValueError(f"Several covers are named {', '.join(duplicates)}, their outputs would overwrite each other")
+    return [os.path.join(output_dir, f"{name}.png") for name in names]
+
+
+def jobs_from_directory(
+    operation: Operation, cover_dir: str, output_dir: str, payload: Optional[str] = None, arrays: bool = False
+) -> list[Job]:
+    """
+    Creates one job for each image in a directory.
+
+    :param operation: Operation to run on every image.
+    :param cover_dir: Directory of cover images (or images to decrypt).
+    :param output_dir: Directory for the outputs.
+    :param payload: Text file or image hidden in every cover when encrypting.
+    :param arrays: Whether to include .npy arrays of pixels, which only mapped jobs read.
+    :return: List of jobs, sorted by cover path.
+    """
+    covers = list_images(cover_dir)
+    if arrays:
+        covers += glob(os.path.join(cover_dir, "*" + mapped.NPY_SUFFIX))
+    covers.sort()
+    return [Job(operation, cover, output, payload) for cover, output in zip(covers, output_paths(covers, output_dir))]
+
+
+def jobs_from_manifest(operation: Operation, manifest: str, output_dir: str) -> list[Job]:
+    """
+    Creates jobs from a CSV manifest.
+
+    Each row holds a cover path, then optionally a payload path and an
+    output path. Relative paths are relative to the manifest's directory.
+    Without an output path, the output is named after the cover, see
+    `output_paths`. Encryption jobs of rows without a payload fail when run.
+
+    :param operation: Operation to run on every row.
+    :param manifest: Path of the CSV file.
+    :param output_dir: Directory for outputs without an explicit path.
+    :raises ValueError: If outputs named after their covers would overwrite each other.
+    :return: List of jobs in manifest order.
+    """
+    base = os.path.dirname(manifest)
+    rows = []
+    with open(manifest, newline="") as f:
+        for row in csv.reader(f):
+            row = [os.path.join(base, value.strip()) if value.strip() else None for value in row]
+            if row and row[0] is not None:
+                rows.append((row + [None, None])[:3])
+    named = iter(output_paths([cover for cover, _, output in rows if output is None], output_dir))
+    return [Job(operation, cover, output or next(named), payload) for cover, payload, output in rows]
+
+
+def run_batch(jobs: Iterable[Job], workers: Optional[int] = None) -> BatchReport:
+    """
+    Runs jobs on a pool of worker processes.
+
+    :param jobs: Jobs to run.
+    :param workers: Number of worker processes. Defaults to the number of CPUs.
+    :return: Report with the result of every job, in order.
+    """
+    jobs = list(jobs)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_job, jobs))
+    return BatchReport(results, time.perf_counter() - start)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    """Command line entry point, returns the exit status"""
+    parser = argparse.ArgumentParser(
+        prog="python -m helper.batch", description="Encrypt or decrypt many images at once."
+    )
+    parser.add_argument("operation", type=Operation, choices=list(Operation), metavar="operation",
+                        help=", ".join(operation.value for operation in Operation))
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="directory of cover images (or images to decrypt)")
+    source.add_argument("--manifest", help="CSV file of cover,payload[,output] rows")
+    parser.add_argument("--payload", help="text file, image or other file to hide in every cover of --dir")
+    parser.add_argument("--output", help="directory for the outputs, required unless probing")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="threads splitting each image in bands, for a few large images (default: 1)")
+    parser.add_argument("--compress", choices=["none", "auto"] + [codec.name.lower() for codec in Codec][1:],
+                        default="none", help="compression of text messages and files (default: none)")
+    parser.add_argument("--density", type=int, choices=range(CHARACTER_DENSITY, MAX_DENSITY + 1),
+                        default=CHARACTER_DENSITY,
+                        help="low bits per color channel holding text messages and files, 1 to 4 "
+                             "(default: 0, one 7-bit character per pixel)")
+    parser.add_argument("--profile", type=OutputProfile, choices=list(OutputProfile), metavar="profile",
+                        default=OutputProfile.PNG,
+                        help="encoding of output images: " + ", ".join(profile.value for profile in OutputProfile)
+                             + " (default: png)")
+    parser.add_argument("--tiled", action="store_true",
+                        help="stream images in bands, for images too large for memory (outputs are PNG)")
+    parser.add_argument("--mapped", action="store_true",
+                        help="map uncompressed covers (.npy, PPM, BMP, TIFF) into memory and encrypt them in place")
+    args = parser.parse_args(argv)
+
+    probing = args.operation is Operation.PROBE
+    if args.dir and args.operation is not Operation.DECRYPT and not probing and not args.payload:
+        parser.error("--payload is required to encrypt a directory")
+    in_place = args.mapped and args.operation is not Operation.DECRYPT
+    if not args.output and not probing and not in_place:
+        parser.error("--output is required")
+    if args.tiled and args.mapped:
+        parser.error("--tiled and --mapped cannot be combined")
+    if (args.tiled or args.mapped) and ENCODERS[args.profile].format != "PNG":
+        parser.error(f"--{'tiled' if args.tiled else 'mapped'} only writes PNG profiles")
+    if args.operation is Operation.ENCRYPT_IMAGE and not args.mapped and not ENCODERS[args.profile].holds_exif:
+        parser.error(f"the {args.profile.value} profile cannot hold the size of the hidden image")
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    try:
+        if args.dir:
+            jobs = jobs_from_directory(args.operation, args.dir, args.output or "", args.payload, args.mapped)
+        else:
+            jobs = jobs_from_manifest(args.operation, args.manifest, args.output or "")
+    except ValueError as error:
+        parser.error(str(error))
+    codec = None if args.compress == "auto" else Codec[args.compress.upper()]
+    jobs = [
+        replace(
+            job, profile=args.profile, tiled=args.tiled, codec=codec, density=args.density, threads=args.threads,
+            mapped=args.mapped,
+        )
+        for job in jobs
+    ]
+
+    report = run_batch(jobs, args.workers)
+    for result in report.results:
+        if result.probe is not None:
+            print(f"{result.job.cover}: {result.probe.summary()}")
+    for result in report.failed:
+        print(f"FAILED {result.job.cover}: {result.error}", file=sys.stderr)
+    print(report.summary())
+    return 1 if report.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from collections import OrderedDict
+from dataclasses import fields, replace
+from typing import Optional
+
+from .batch import Job, JobResult
+
+# Total size of the results kept in memory, and on disk when spilling
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_DISK_BYTES = 1024 * 1024 * 1024
+# Job fields that do not change the result of a job
+UNKEYED_FIELDS = {"threads", "instrument", "track_memory"}
+# Job fields holding file contents, or paths to them
+SOURCE_FIELDS = {"cover", "payload"}
+SPILL_SUFFIX = ".result"
+SPILL_PREFIX = "results-"
+
+
+def job_key(job: Job) -> str:
+    """
+    Hashes everything a job's result depends on: its operation, its input files and its options.
+
+    Files given by path are identified by their path, size and modification time
+    rather than read.
+
+    :param job: Job to hash.
+    :return: Hex digest identifying the job's result.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for job_field in fields(job):
+        if job_field.name in UNKEYED_FIELDS:
+            continue
+        value = getattr(job, job_field.name)
+        if job_field.name in SOURCE_FIELDS and isinstance(value, str):
+            stat = os.stat(value)
+            value = (os.path.abspath(value), stat.st_size, stat.st_mtime_ns)
+        data = value if isinstance(value, bytes) else repr(value).encode()
+        # Lengths keep the boundaries between fields unambiguous
+        digest.update(job_field.name.encode() + len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def result_nbytes(result: JobResult) -> int:
+    """Approximate memory held by the outputs of a result"""
+    outputs = (result.data, result.text, result.file)
+    return sum(len(output) for output in outputs if output is not None)
+
+
+class ResultCache:
+    """
+    Results of successful jobs keyed by `job_key`, evicted least recently used first.
+
+    Only jobs without an output path are cached: their outputs are held in the
+    result itself, while the files of other jobs may have changed since.
+
+    Whenever the results in memory add up to more than `max_bytes`, the least
+    recently used ones are dropped, or moved to `spill_dir` if given. Spilled
+    results are read back on their next use, and the least recently used
+    files are deleted once they add up to more than `max_disk_bytes`.
+
+    Results are kept without their jobs, whose inputs are not counted in the budget.
+    They are spilled to a directory of their own created inside `spill_dir`, which
+    only the current user can access, so no file left by anyone else is ever unpickled.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        spill_dir: Optional[str] = None,
+        max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.results: OrderedDict[str, JobResult] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix=SPILL_PREFIX, dir=spill_dir)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.results or (self.spill_dir is not None and os.path.exists(self.spill_path(key)))
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def spill_path(self, key: str) -> str:
+        """Path of the file a result is spilled to"""
+        return os.path.join(self.spill_dir, key + SPILL_SUFFIX)
+
+    def get(self, job: Job, key: Optional[str] = None) -> Optional[JobResult]:
+        """
+        Gets the cached result of a job, and marks it as recently used.
+
+        :param job: Job whose result is wanted.
+        :param key: `job_key(job)`, if already computed.
+        :return: Result for this job, without stage records, or `None` if not cached.
+        """
+        if job.output is not None:
+            self.misses += 1
+            return None
+        key = job_key(job) if key is None else key
+        result = self.results.get(key)
+        if result is not None:
+            self.results.move_to_end(key)
+        elif self.spill_dir is not None and os.path.exists(path := self.spill_path(key)):
+            try:
+                with open(path, "rb") as f:
+                    result = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                result = None
+            else:
+                os.remove(path)
+                self.put(job, result, key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return replace(result, job=job, stages=[])
+
+    def put(self, job: Job, result: JobResult, key: Optional[str] = None):
+        """
+        Keeps the result of a job run without an output path, if it succeeded, then evicts results past the budget.
+
+        :param job: Job that produced the result.
+        :param result: Its result.
+        :param key: `job_key(job)`, if already computed.
+        """
+        if not result.ok or job.output is not None:
+            return
+        key = job_key(job) if key is None else key
+        if key in self.results:
+            self.nbytes -= result_nbytes(self.results.pop(key))
+        # The job holds its input files, which the result does not need
+        self.results[key] = replace(result, job=None, stages=[])
+        self.nbytes += result_nbytes(result)
+        self.trim()
+
+    def trim(self) -> list[str]:
+        """
+        Evicts least recently used results until the cache fits its budget.
+
+        :return: Keys of the evicted results, spilled to disk or dropped.
+        """
+        evicted = []
+        while self.nbytes > self.max_bytes and self.results:
+            key, result = self.results.popitem(last=False)
+            self.nbytes -= result_nbytes(result)
+            evicted.append(key)
+            if self.spill_dir is not None:
+                self.spill(key, result)
+        if evicted and self.spill_dir is not None:
+            self.trim_disk()
+        return evicted
+
+    def spill(self, key: str, result: JobResult):
+        """Writes a result to the spill directory"""
+        path = self.spill_path(key)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+        except OSError as error:
+            print(f"WARNING: Could not spill cached result to disk: {error}")
+
+    def trim_disk(self):
+        """Deletes the least recently spilled results until the spill directory fits its budget"""
+        entries = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.name.endswith(SPILL_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        """Drops every result, in memory and on disk"""
+        self.results.clear()
+        self.nbytes = 0
+        if self.spill_dir is not None:
+            for entry in os.scandir(self.spill_dir):
+                if entry.name.endswith(SPILL_SUFFIX):
+                    os.remove(entry.path)
+
+    def close(self):
+        """Drops every result and deletes the spill directory"""
+        self.clear()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,143 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image
+
+from .compression import compress
+from .constant import BITS_4, CHARACTER_DENSITY, N_PLANES, Codec, ResizeMode
+from .header import HEADER_PIXELS
+from .packing import payload_capacity, payload_pixels
+from .utility import FileSource, resized_size, strip_non_ascii
+
+# 3 bits of red, 3 bits of green and 1 bit of blue per character
+TEXT_BITS_PER_PIXEL = 2 * N_PLANES + 1
+# 4 bits of each of red, green and blue
+IMAGE_BITS_PER_PIXEL = BITS_4 * N_PLANES
+
+ImageSource = FileSource | Image.Image | tuple[int, int]
+
+
+@dataclass(frozen=True)
+class TextCapacity:
+    """Room for a text message in a cover image"""
+
+    cover_size: tuple[int, int]
+    # Bytes of the message as embedded, compressed or not, without the header
+    message_bytes: int
+    codec: Codec = Codec.NONE
+    density: int = CHARACTER_DENSITY
+
+    @property
+    def bits_per_pixel(self) -> int:
+        """Bits of the message held by each pixel"""
+        return TEXT_BITS_PER_PIXEL if self.density == CHARACTER_DENSITY else self.density * N_PLANES
+
+    @property
+    def bytes_available(self) -> int:
+        """Longest message, as embedded with the codec and density, the cover can hold"""
+        width, height = self.cover_size
+        return payload_capacity(max(0, width * height - HEADER_PIXELS), self.codec, self.density)
+
+    @property
+    def pixels_used(self) -> int:
+        """Pixels modified to encrypt the message and its header"""
+        return HEADER_PIXELS + payload_pixels(self.message_bytes, self.codec, self.density)
+
+    @property
+    def fits(self) -> bool:
+        """Whether the message can be encrypted in the cover"""
+        return self.message_bytes <= self.bytes_available
+
+
+@dataclass(frozen=True)
+class ImageCapacity:
+    """Room for a secret image in a cover image"""
+
+    cover_size: tuple[int, int]
+    secret_size: tuple[int, int]
+    # Size of the secret image once shrunk to fit the cover
+    resized_size: tuple[int, int]
+    bits_per_pixel: int = IMAGE_BITS_PER_PIXEL
+
+    @property
+    def resized(self) -> bool:
+        """Whether the secret image has to be shrunk"""
+        return self.resized_size != self.secret_size
+
+    @property
+    def hidden_size(self) -> tuple[int, int]:
+        """Size of the secret image actually hidden, within the cover"""
+        (width, height), (max_width, max_height) = self.resized_size, self.cover_size
+        return min(width, max_width), min(height, max_height)
+
+    @property
+    def scale(self) -> float:
+        """Ratio of the resized secret image's width to the original width"""
+        return self.resized_size[0] / self.secret_size[0] if self.secret_size[0] else 1.0
+
+    @property
+    def quality(self) -> float:
+        """
+        Fraction of the secret image's information that can be recovered.
+
+        This is the fraction of pixels kept after resizing, times the fraction
+        of bits kept in each color plane.
+        """
+        (width, height), (new_width, new_height) = self.secret_size, self.hidden_size
+        pixels_kept = new_width * new_height / (width * height) if width * height else 1.0
+        return pixels_kept * BITS_4 / 8
+
+
+def read_size(source: ImageSource) -> tuple[int, int]:
+    """
+    Gets the size of an image from its header only.
+
+    :param source: Path, binary file object or Pillow image, or a (width, height) tuple.
+    :return: Width and height of the image.
+    """
+    if isinstance(source, tuple):
+        return source
+    if isinstance(source, Image.Image):
+        return source.size
+    if not isinstance(source, str):
+        source.seek(0)
+    # Opening an image only parses its header, pixels are decoded on load
+    with Image.open(source) as image:
+        return image.size
+
+
+def plan_text(
+    cover: ImageSource, message: str | int, codec: Optional[Codec] = Codec.NONE, density: int = CHARACTER_DENSITY
+) -> TextCapacity:
+    """
+    Checks whether a text message fits in a cover image, without encrypting it.
+
+    A message given as text is compressed as `encrypt_text_to_image` would.
+
+    :param cover: Cover image, see `read_size`.
+    :param message: Message to encrypt, or its length in bytes once compressed with `codec`.
+    :param codec: Compression of the message, or `None` to pick the one needing the fewest pixels,
+    which requires the message as text.
+    :param density: Bits per color plane holding the message, see `encrypt_text_to_image`.
+    :return: Capacity of the cover for the message.
+    """
+    if isinstance(message, str):
+        codec, data = compress(strip_non_ascii(message.strip()).encode("ascii"), codec, density)
+        message = len(data)
+    elif codec is None:
+        raise ValueError("The codec must be given with the length of the message")
+    return TextCapacity(read_size(cover), message, codec, density)
+
+
+def plan_image(cover: ImageSource, secret: ImageSource) -> ImageCapacity:
+    """
+    Checks how a secret image would be resized to fit a cover image, without encrypting it.
+
+    :param cover: Cover image, see `read_size`.
+    :param secret: Image to hide, see `read_size`.
+    :return: Capacity of the cover for the secret image.
+    """
+    cover_size, secret_size = read_size(cover), read_size(secret)
+    return ImageCapacity(
+        cover_size, secret_size, resized_size(secret_size, cover_size, ResizeMode.SHRINK_TO_SCALE)
+    )
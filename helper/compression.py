@@ -0,0 +1,140 @@
+import bz2
+import io
+import lzma
+import tempfile
+import zlib
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain
+from typing import IO, Any, Callable, Iterator, Optional, Protocol
+
+from .constant import CHARACTER_DENSITY, Codec, PayloadMode
+from .packing import payload_pixels
+
+# Payloads are read and compressed in chunks of this size
+CHUNK_BYTES = 1 << 20
+# Compressed payloads larger than this are spooled to disk
+SPOOL_BYTES = 64 << 20
+# Decompressed payloads may be this many times longer than as embedded, or this long, whichever is more.
+# Real text and files stay well within these, decompression bombs do not.
+MAX_EXPANSION = 1024
+MIN_DECOMPRESSED_LIMIT = 64 << 20
+
+
+class Decompressor(Protocol):
+    """Incremental decompressor, as returned by `zlib.decompressobj`"""
+
+    def decompress(self, data: bytes, max_length: int = -1) -> bytes:
+        """Decompresses the next chunk of data, into at most `max_length` bytes if positive"""
+
+
+class Passthrough:
+    """Decompressor of uncompressed data"""
+
+    def decompress(self, data: bytes, max_length: int = -1) -> bytes:
+        """Returns the data as it is"""
+        return data
+
+
+# Raised by decompressors on corrupt data
+DecompressionError = (zlib.error, lzma.LZMAError, OSError, EOFError)
+
+COMPRESSORS: dict[Codec, Callable[[bytes], bytes]] = {
+    Codec.ZLIB: partial(zlib.compress, level=9),
+    Codec.LZMA: lzma.compress,
+    Codec.BZ2: partial(bz2.compress, compresslevel=9),
+}
+STREAM_COMPRESSORS: dict[Codec, Callable[[], Any]] = {
+    Codec.ZLIB: partial(zlib.compressobj, 9),
+    Codec.LZMA: lzma.LZMACompressor,
+    Codec.BZ2: partial(bz2.BZ2Compressor, 9),
+}
+DECOMPRESSORS: dict[Codec, Callable[[], Decompressor]] = {
+    Codec.NONE: Passthrough,
+    Codec.ZLIB: zlib.decompressobj,
+    Codec.LZMA: lzma.LZMADecompressor,
+    Codec.BZ2: bz2.BZ2Decompressor,
+}
+
+
+def decompressed_limit(length: int) -> int:
+    """Most bytes a payload of `length` bytes as embedded may decompress to, see `MAX_EXPANSION`"""
+    return max(MIN_DECOMPRESSED_LIMIT, length * MAX_EXPANSION)
+
+
+def compress(
+    data: bytes,
+    codec: Optional[Codec] = Codec.NONE,
+    density: int = CHARACTER_DENSITY,
+    mode: PayloadMode = PayloadMode.TEXT,
+) -> tuple[Codec, bytes]:
+    """
+    Compresses a payload before embedding.
+
+    Payloads compressed past what decryption accepts, see `decompressed_limit`,
+    are left uncompressed instead.
+
+    :param data: Payload to compress.
+    :param codec: Codec to use, or `None` to pick the one needing the fewest pixels,
+    which may be no compression at all.
+    :param density: Density the payload is embedded at, see `payload_pixels`.
+    :param mode: Kind of payload.
+    :return: Tuple of the codec used and the compressed data.
+    """
+    if codec is Codec.NONE:
+        return codec, data
+    if codec is not None:
+        compressed = COMPRESSORS[codec](data)
+        return (codec, compressed) if len(data) <= decompressed_limit(len(compressed)) else (Codec.NONE, data)
+    best, best_pixels = (Codec.NONE, data), payload_pixels(len(data), Codec.NONE, density, mode)
+    for codec, compressor in COMPRESSORS.items():
+        compressed = compressor(data)
+        if len(data) > decompressed_limit(len(compressed)):
+            continue
+        if (pixels := payload_pixels(len(compressed), codec, density, mode)) < best_pixels:
+            best, best_pixels = (codec, compressed), pixels
+    return best
+
+
+@contextmanager
+def compressed_stream(
+    source: IO[bytes], codec: Optional[Codec] = Codec.NONE, density: int = CHARACTER_DENSITY
+) -> Iterator[tuple[Codec, int, Iterator[bytes]]]:
+    """
+    Compresses a binary payload read in chunks, without holding it in memory.
+
+    The length of the payload must be known before embedding it, so compressed
+    data is first written to a temporary file, kept in memory while small.
+    Payloads compressed past what decryption accepts, see `decompressed_limit`,
+    are read again and embedded uncompressed.
+
+    :param source: Binary file object of the payload, read from its current position.
+    :param codec: Codec to use, or `None` to pick the one compressing the first chunk
+    into the fewest pixels.
+    :param density: Density the payload is embedded at, see `payload_pixels`.
+    :return: Tuple of the codec used, the length of the compressed payload and an
+    iterator of its chunks, valid until the context exits.
+    """
+    start = source.tell()
+    first = source.read(CHUNK_BYTES)
+    if codec is None:
+        codec = compress(first, None, density, PayloadMode.BINARY)[0]
+    if codec is not Codec.NONE:
+        with tempfile.SpooledTemporaryFile(SPOOL_BYTES) as spool:
+            compressor = STREAM_COMPRESSORS[codec]()
+            for chunk in chain([first], iter(partial(source.read, CHUNK_BYTES), b"")):
+                spool.write(compressor.compress(chunk))
+            spool.write(compressor.flush())
+            length = spool.tell()
+            if source.tell() - start <= decompressed_limit(length):
+                spool.seek(0)
+                yield codec, length, iter(partial(spool.read, CHUNK_BYTES), b"")
+                return
+    length = source.seek(0, io.SEEK_END) - start
+    source.seek(start)
+    yield Codec.NONE, length, iter(partial(source.read, CHUNK_BYTES), b"")
+
+
+def decompressor(codec: Codec) -> Decompressor:
+    """Creates an incremental decompressor for a codec"""
+    return DECOMPRESSORS[codec]()
@@ -9,6 +9,22 @@ STARTING_Y = 0
 BITS_4 = 4
 # R, G, B
 N_PLANES = 3
+# Added as message end by the legacy text format, which had no header
+END_TEXT = ",,,.."
+# Starts the header of payloads, DEL then "STG", one character per pixel
+HEADER_MAGIC = "\x7fSTG"
+# Version of the header and payload layout written by encryption
+FORMAT_VERSION = 3
+# Payload density storing one 7-bit character code per pixel, as in the original text format
+CHARACTER_DENSITY = 0
+# Most low bits per channel a payload can replace
+MAX_DENSITY = BITS_4
+# Pixels read per band when scanning an image row by row
+BAND_PIXELS = 1 << 16
+# Pixels read per tile when streaming images too large for memory
+TILE_PIXELS = 1 << 22
+# Largest image accepted from GUI uploads, refused before decoding
+MAX_UPLOAD_PIXELS = 100_000_000
 
 
 class ResizeMode(Enum):
@@ -44,3 +60,59 @@ class ExifData(Enum):
     ARTIST = 315
     SOFTWARE = 305
     DESCRIPTION = 270
+
+
+class PayloadMode(Enum):
+    """Enumeration for the kinds of payload announced by a header"""
+
+    TEXT = 1
+    # Any bytes, such as files
+    BINARY = 2
+
+
+class PayloadKind(Enum):
+    """Enumeration for what an image is found to hide without decrypting it"""
+
+    TEXT = "text"
+    FILE = "file"
+    IMAGE = "image"
+    # Nothing, a text message in the format predating headers, or an image without its metadata
+    UNKNOWN = "unknown"
+
+
+class Codec(Enum):
+    """Enumeration for the compression applied to payloads before embedding"""
+
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+    BZ2 = 3
+
+
+class OutputProfile(Enum):
+    """Enumeration for the ways output images are encoded, trading write speed for file size"""
+
+    # PNG at zlib's default level
+    PNG = "png"
+    # PNG at the lowest level with run-length matching, for temporary files
+    PNG_FAST = "png-fast"
+    # PNG at the highest level with the best filters, for archival
+    PNG_SMALL = "png-small"
+    # Lossless WebP, smaller than PNG but slower to write
+    WEBP = "webp"
+    # Uncompressed, the fastest to write and read
+    TIFF = "tiff"
+    BMP = "bmp"
+    PPM = "ppm"
+
+
+class Operation(Enum):
+    """Enumeration for the operations a batch job can run"""
+
+    ENCRYPT_TEXT = "encrypt-text"
+    ENCRYPT_IMAGE = "encrypt-image"
+    # Any file, e.g. an archive or a document, kept byte for byte
+    ENCRYPT_FILE = "encrypt-file"
+    DECRYPT = "decrypt"
+    # Report what each image hides, without decrypting it
+    PROBE = "probe"
@@ -1,42 +1,360 @@
-from PIL.Image import Image
+import logging
+from itertools import chain
+from typing import IO, Generator, Iterable, Iterator, Optional
 
-from .constant import BITS_4, N_PLANES
-from .utility import parse_exif, pixels_to_binary
+import numpy as np
+import PIL.Image
+from PIL.Image import Exif, Image
 
+from . import compression
+from .constant import (
+    BAND_PIXELS, BITS_4, CHARACTER_DENSITY, END_TEXT, N_PLANES, STARTING_X,
+    PayloadMode
+)
+from .header import HEADER_PIXELS, Header, parse_header
+from .instrument import staged
+from .packing import ValueJoiner, extract_dense, value_bits, values_to_bytes
+from .parallel import band_ranges, image_array, map_bands, run_bands
+from .utility import (
+    FileSource, iter_file_bands, iter_pixel_bands, parse_exif, pixels_to_codes
+)
 
-def decrypt_text_from_image(img: Image) -> tuple[str, bool]:
+logger = logging.getLogger(__name__)
+END_BYTES = END_TEXT.encode("ascii")
+# Moves the 4 least significant bits of a byte to the most significant ones
+DECRYPT_LUT = [(byte << BITS_4) & 0xFF for byte in range(256)]
+
+TextStream = Generator[str, None, bool]
+
+
+def stream_text_from_bands(bands: Iterable[np.ndarray]) -> TextStream:
+    """
+    Decrypts text from bands of pixels as they arrive.
+
+    Each band is an array of RGB pixels, as yielded by `iter_pixel_bands` or
+    `iter_file_bands`. The three least significant bits of red and green and
+    the least significant bit of blue of each pixel are combined into the
+    corresponding ASCII character. The first characters hold a header giving
+    the message length, codec and density (see `helper.header`), and no band
+    is requested after the message ends. Images encrypted before headers
+    existed are read until the message delimiter ",,,.." instead.
+
+    :param bands: Iterable of (pixels, 3) uint8 arrays, in pixel order.
+    :return: Generator of decrypted text chunks. Its return value is a bool
+    indicating whether a whole message (header and payload, or legacy delimiter) was found.
+    Binary payloads are not text, so nothing is yielded for them and False is returned.
+    """
+    header, pixels, bands = split_header(bands)
+    if header is None:
+        return (yield from scan_delimited_text(pixels_to_codes(pixels).tobytes(), bands))
+    if header.mode is not PayloadMode.TEXT:
+        return False
+    return (yield from decode_text(stream_payload(header, chain([pixels[header.pixels:]], bands))))
+
+
+def split_header(bands: Iterable[np.ndarray]) -> tuple[Optional[Header], np.ndarray, Iterator[np.ndarray]]:
+    """
+    Reads the header from the first bands of pixels of an image.
+
+    :param bands: Iterable of (pixels, 3) uint8 arrays, in pixel order.
+    :return: Tuple of the header, or `None` if there is none, the pixels read so far
+    and an iterator of the remaining bands.
+    """
+    bands = iter(bands)
+    first = []
+    # The header must be read whole before the format is known
+    for band in bands:
+        first.append(band)
+        if sum(map(len, first)) >= HEADER_PIXELS:
+            break
+    pixels = np.concatenate(first) if first else np.empty((0, N_PLANES), dtype=np.uint8)
+    return parse_header(pixels_to_codes(pixels[:HEADER_PIXELS])), pixels, bands
+
+
+def stream_bytes_from_bands(bands: Iterable[np.ndarray]) -> Generator[bytes, None, bool]:
+    """
+    Recovers the payload of an image as bytes, from bands of pixels as they arrive.
+
+    Any payload with a header is recovered, text or binary, but not messages in the
+    legacy format.
+
+    :param bands: Iterable of (pixels, 3) uint8 arrays, in pixel order.
+    :return: Generator of payload chunks. Its return value is a bool indicating
+    whether the whole payload was found.
+    """
+    header, pixels, bands = split_header(bands)
+    if header is None:
+        return False
+    return (yield from stream_payload(header, chain([pixels[header.pixels:]], bands)))
+
+
+def write_payload(stream: Generator[bytes, None, bool], sink: IO[bytes]) -> bool:
+    """
+    Writes a payload stream to a binary file object as it arrives.
+
+    :param stream: Generator returned by one of the `stream_bytes_from_*` functions.
+    :param sink: Writable binary file object.
+    :return: Whether the whole payload was found. Bytes may have been written even if not.
+    """
+    try:
+        while True:
+            if data := next(stream):
+                sink.write(data)
+    except StopIteration as stop:
+        return stop.value
+
+
+def decode_text(payload: Generator[bytes, None, bool]) -> TextStream:
+    """Decodes the chunks of a text payload, keeping the stream's return value"""
+    try:
+        while True:
+            if text := next(payload):
+                yield text.decode("ascii")
+    except StopIteration as stop:
+        return stop.value
+
+
+def stream_payload(header: Header, bands: Iterable[np.ndarray]) -> Generator[bytes, None, bool]:
+    """
+    Recovers a payload from the pixels following its header.
+
+    The payload is read with the density given by the header, and decompressed
+    as it arrives with the codec given by the header.
+
+    :param header: Header of the payload.
+    :param bands: (pixels, 3) uint8 arrays of the pixels after the header, in bands of any size.
+    :return: Generator of payload chunks. Its return value is a bool indicating
+    whether the whole payload was found and decompressed.
+    """
+    return (yield from decompress_payload(header, extract_chunks(header, bands)))
+
+
+def extract_chunks(header: Header, bands: Iterable[np.ndarray]) -> Iterator[bytes]:
+    """
+    Extracts the bytes of a payload, still compressed, from bands of pixels of any size.
+
+    :param header: Header of the payload.
+    :param bands: (pixels, 3) uint8 arrays of the pixels after the header.
+    :return: Iterator of chunks of the payload, requesting no band after its last pixel.
+    """
+    remaining = header.payload_pixels
+    # Uncompressed text at the character density needs no repacking
+    joiner = None if header.characters else ValueJoiner(value_bits(header.density))
+    if not remaining:
+        return
+    for band in bands:
+        band, remaining = band[:remaining], remaining - min(remaining, len(band))
+        values = extract_values(header, band)
+        data = values.tobytes() if joiner is None else joiner.join(values)
+        if not remaining and joiner is not None:
+            data += joiner.flush()
+        yield data
+        if not remaining:
+            return
+
+
+def extract_values(header: Header, pixels: np.ndarray) -> np.ndarray:
+    """Reads the values hidden in pixels holding a payload, with the density given by its header"""
+    if header.density == CHARACTER_DENSITY:
+        return pixels_to_codes(pixels)
+    return extract_dense(pixels, header.density)
+
+
+def extract_chunks_parallel(header: Header, pixels: np.ndarray, threads: int = 1) -> Iterator[bytes]:
+    """
+    Extracts the bytes of a payload, still compressed, from bands of an array of pixels on several threads.
+
+    Bands hold a multiple of 8 pixels, so each one holds whole bytes.
+
+    :param header: Header of the payload.
+    :param pixels: (pixels, 3) uint8 array of the pixels after the header.
+    :param threads: Number of threads extracting bands, see `helper.parallel`.
+    :return: Iterator of chunks of the payload, in order.
+    """
+    pixels = pixels[:header.payload_pixels]
+    bits = 8 if header.characters else value_bits(header.density)
+
+    def extract(start: int, end: int) -> bytes:
+        return values_to_bytes(extract_values(header, pixels[start:end]), bits)
+
+    return map_bands(extract, band_ranges(len(pixels)), threads)
+
+
+def decompress_payload(header: Header, chunks: Iterable[bytes]) -> Generator[bytes, None, bool]:
+    """
+    Decompresses the chunks of a payload as they arrive, with the codec given by its header.
+
+    Payloads decompressing to more than `compression.decompressed_limit` bytes
+    are refused as soon as the limit is reached, without inflating any further.
+
+    :param header: Header of the payload.
+    :param chunks: Chunks of the payload as embedded, e.g. from `extract_chunks`.
+    :return: Generator of payload chunks. Its return value is a bool indicating
+    whether the whole payload was found and decompressed within the limit.
+    """
+    decompressor = compression.decompressor(header.codec)
+    limit = compression.decompressed_limit(header.length)
+    # Padding bits may complete a byte after the payload's last one
+    length = header.length
+    try:
+        for data in chunks:
+            data, length = data[:length], length - min(length, len(data))
+            # One byte over the limit tells a payload reaching it from one exceeding it
+            output = decompressor.decompress(data, limit + 1)
+            limit -= len(output)
+            if limit < 0:
+                return False
+            yield output
+            if not length:
+                break
+    except compression.DecompressionError:
+        return False
+    return not length and getattr(decompressor, "eof", True)
+
+
+def scan_delimited_text(codes: bytes, bands: Iterator[np.ndarray]) -> TextStream:
+    """
+    Decrypts text in the legacy format, ended by the delimiter ",,,..", from bands of pixels.
+
+    :param codes: Codes already read from the first bands.
+    :param bands: Iterator of the remaining bands.
+    :return: Generator of decrypted text chunks, see `stream_text_from_bands`.
+    """
+    # The last characters are held back until they cannot start the delimiter
+    pending = b""
+    for codes in chain([codes], (pixels_to_codes(band).tobytes() for band in bands)):
+        codes = pending + codes
+        end = codes.find(END_BYTES)
+        if end != -1:
+            if end:
+                yield codes[:end].decode("ascii")
+            return True
+        pending = codes[-len(END_BYTES):]
+        if len(codes) > len(pending):
+            yield codes[:-len(END_BYTES)].decode("ascii")
+    return False
+
+
+def stream_text_from_file(fp: FileSource, band_pixels: int = BAND_PIXELS) -> TextStream:
+    """
+    Decrypts text from an image file without decoding more rows than needed.
+
+    :param fp: Path or binary file object of the image containing the message.
+    :param band_pixels: Approximate number of pixels in the first band read.
+    :return: Generator of decrypted text chunks, see `stream_text_from_bands`.
+    """
+    return stream_text_from_bands(iter_file_bands(fp, band_pixels))
+
+
+def join_text(stream: TextStream) -> tuple[str, bool]:
+    """
+    Collects a text stream into a string.
+
+    :param stream: Generator returned by one of the `stream_text_from_*` functions.
+    :return: Tuple of the decrypted message and whether the delimiter was found.
+    """
+    chunks = []
+    try:
+        while True:
+            chunks.append(next(stream))
+    except StopIteration as stop:
+        return "".join(chunks), stop.value
+
+
+@staged("extract_text")
+def decrypt_text_from_image(img: Image, threads: int = 1) -> tuple[str, bool]:
     """
     Decrypts an image encoded with text.
 
     param img: A Pillow Image object containing message
-    This function iterates over an image's pixels and extracts the three least
-    significant bits of each color plane. These values are summed and converted
-    to the corresponding ASCII character. The function scans until it finds
-    the message delimiter ",,,.." or it processes all pixels. It returns
-    a tuple of the decrypted message and a bool indicating whether the
-    delimiter (present in all valid messages) was found.
-    """
-    delimiter = False
-    pixel_list, word_total = [], ""
-    RGB_binary_list = pixels_to_binary(img)
-
-    # Iterates through each pixel's binary values and concatenates the least significant bits into decoded code
-    for pixel in RGB_binary_list:
-        output = "0"
-        r, g, b = pixel[0][-N_PLANES:], pixel[1][-N_PLANES:], pixel[2][-1]
-        output += f"{b}{g}{r}"
-        pixel_list.append(int(output, 2))
-
-    # Iterates through each binary output and converts each binary to ASCII, simultaneously checking for the delimiter
-    for binary in pixel_list:
-        if word_total[-5:] == ",,,..":
-            delimiter = True
-            break
-        word_total += format(binary, "c")
-    return word_total[:-5], delimiter
+    This function extracts the three least significant bits of red and green
+    and the least significant bit of blue of each pixel. These values are
+    combined into the corresponding ASCII character. The first characters hold
+    a header giving the message length, so the rows covering the message are
+    read in one slice, then extracted in bands, each band on its own thread
+    when `threads` is more than 1. Images encrypted before headers existed are
+    scanned in bands of rows until the message delimiter ",,,.." or the last pixel.
+    It returns a tuple of the decrypted message and a bool indicating whether
+    a whole message was found.
+    """
+    width, height = img.size
+    header_rows = min(height, -(-HEADER_PIXELS // max(1, width)))
+    header = parse_header(pixels_to_codes(np.asarray(img.crop((STARTING_X, 0, width, header_rows)))).ravel())
+    if header is None or header.mode is not PayloadMode.TEXT:
+        return join_text(stream_text_from_bands(iter_pixel_bands(img)))
+    end = header.pixels + header.payload_pixels
+    if end > width * height:
+        return "", False
+    rows = image_array(img, threads, -(-end // width))
+    pixels = rows.reshape((-1, rows.shape[-1]))[header.pixels:end]
+    return join_text(decode_text(decompress_payload(header, extract_chunks_parallel(header, pixels, threads))))
 
 
-def decrypt_image_from_image(image: Image) -> Image:
+@staged("extract_text")
+def decrypt_text_from_file(fp: FileSource) -> tuple[str, bool]:
+    """
+    Decrypts text from an image file, reading only the rows the message covers when possible.
+
+    :param fp: Path or binary file object of the image containing the message.
+    :return: Tuple of the decrypted message and whether the delimiter was found.
+    """
+    return join_text(stream_text_from_file(fp))
+
+
+@staged("extract_bytes")
+def decrypt_bytes_from_image(img: Image, sink: IO[bytes]) -> bool:
+    """
+    Decrypts the payload of an image, e.g. a binary file, into a binary file object.
+
+    :param img: Pillow image containing the payload.
+    :param sink: Writable binary file object receiving the payload as it is decrypted.
+    :return: Whether the whole payload was found.
+    """
+    return write_payload(stream_bytes_from_bands(iter_pixel_bands(img)), sink)
+
+
+@staged("extract_bytes")
+def decrypt_bytes_from_file(fp: FileSource, sink: IO[bytes]) -> bool:
+    """
+    Decrypts the payload of an image file into a binary file object, decoding no more rows than needed.
+
+    :param fp: Path or binary file object of the image containing the payload.
+    :param sink: Writable binary file object receiving the payload as it is decrypted.
+    :return: Whether the whole payload was found.
+    """
+    return write_payload(stream_bytes_from_bands(iter_file_bands(fp)), sink)
+
+
+def hidden_image_size(image: Image) -> tuple[int, int]:
+    """
+    Gets the size of the image hidden in an encrypted image.
+
+    The size is read from the image's EXIF metadata, limited to the image's
+    own size. Failing that, the whole image is assumed to be hidden.
+
+    :param image: Pillow image containing encrypted image.
+    :return: Width and height of the hidden image.
+    """
+    return hidden_size_from_exif(image.getexif(), image.size)
+
+
+def hidden_size_from_exif(exif: Exif, size: tuple[int, int]) -> tuple[int, int]:
+    """
+    Gets the size of a hidden image from the metadata of the image hiding it.
+
+    :param exif: Metadata of the encrypted image.
+    :param size: Size of the encrypted image.
+    :return: Width and height of the hidden image.
+    """
+    if hidden_size := parse_exif(exif):
+        (width, height), (max_width, max_height) = hidden_size, size
+        return min(width, max_width), min(height, max_height)
+    logger.debug("No hidden image size in the EXIF metadata, decrypting the whole image")
+    return size
+
+
+@staged("extract_image")
+def decrypt_image_from_image(image: Image, threads: int = 1) -> Image:
     """
     Decrypts the secret image from the given input image.
 
@@ -44,14 +362,49 @@ def decrypt_image_from_image(image: Image) -> Image:
     a cover image's metadata. Failing that, it decrypts the whole image.
     It should recover the four most significant bits of each pixel of the
     original image.
+    The hidden region is read in bands of rows, mapped through a lookup
+    table shared by all calls, and pasted into a single output image.
+    With several threads, bands are decrypted in parallel.
 
     :param image: Pillow image containing encrypted image.
+    :param threads: Number of threads decrypting bands, see `helper.parallel`.
     :return: The reconstruction of the original image.
     """
-    if size := parse_exif(image.getexif()):
-        width, height = size
-        image = image.crop((0, 0, width, height))
-    else:
-        print("WARNING: Could not parse size from EXIF metadata. Falling back to decrypting whole image")
+    width, height = hidden_image_size(image)
+    secret = PIL.Image.new(image.mode, (width, height))
+    lut = DECRYPT_LUT * len(image.getbands())
+    # Loaded before bands are cropped from several threads
+    image.load()
+
+    def decrypt(top: int, bottom: int):
+        secret.paste(image.crop((STARTING_X, top, width, bottom)).point(lut), (STARTING_X, top))
+
+    run_bands(decrypt, band_ranges(height, BAND_PIXELS // max(1, width)), threads)
+    return secret
 
-    return image.point(lambda byte: (byte & 0b00001111) << BITS_4)
+
+def decrypt_image_into(image: Image, out: np.ndarray) -> np.ndarray:
+    """
+    Decrypts the secret image from the given input image into an existing array.
+
+    This lets batch decoders reuse one buffer for many images. The image's
+    pixels are read into one array, and each band of rows of the hidden
+    region is decrypted from it straight into `out`.
+
+    :param image: Pillow image containing encrypted image.
+    :param out: uint8 array of at least (height, width, bands) of the hidden image,
+    see `hidden_image_size`.
+    :return: View of `out` holding the reconstruction of the original image.
+    """
+    width, height = hidden_image_size(image)
+    bands = len(image.getbands())
+    if out.dtype != np.uint8 or out.ndim != 3 or out.shape[0] < height or out.shape[1] < width \
+            or out.shape[2] != bands:
+        raise ValueError(f"Output array must be uint8 and hold at least {(height, width, bands)}")
+    pixels = np.asarray(image)
+    band_rows = max(1, BAND_PIXELS // max(1, width))
+    for top in range(0, height, band_rows):
+        bottom = min(top + band_rows, height)
+        # Shifting out of a byte drops the 4 most significant bits, as DECRYPT_LUT does
+        np.left_shift(pixels[top:bottom, STARTING_X:width], BITS_4, out=out[top:bottom, :width])
+    return out[:height, :width]
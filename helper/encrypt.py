@@ -1,102 +1,299 @@
+from dataclasses import dataclass
+from typing import IO, Iterable, Optional
+
 import numpy as np
 from PIL import Image
 
 from . import utility
-from .constant import BITS_4, N_PLANES, Direction
+from .compression import compress, compressed_stream
+from .constant import (
+    BAND_PIXELS, BITS_4, CHARACTER_DENSITY, N_PLANES, STARTING_X, Codec,
+    PayloadMode
+)
+from .header import Header, header_codes
+from .instrument import staged
+from .packing import (
+    ValueSplitter, embed_dense, value_bits, values_between, values_needed
+)
+from .parallel import band_ranges, image_array, run_bands
+
+
+@dataclass(frozen=True)
+class Segment:
+    """Bytes to encrypt in a run of consecutive pixels, split into values as each band of pixels needs them"""
+
+    start: int
+    data: bytes
+    # Bits of data per value, one value per pixel at the character density and one per channel otherwise
+    bits: int = 8
+    density: int = CHARACTER_DENSITY
+
+    @property
+    def per_pixel(self) -> int:
+        """Values encrypted in each pixel"""
+        return 1 if self.density == CHARACTER_DENSITY else N_PLANES
+
+    @property
+    def end(self) -> int:
+        """Pixel after the last pixel of the segment"""
+        return self.start + values_needed(len(self.data), self.bits * self.per_pixel)
+
+    def values(self, start: int, end: int) -> np.ndarray:
+        """
+        Splits the values encrypted in a range of the segment's pixels.
 
-# Added as message end
-END_TEXT = ",,,.."
-END_BYTES = list(map(ord, END_TEXT))
+        :param start: First pixel of the range, counted from the start of the segment.
+        :param end: Pixel after the last pixel of the range.
+        :return: (pixels,) character codes at the character density, (pixels, 3) channel values otherwise.
+        """
+        values = values_between(self.data, self.bits, start * self.per_pixel, end * self.per_pixel)
+        return values if self.density == CHARACTER_DENSITY else values.reshape((-1, N_PLANES))
 
 
-def encrypt_text_to_image(text: str, image: Image.Image) -> Image.Image | None:
+@staged("embed_text")
+def encrypt_text_to_image(
+    text: str,
+    image: Image.Image,
+    codec: Optional[Codec] = Codec.NONE,
+    density: int = CHARACTER_DENSITY,
+    threads: int = 1,
+) -> Image.Image | None:
     """
     Encode a text string in the pixels of an image
 
     This function encrypts a string in an image. Non-ASCII characters are
     stripped from the string, and a copy of the image is made.
-    For each character, a pixel of the copy is selected,
+    A header giving the message length is encrypted first (see `helper.header`),
+    then for each character, a pixel of the copy is selected,
     going left and down from the top left corner.
     For each pixel, the 7 bits of the corresponding ASCII code are encoded in
     the three least significant bits
     of each color plane (red, green, blue).
     Blue receives only one bit. The modified copy with the encoded message is
     returned.
+    With a codec, the message is compressed first, and the compressed bytes are
+    packed 7 bits per pixel instead. With a density from 1 to 4, the message is
+    instead written as a continuous stream of bits over that many least
+    significant bits of each color plane.
+    The pixels are encrypted in bands, each band on its own thread when
+    several are asked for.
 
-    If the input text contains more characters than the image has pixels,
+    If the header and the input text need more pixels than the image has,
     encryption is impossible, so `None` is returned.
 
     :param text: Message to encrypt.
     :param image: Pillow `Image` object in which `text` will be encrypted. Must have at
     least R, G, and B color planes.
+    :param codec: Compression of the message, or `None` to pick the one needing the fewest pixels.
+    :param density: Bits per color plane holding the message, or `CHARACTER_DENSITY`
+    for one character per pixel.
+    :param threads: Number of threads encrypting bands of pixels, see `helper.parallel`.
     :return: Image with the secret message encrypted.
     """
-    # Convert to ASCII and add padding indicating message end
-    bytes = utility.to_bytes(utility.strip_non_ascii(text.strip())) + END_BYTES
-    n = len(bytes)
+    segments = text_to_segments(text, codec, density)
     # RGB only
     cols, rows = image.size
     extent = cols * rows
     # Alert caller if too many bytes to encode
-    if n > extent:
+    if segments[-1].end > extent:
         return None
 
-    # Create array from ASCII codes with image's width and height,
-    # padded with zeroes
-    bytes = np.array(bytes, dtype=np.uint8)
-    pixels = np.array(image, dtype=np.uint8)
-    mask = np.concatenate(
-        (bytes, np.zeros(extent - n, dtype=np.uint8)), dtype=np.uint8
-    ).reshape((rows, cols))
+    pixels = image_array(image, threads)
+    flat = pixels.reshape((extent, -1))
+
+    def embed(start: int, end: int):
+        embed_segments(flat[start:end], segments, start)
+
+    run_bands(embed, band_ranges(segments[-1].end), threads)
+    return Image.fromarray(pixels)
+
+
+def text_to_segments(
+    text: str, codec: Optional[Codec] = Codec.NONE, density: int = CHARACTER_DENSITY
+) -> list[Segment]:
+    """
+    Converts a message to the values encrypted in the first pixels of an image.
+
+    Non-ASCII characters are stripped from the message, which is then
+    compressed, and the header giving its length, codec and density is put in front.
+
+    :param text: Message to encrypt.
+    :param codec: Compression of the message, or `None` to pick the one needing the fewest pixels.
+    :param density: Bits per color plane holding the message, or `CHARACTER_DENSITY`.
+    :return: Segments of the header and of the message.
+    """
+    message = utility.strip_non_ascii(text.strip()).encode("ascii")
+    codec, data = compress(message, codec, density)
+    header = Header(PayloadMode.TEXT, len(data), codec, density)
+    # Uncompressed text at the character density is one ASCII code per pixel
+    bits = 8 if header.characters else value_bits(density)
+    return [Segment(0, header_codes(header).tobytes()), Segment(header.pixels, data, bits, density)]
+
+
+def embed_segments(pixels: np.ndarray, segments: list[Segment], offset: int = 0) -> None:
+    """
+    Encrypts the parts of segments falling in an array of pixels, in place.
+
+    :param pixels: Writable (pixels, planes) uint8 array, with at least R, G, and B planes.
+    :param segments: Segments to encrypt.
+    :param offset: Index in the image of the first pixel of the array, when encrypting a band.
+    """
+    for segment in segments:
+        start, end = max(segment.start, offset), min(segment.end, offset + len(pixels))
+        if start >= end:
+            continue
+        values = segment.values(start - segment.start, end - segment.start)
+        if segment.density == CHARACTER_DENSITY:
+            embed_codes(pixels[start - offset:end - offset], values)
+        else:
+            embed_dense(pixels[start - offset:end - offset], values, segment.density)
+
+
+class PayloadEmbedder:
+    """Encrypts a header and a payload arriving in chunks, band after band of pixels"""
+
+    def __init__(self, header: Header, chunks: Iterable[bytes]):
+        """
+        Prepares the header and payload for encryption.
+
+        :param header: Header of the payload, giving its length once embedded.
+        :param chunks: Chunks of the payload as embedded, e.g. compressed.
+        """
+        self.header = header
+        self.codes = header_codes(header)
+        self.splitter = ValueSplitter(chunks, value_bits(header.density))
+        # Next pixel of the payload to encrypt
+        self.position = header.pixels
+
+    @property
+    def end(self) -> int:
+        """Pixel after the last pixel of the payload"""
+        return self.header.pixels + self.header.payload_pixels
 
+    def embed(self, pixels: np.ndarray, offset: int = 0) -> None:
+        """
+        Encrypts the part of the header and payload falling in a band of pixels, in place.
+
+        Bands must be given in order, without gaps, from the first pixel of the image.
+
+        :param pixels: Writable (pixels, planes) uint8 array, with at least R, G, and B planes.
+        :param offset: Index in the image of the first pixel of the array.
+        """
+        if offset < len(self.codes):
+            embed_codes(pixels, self.codes[offset:offset + len(pixels)])
+        start, end = max(self.position, offset), min(self.end, offset + len(pixels))
+        if start >= end:
+            return
+        density = self.header.density
+        if density == CHARACTER_DENSITY:
+            embed_codes(pixels[start - offset:], self.splitter.take(end - start))
+        else:
+            values = self.splitter.take((end - start) * N_PLANES).reshape((-1, N_PLANES))
+            embed_dense(pixels[start - offset:], values, density)
+        self.position = end
+
+
+@staged("embed_file")
+def encrypt_file_to_image(
+    source: IO[bytes], image: Image.Image, codec: Optional[Codec] = Codec.NONE, density: int = CHARACTER_DENSITY
+) -> Image.Image | None:
+    """
+    Encrypts arbitrary bytes, read in chunks from a binary file, in the pixels of an image.
+
+    The bytes are kept as they are, and packed 7 bits per pixel at the character
+    density, or over the low bits of each color plane otherwise, after a header
+    marking them as binary data.
+
+    :param source: Binary file object of the payload, read from its current position.
+    :param image: Pillow `Image` object in which the payload will be encrypted. Must have at
+    least R, G, and B color planes.
+    :param codec: Compression of the payload, or `None` to pick one from the first chunk.
+    :param density: Bits per color plane holding the payload, or `CHARACTER_DENSITY`.
+    :return: Image with the payload encrypted, or `None` if it does not fit.
+    """
+    cols, rows = image.size
+    extent = cols * rows
+    with compressed_stream(source, codec, density) as (codec, length, chunks):
+        try:
+            embedder = PayloadEmbedder(Header(PayloadMode.BINARY, length, codec, density), chunks)
+        except ValueError:
+            return None
+        if embedder.end > extent:
+            return None
+        pixels = np.array(image, dtype=np.uint8)
+        flat = pixels.reshape((extent, -1))
+        for offset in range(0, embedder.end, BAND_PIXELS):
+            embedder.embed(flat[offset:offset + BAND_PIXELS], offset)
+    return Image.fromarray(pixels)
+
+
+def embed_codes(pixels: np.ndarray, codes: np.ndarray) -> None:
+    """
+    Encrypts ASCII codes in place in the first pixels of an array.
+
+    Only as many pixels as there are codes are touched.
+
+    :param pixels: Writable (pixels, planes) uint8 array, with at least R, G, and B
+    planes, in which the codes are encrypted left and down.
+    :param codes: ASCII codes to encrypt, no more than there are pixels.
+    """
+    used = pixels[:codes.size, :N_PLANES]
     modulus = 2 ** N_PLANES
-    # Needed to identify which pixels need LSBs cleared
-    full_rows = n // cols
-    last_row_cols = n % cols
-
-    # First clear all rows where all pixels are used
-    pixels[:full_rows, :, :N_PLANES] = utility.clear_least_significant_bits(
-        pixels[:full_rows, :, :N_PLANES], N_PLANES
-    )
-    # And last, partially filled row, if it exists
-    if full_rows < rows and last_row_cols > 0:
-        pixels[full_rows, :last_row_cols, :N_PLANES] = utility.clear_least_significant_bits(
-            pixels[full_rows, :last_row_cols, :N_PLANES], N_PLANES
-        )
-    # Add array to each channel to encode bits
+    # Clear the least significant bits, then encode bits in each channel
+    used &= np.uint8(0xFF - (modulus - 1))
     # Red
-    pixels[:, :, 0] += mask % modulus
-    mask >>= N_PLANES
+    used[:, 0] |= codes % modulus
     # Green
-    pixels[:, :, 1] += mask % modulus
-    mask >>= N_PLANES
+    used[:, 1] |= (codes >> N_PLANES) % modulus
     # Blue
-    pixels[:, :, 2] += mask
-    return Image.fromarray(pixels)
+    used[:, 2] |= codes >> (2 * N_PLANES)
 
 
-def encrypt_image_to_image(cover: Image.Image, secret: Image.Image) -> Image.Image:
+def hide_band(band: np.ndarray, secret_band: np.ndarray) -> None:
+    """
+    Encrypts a band of a secret image in place in a band of a cover image.
+
+    The cover's least significant 4 bits are reset and the secret's most significant
+    4 bits are added in their place, over the top left region of the cover band the
+    secret band covers.
+
+    :param band: Writable (rows, width, planes) uint8 array of cover pixels.
+    :param secret_band: (rows, width, planes) uint8 array of secret pixels, no larger than `band`.
+    """
+    band &= np.uint8(0xFF ^ (2 ** BITS_4 - 1))
+    height, width = secret_band.shape[:2]
+    band[:height, :width] |= secret_band >> BITS_4
+
+
+@staged("embed_image")
+def encrypt_image_to_image(cover: Image.Image, secret: Image.Image, threads: int = 1) -> Image.Image:
     """
     Encrypts an image into a cover image.
 
     This function applies image steganography by resetting the cover image's least significant 4 bits,
-    taking the secret image's most significant 4 bits and adding both together using
+    taking the secret image's most significant 4 bits and combining both together using
     Numpy arrays.
-    The sum of arrays is converted back into a Pillow Image and returned.
+    Both images are read in bands of rows, and each combined band is pasted into a single
+    preallocated output image, so peak memory stays close to the size of the cover.
+    With several threads, bands are combined in parallel.
 
     :param cover: Image in which the secret image should be hidden.
     :param secret: Image to be hidden.
+    :param threads: Number of threads combining bands, see `helper.parallel`.
     :return: An Image object in which the secret image is encrypted.
     """
-    cover_asarray = np.asarray(cover)
-    secret_asarray = np.asarray(secret)
-    cover_msb = utility.shift_image_bits_asarray(cover_asarray, Direction.RIGHT, BITS_4)
-    cover_lsb_reset = utility.shift_image_bits_asarray(cover_msb, Direction.LEFT, BITS_4)
-    secret_msb = utility.shift_image_bits_asarray(secret_asarray, Direction.RIGHT, BITS_4)
-    stega_asarray = cover_lsb_reset.copy()
-    if secret_msb.size < cover_lsb_reset.size:
-        height, width, _ = secret_msb.shape
-        stega_asarray[:height, :width] += secret_msb
-    else:
-        stega_asarray += secret_msb
-    return Image.fromarray(stega_asarray)
+    stega = Image.new(cover.mode, cover.size)
+    # Loaded before bands are cropped from several threads
+    cover.load()
+    secret.load()
+    # Top left region shared by both images
+    width, height = min(cover.width, secret.width), min(cover.height, secret.height)
+
+    def combine(top: int, bottom: int):
+        band = np.array(cover.crop((STARTING_X, top, cover.width, bottom)), dtype=np.uint8)
+        secret_bottom = max(top, min(bottom, height))
+        hide_band(band, np.asarray(secret.crop((STARTING_X, top, width, secret_bottom))))
+        stega.paste(Image.fromarray(band), (STARTING_X, top))
+
+    run_bands(combine, band_ranges(cover.height, BAND_PIXELS // max(1, cover.width)), threads)
+    return stega
@@ -0,0 +1,118 @@
+import logging
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+
+from .constant import (
+    CHARACTER_DENSITY, FORMAT_VERSION, HEADER_MAGIC, MAX_DENSITY, Codec,
+    PayloadMode
+)
+from .packing import CODE_BITS, character_layout, payload_pixels
+
+logger = logging.getLogger(__name__)
+
+# The payload length is stored 7 bits per pixel, least significant first
+LENGTH_CODES = 5
+MAX_LENGTH = 2 ** (CODE_BITS * LENGTH_CODES) - 1
+MAGIC_CODES = HEADER_MAGIC.encode("ascii")
+# Magic and version, which give the layout of the rest of the header
+PREFIX_PIXELS = len(MAGIC_CODES) + 1
+
+
+def check_density(density: int) -> int:
+    """Validates a payload density, the bits per channel or `CHARACTER_DENSITY`"""
+    if not CHARACTER_DENSITY <= density <= MAX_DENSITY:
+        raise ValueError(f"Density must be between {CHARACTER_DENSITY} and {MAX_DENSITY}")
+    return density
+
+
+# Fields stored one per pixel after the prefix, by version, before the length
+FIELD_TYPES = {"mode": PayloadMode, "codec": Codec, "density": check_density}
+VERSION_FIELDS = {
+    1: ("mode",),
+    2: ("mode", "codec"),
+    3: ("mode", "codec", "density"),
+}
+
+
+def header_pixels(version: int = FORMAT_VERSION) -> int:
+    """Number of pixels of a header of the given version"""
+    return PREFIX_PIXELS + len(VERSION_FIELDS[version]) + LENGTH_CODES
+
+
+HEADER_PIXELS = header_pixels()
+
+
+@dataclass(frozen=True)
+class Header:
+    """Describes the payload hidden right after it, in the first pixels of an image"""
+
+    mode: PayloadMode
+    # Bytes of payload following the header, as embedded
+    length: int
+    codec: Codec = Codec.NONE
+    # Bits per channel of the payload, or one character code per pixel
+    density: int = CHARACTER_DENSITY
+    version: int = FORMAT_VERSION
+
+    @property
+    def pixels(self) -> int:
+        """Number of pixels of the header itself"""
+        return header_pixels(self.version)
+
+    @property
+    def payload_pixels(self) -> int:
+        """Number of pixels of the payload following the header"""
+        return payload_pixels(self.length, self.codec, self.density, self.mode)
+
+    @property
+    def characters(self) -> bool:
+        """Whether the payload is stored as one ASCII character per pixel"""
+        return character_layout(self.mode, self.codec, self.density)
+
+
+def header_codes(header: Header) -> np.ndarray:
+    """
+    Converts a header to the character codes encrypted in its pixels.
+
+    :param header: Header to encrypt.
+    :return: uint8 array of `header.pixels` codes.
+    """
+    if not 0 <= header.length <= MAX_LENGTH:
+        raise ValueError(f"Payload length must be between 0 and {MAX_LENGTH}")
+    fields = [getattr(header, name) for name in VERSION_FIELDS[header.version]]
+    fields = [field.value if isinstance(field, Enum) else field for field in fields]
+    length = [(header.length >> (CODE_BITS * i)) & (2 ** CODE_BITS - 1) for i in range(LENGTH_CODES)]
+    return np.frombuffer(MAGIC_CODES + bytes([header.version] + fields + length), dtype=np.uint8)
+
+
+def parse_header(codes: bytes | np.ndarray) -> Optional[Header]:
+    """
+    Reads a header from the character codes of an image's first pixels.
+
+    Headers of every version up to `FORMAT_VERSION` are read. Fields missing
+    from older versions take their default values.
+
+    :param codes: Codes of at least the header's pixels, see `pixels_to_codes`.
+    :return: The header, or `None` if the codes do not start with one, as in
+    images encrypted before headers existed.
+    """
+    codes = bytes(codes[:HEADER_PIXELS])
+    if len(codes) < PREFIX_PIXELS or not codes.startswith(MAGIC_CODES):
+        return None
+    version = codes[len(MAGIC_CODES)]
+    if version not in VERSION_FIELDS or len(codes) < header_pixels(version):
+        logger.warning(f"Unsupported payload format version {version}, reading it as legacy text")
+        return None
+    names = VERSION_FIELDS[version]
+    values = codes[PREFIX_PIXELS:PREFIX_PIXELS + len(names)]
+    try:
+        fields = {name: FIELD_TYPES[name](value) for name, value in zip(names, values)}
+    except ValueError:
+        logger.warning(f"Unsupported payload fields {dict(zip(names, values))}, reading it as legacy text")
+        return None
+    length_codes = codes[header_pixels(version) - LENGTH_CODES:header_pixels(version)]
+    length = sum(code << (CODE_BITS * i) for i, code in enumerate(length_codes))
+    return Header(length=length, version=version, **fields)
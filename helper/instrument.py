@@ -0,0 +1,225 @@
+import functools
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, replace
+from typing import Callable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StageRecord:
+    """Measurements of one stage of a request"""
+
+    # Names of the enclosing stages and of this stage, joined by "/"
+    path: str
+    wall_seconds: float
+    # CPU time of the whole process, including other threads
+    cpu_seconds: float
+    # Peak memory allocated through Python above the stage's start, if tracked
+    peak_bytes: Optional[int] = None
+
+    @property
+    def name(self) -> str:
+        """Name of the stage itself"""
+        return self.path.rsplit("/", 1)[-1]
+
+
+Sink = Callable[[StageRecord], None]
+
+
+@dataclass
+class _Frame:
+    """A stage being measured"""
+
+    path: str
+    start_wall: float
+    start_cpu: float
+    start_bytes: int = 0
+    # Highest allocation peak of the stage's finished sub-stages
+    peak: int = 0
+
+
+_sinks: list[Sink] = []
+# Sinks asking for peak allocations
+_memory_sinks: list[Sink] = []
+# Whether tracemalloc was started here, and should be stopped here
+_started_tracing = False
+_stack: ContextVar[tuple[_Frame, ...]] = ContextVar("stages", default=())
+
+
+def enabled() -> bool:
+    """Whether any sink receives stage records"""
+    return bool(_sinks)
+
+
+def tracking_memory() -> bool:
+    """Whether any sink asks for peak allocations"""
+    return bool(_memory_sinks)
+
+
+def add_sink(sink: Sink, track_memory: bool = False):
+    """
+    Sends the records of every finished stage to a callable.
+
+    Instrumentation is off, and costs next to nothing, while no sink is added.
+
+    :param sink: Called with each `StageRecord`.
+    :param track_memory: Also measure peak allocations with `tracemalloc`, which slows
+    allocation-heavy code down noticeably.
+    """
+    global _started_tracing
+    _sinks.append(sink)
+    if track_memory:
+        _memory_sinks.append(sink)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+
+
+def remove_sink(sink: Sink):
+    """Stops sending records to a sink, and tracking memory once no sink asks for it"""
+    global _started_tracing
+    if sink in _sinks:
+        _sinks.remove(sink)
+    if sink in _memory_sinks:
+        _memory_sinks.remove(sink)
+        if not _memory_sinks and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def emit(record: StageRecord):
+    """Sends a record to every sink, e.g. one measured in another process"""
+    for sink in list(_sinks):
+        sink(record)
+
+
+def forward(records: list[StageRecord]):
+    """
+    Sends records measured elsewhere, e.g. in a worker process, as sub-stages of the current stage.
+
+    :param records: Records to send, in order.
+    """
+    stack = _stack.get()
+    for record in records:
+        emit(replace(record, path=f"{stack[-1].path}/{record.path}") if stack else record)
+
+
+def log_sink(record: StageRecord):
+    """Sink writing each record to the `helper.instrument` logger"""
+    peak = "" if record.peak_bytes is None else f" peak={record.peak_bytes / 2 ** 20:.1f}MiB"
+    logger.info(f"{record.path}: wall={record.wall_seconds * 1e3:.1f}ms cpu={record.cpu_seconds * 1e3:.1f}ms{peak}")
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Measures a block of code as a named stage, if instrumentation is enabled.
+
+    Stages can be nested: the record of a nested stage has the names of the
+    enclosing stages in its path, e.g. "encrypt/load".
+
+    :param name: Name of the stage.
+    """
+    if not _sinks:
+        yield
+        return
+    stack = _stack.get()
+    path = f"{stack[-1].path}/{name}" if stack else name
+    frame = _Frame(path, time.perf_counter(), time.process_time())
+    tracking = bool(_memory_sinks) and tracemalloc.is_tracing()
+    if tracking:
+        frame.start_bytes, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, peak)
+        tracemalloc.reset_peak()
+    token = _stack.set(stack + (frame,))
+    try:
+        yield
+    finally:
+        _stack.reset(token)
+        wall, cpu = time.perf_counter() - frame.start_wall, time.process_time() - frame.start_cpu
+        peak_bytes = None
+        if tracking and tracemalloc.is_tracing():
+            peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+            peak_bytes = max(0, peak - frame.start_bytes)
+            # The enclosing stage's peak includes this one
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+        emit(StageRecord(path, wall, cpu, peak_bytes))
+
+
+def staged(name: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Decorator measuring every call of a function as a stage, see `stage`"""
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) -> T:
+            if not _sinks:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@dataclass(eq=False)
+class Recorder:
+    """Sink keeping records in memory"""
+
+    records: list[StageRecord] = field(default_factory=list)
+
+    def __call__(self, record: StageRecord):
+        """Keeps a record"""
+        self.records.append(record)
+
+    def totals(self) -> dict[str, float]:
+        """Total wall time per stage path, slowest first"""
+        totals: dict[str, float] = {}
+        for record in self.records:
+            totals[record.path] = totals.get(record.path, 0.0) + record.wall_seconds
+        return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+
+@contextmanager
+def recording(track_memory: bool = False) -> Iterator[Recorder]:
+    """
+    Records the stages run within a block.
+
+    :param track_memory: Also measure peak allocations, see `add_sink`.
+    :return: Recorder holding the records once the block ends.
+    """
+    recorder = Recorder()
+    add_sink(recorder, track_memory)
+    try:
+        yield recorder
+    finally:
+        remove_sink(recorder)
+
+
+@contextmanager
+def capture(track_memory: bool = False) -> Iterator[Recorder]:
+    """
+    Records the stages run within a block in place of the current sinks, outside any enclosing stage.
+
+    Worker processes use this to send their records back to their caller, even when
+    they inherited the caller's sinks and stages by forking.
+
+    :param track_memory: Also measure peak allocations, see `add_sink`.
+    :return: Recorder holding the records once the block ends.
+    """
+    sinks, memory_sinks = _sinks[:], _memory_sinks[:]
+    _sinks.clear()
+    _memory_sinks.clear()
+    token = _stack.set(())
+    try:
+        with recording(track_memory) as recorder:
+            yield recorder
+    finally:
+        _stack.reset(token)
+        _sinks[:] = sinks
+        _memory_sinks[:] = memory_sinks
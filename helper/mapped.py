@@ -0,0 +1,262 @@
+from typing import IO, Callable, Iterator, Optional
+
+import numpy as np
+
+from .compression import compressed_stream
+from .constant import (
+    BITS_4, CHARACTER_DENSITY, N_PLANES, TILE_PIXELS, Codec, OutputProfile,
+    PayloadMode
+)
+from .decrypt import (
+    TextStream, join_text, stream_bytes_from_bands, stream_text_from_bands,
+    write_payload
+)
+from .encrypt import (
+    PayloadEmbedder, embed_segments, hide_band, text_to_segments
+)
+from .header import HEADER_PIXELS, Header
+from .instrument import staged
+from .parallel import band_ranges
+from .probe import Probe, classify
+from .tiled import BandReader, PngBandWriter, raw_layout
+from .utility import FileSource, open_image
+
+NPY_SUFFIX = ".npy"
+# Pixels in the first band read by the decoders, a few pages of memory
+MAPPED_BAND_PIXELS = 1 << 12
+
+
+def map_pixels(path: str, writable: bool = False) -> Optional[np.ndarray]:
+    """
+    Maps the RGB values of an uncompressed image file into memory, without reading them.
+
+    This holds for .npy files of uint8 (height, width, 3 or 4) arrays, and for the
+    files `raw_layout` accepts: binary PPM, uncompressed BMP and TIFF files stored
+    in one block of rows. Only the pages of the file an operation touches are
+    read, and writing to the array writes to the file itself.
+
+    :param path: Path of the image file.
+    :param writable: Whether to map the file for writing.
+    :return: (height, width, 3) uint8 view of the file, top row first and channels in RGB order,
+    or `None` if the file must be decoded by Pillow.
+    """
+    mode = "r+" if writable else "r"
+    if path.lower().endswith(NPY_SUFFIX):
+        try:
+            array = np.load(path, mmap_mode=mode)
+        except ValueError:
+            return None
+        if array.dtype != np.uint8 or array.ndim != 3 or array.shape[2] < N_PLANES:
+            return None
+        return array[..., :N_PLANES]
+    # Pixels are never decoded here, so Pillow's limit against decompression bombs does not apply
+    with open_image(path) as image:
+        width, height = image.size
+        layout = raw_layout(image)
+    if layout is None:
+        return None
+    offset, stride, bytes_per_pixel, channels, orientation = layout
+    rows = np.memmap(path, dtype=np.uint8, mode=mode, offset=offset, shape=(height, stride))
+    # Slicing, splitting an axis and reversing keep views of the file, where indexing with a list would copy
+    pixels = rows[:, :width * bytes_per_pixel].reshape((height, width, bytes_per_pixel))[::orientation]
+    return pixels[..., 2::-1] if channels[0] == 2 else pixels[..., :N_PLANES]
+
+
+def flush_pixels(pixels: np.ndarray):
+    """Writes the changes made to a mapped image to its file"""
+    if isinstance(pixels, np.memmap):
+        pixels.flush()
+
+
+def embed_rows(pixels: np.ndarray, end: int, embed: Callable[[np.ndarray, int], None]):
+    """
+    Calls an embedder on each row of an image holding one of its first pixels, in place.
+
+    Rows of a mapped file are views of it, so only the pages of the rows reached are touched.
+
+    :param pixels: Writable (height, width, 3) uint8 array.
+    :param end: Pixel after the last pixel to reach.
+    :param embed: Function of a (width, 3) row and the index in the image of its first pixel.
+    """
+    width = pixels.shape[1]
+    for row in range(-(-end // width)):
+        embed(pixels[row], row * width)
+
+
+def read_span(pixels: np.ndarray, start: int, end: int) -> np.ndarray:
+    """
+    Copies a run of consecutive pixels of an image, reading no other part of the rows it spans.
+
+    :param pixels: (height, width, 3) uint8 array.
+    :param start: First pixel of the run, counted left to right then down.
+    :param end: Pixel after the last pixel of the run.
+    :return: (pixels, 3) uint8 array.
+    """
+    width = pixels.shape[1]
+    parts = [
+        pixels[row, max(start - row * width, 0):min(end - row * width, width)]
+        for row in range(start // width, -(-end // width))
+    ]
+    return np.concatenate(parts) if parts else np.empty((0, N_PLANES), dtype=np.uint8)
+
+
+def iter_mapped_bands(pixels: np.ndarray, band_pixels: int = MAPPED_BAND_PIXELS) -> Iterator[np.ndarray]:
+    """
+    Yields an image's pixels in bands, left to right then down, copying each band only when it is reached.
+
+    The first band holds `band_pixels` pixels and each later band as many as all the
+    previous ones, so stopping early reads about twice the pixels actually used.
+
+    :param pixels: (height, width, 3) uint8 array, e.g. from `map_pixels`.
+    :param band_pixels: Number of pixels in the first band.
+    :return: Iterator of (pixels, 3) uint8 arrays.
+    """
+    height, width = pixels.shape[:2]
+    start = 0
+    while start < width * height:
+        end = min(width * height, start + max(band_pixels, start))
+        yield read_span(pixels, start, end)
+        start = end
+
+
+@staged("embed_text")
+def encrypt_text_mapped(
+    text: str, pixels: np.ndarray, codec: Optional[Codec] = Codec.NONE, density: int = CHARACTER_DENSITY
+) -> bool:
+    """
+    Encrypts a text message in place in the first pixels of a mapped image.
+
+    The pixels become those `encrypt_text_to_image` gives the RGB cover, but only the
+    rows holding the header and message are touched, so a short message in a large
+    file costs a few pages of I/O.
+
+    :param text: Message to encrypt.
+    :param pixels: Writable (height, width, 3) uint8 array, see `map_pixels`.
+    :param codec: Compression of the message, see `encrypt_text_to_image`.
+    :param density: Bits per color plane holding the message, see `encrypt_text_to_image`.
+    :return: False if the message is too long for the image, True otherwise.
+    """
+    segments = text_to_segments(text, codec, density)
+    height, width = pixels.shape[:2]
+    if segments[-1].end > width * height:
+        return False
+    embed_rows(pixels, segments[-1].end, lambda row, offset: embed_segments(row, segments, offset))
+    flush_pixels(pixels)
+    return True
+
+
+@staged("embed_file")
+def encrypt_file_mapped(
+    source: IO[bytes], pixels: np.ndarray, codec: Optional[Codec] = Codec.NONE, density: int = CHARACTER_DENSITY
+) -> bool:
+    """
+    Encrypts arbitrary bytes, read in chunks from a binary file, in place in the first pixels of a mapped image.
+
+    The pixels become those `encrypt_file_to_image` gives the RGB cover, touching only the rows the payload covers.
+
+    :param source: Binary file object of the payload, read from its current position.
+    :param pixels: Writable (height, width, 3) uint8 array, see `map_pixels`.
+    :param codec: Compression of the payload, see `encrypt_file_to_image`.
+    :param density: Bits per color plane holding the payload, see `encrypt_file_to_image`.
+    :return: False if the payload is too long for the image, True otherwise.
+    """
+    height, width = pixels.shape[:2]
+    with compressed_stream(source, codec, density) as (codec, length, chunks):
+        try:
+            embedder = PayloadEmbedder(Header(PayloadMode.BINARY, length, codec, density), chunks)
+        except ValueError:
+            return False
+        if embedder.end > width * height:
+            return False
+        embed_rows(pixels, embedder.end, embedder.embed)
+    flush_pixels(pixels)
+    return True
+
+
+@staged("embed_image")
+def encrypt_image_mapped(pixels: np.ndarray, secret_fp: FileSource, band_pixels: int = TILE_PIXELS):
+    """
+    Encrypts an image file in place in a mapped image, one band of rows at a time.
+
+    Every pixel's 4 least significant bits are replaced, as `encrypt_image_to_image`
+    does, but the cover is never decoded or written anew. The secret image is not
+    resized: only its top left region fitting in the cover is hidden. Mapped files
+    have no room for its size, so it is decrypted with the rest of the cover.
+
+    :param pixels: Writable (height, width, 3) uint8 array, see `map_pixels`.
+    :param secret_fp: Path or binary file object of the image to hide.
+    :param band_pixels: Approximate number of pixels per band.
+    """
+    height, width = pixels.shape[:2]
+    with BandReader(secret_fp) as secret:
+        secret_width, secret_height = min(width, secret.size[0]), min(height, secret.size[1])
+        for top, bottom in band_ranges(height, band_pixels // max(1, width)):
+            secret_bottom = max(top, min(bottom, secret_height))
+            hide_band(pixels[top:bottom], secret.read(top, secret_bottom)[:, :secret_width])
+    flush_pixels(pixels)
+
+
+@staged("probe")
+def probe_mapped(pixels: np.ndarray) -> Probe:
+    """
+    Finds what a mapped image hides, reading only the pages of its header.
+
+    :param pixels: (height, width, 3) uint8 array, see `map_pixels`.
+    :return: The probe's findings, never a hidden image, whose size mapped files cannot hold.
+    """
+    height, width = pixels.shape[:2]
+    return classify((width, height), read_span(pixels, 0, min(HEADER_PIXELS, width * height)), None)
+
+
+def stream_text_mapped(pixels: np.ndarray) -> TextStream:
+    """
+    Decrypts text from a mapped image, reading only the pages of the pixels the message covers.
+
+    :param pixels: (height, width, 3) uint8 array, see `map_pixels`.
+    :return: Generator of decrypted text chunks, see `stream_text_from_bands`.
+    """
+    return stream_text_from_bands(iter_mapped_bands(pixels))
+
+
+@staged("extract_text")
+def decrypt_text_mapped(pixels: np.ndarray) -> tuple[str, bool]:
+    """
+    Decrypts text from a mapped image, see `stream_text_mapped`.
+
+    :param pixels: (height, width, 3) uint8 array, see `map_pixels`.
+    :return: Tuple of the decrypted message and whether the whole message was found.
+    """
+    return join_text(stream_text_mapped(pixels))
+
+
+@staged("extract_bytes")
+def decrypt_bytes_mapped(pixels: np.ndarray, sink: IO[bytes]) -> bool:
+    """
+    Decrypts the payload of a mapped image into a binary file object, reading only the pages it covers.
+
+    :param pixels: (height, width, 3) uint8 array, see `map_pixels`.
+    :param sink: Writable binary file object receiving the payload as it is decrypted.
+    :return: Whether the whole payload was found.
+    """
+    return write_payload(stream_bytes_from_bands(iter_mapped_bands(pixels)), sink)
+
+
+@staged("extract_image")
+def decrypt_image_mapped(
+    pixels: np.ndarray,
+    output_fp: str | IO[bytes],
+    band_pixels: int = TILE_PIXELS,
+    profile: OutputProfile = OutputProfile.PNG,
+):
+    """
+    Decrypts the secret image from a whole mapped image, one band of rows at a time.
+
+    :param pixels: (height, width, 3) uint8 array, see `map_pixels`.
+    :param output_fp: Path or binary file object of the PNG file to write.
+    :param band_pixels: Approximate number of pixels per band.
+    :param profile: PNG output profile, see `helper.output`.
+    """
+    height, width = pixels.shape[:2]
+    with PngBandWriter.for_profile(output_fp, (width, height), profile) as writer:
+        for top, bottom in band_ranges(height, band_pixels // max(1, width)):
+            writer.write(np.left_shift(pixels[top:bottom], BITS_4))
@@ -0,0 +1,91 @@
+import zlib
+from dataclasses import dataclass, field
+from typing import IO, Any, Optional
+
+from PIL import Image
+from PIL.Image import Exif
+
+from .constant import OutputProfile
+
+
+@dataclass(frozen=True)
+class Encoder:
+    """How Pillow writes the images of an output profile"""
+
+    format: str
+    extension: str
+    media_type: str
+    # Modes stored without losing any bit
+    modes: frozenset[str]
+    params: dict[str, Any] = field(default_factory=dict)
+    # Whether EXIF metadata, such as the size of a hidden image, can be written
+    holds_exif: bool = True
+
+
+ENCODERS = {
+    OutputProfile.PNG: Encoder("PNG", ".png", "image/png", frozenset({"RGB", "RGBA", "L", "LA"})),
+    OutputProfile.PNG_FAST: Encoder(
+        "PNG", ".png", "image/png", frozenset({"RGB", "RGBA", "L", "LA"}),
+        {"compress_level": 1, "compress_type": zlib.Z_RLE},
+    ),
+    OutputProfile.PNG_SMALL: Encoder(
+        "PNG", ".png", "image/png", frozenset({"RGB", "RGBA", "L", "LA"}), {"compress_level": 9, "optimize": True}
+    ),
+    # Without exact, the color of transparent pixels is not kept
+    OutputProfile.WEBP: Encoder(
+        "WEBP", ".webp", "image/webp", frozenset({"RGB", "RGBA"}), {"lossless": True, "exact": True}
+    ),
+    OutputProfile.TIFF: Encoder("TIFF", ".tiff", "image/tiff", frozenset({"RGB", "RGBA", "L"})),
+    OutputProfile.BMP: Encoder("BMP", ".bmp", "image/bmp", frozenset({"RGB", "RGBA", "L"}), holds_exif=False),
+    OutputProfile.PPM: Encoder("PPM", ".ppm", "image/x-portable-pixmap", frozenset({"RGB", "L"}), holds_exif=False),
+}
+
+
+def check_lossless(profile: OutputProfile, mode: str) -> None:
+    """
+    Checks that a profile keeps every bit of an image, hidden bits included.
+
+    :param profile: Output profile.
+    :param mode: Mode of the image to write.
+    :raises ValueError: If the profile would alter or drop some of the image's bits.
+    """
+    if mode not in ENCODERS[profile].modes:
+        raise ValueError(f"Output profile {profile.value} cannot store {mode} images without loss")
+
+
+def png_compression(profile: OutputProfile) -> tuple[int, int]:
+    """
+    Gets the zlib settings of a PNG profile, for writers encoding PNG files themselves.
+
+    :param profile: Output profile.
+    :raises ValueError: If the profile does not write PNG files.
+    :return: Tuple of the zlib compression level and strategy.
+    """
+    encoder = ENCODERS[profile]
+    if encoder.format != "PNG":
+        raise ValueError(f"Output profile {profile.value} does not write PNG files")
+    compress_level = encoder.params.get("compress_level", zlib.Z_DEFAULT_COMPRESSION)
+    return compress_level, encoder.params.get("compress_type", zlib.Z_DEFAULT_STRATEGY)
+
+
+def write_image(
+    image: Image.Image, fp: str | IO[bytes], profile: OutputProfile = OutputProfile.PNG, exif: Optional[Exif] = None
+):
+    """
+    Writes an image with an output profile.
+
+    :param image: Image to write.
+    :param fp: Path or writable binary file object.
+    :param profile: Output profile.
+    :param exif: Metadata to write along.
+    :raises ValueError: If the profile would alter some bits of the image, see `check_lossless`,
+    or cannot hold the metadata.
+    """
+    check_lossless(profile, image.mode)
+    encoder = ENCODERS[profile]
+    params = dict(encoder.params)
+    if exif is not None:
+        if not encoder.holds_exif:
+            raise ValueError(f"Output profile {profile.value} cannot hold EXIF metadata")
+        params["exif"] = exif
+    image.save(fp, format=encoder.format, **params)
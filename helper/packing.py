@@ -0,0 +1,228 @@
+from math import gcd
+from typing import Iterable
+
+import numpy as np
+
+from .constant import CHARACTER_DENSITY, N_PLANES, Codec, PayloadMode
+
+# Bits of a character code held by each pixel: 3 of red, 3 of green, 1 of blue
+CODE_BITS = 2 * N_PLANES + 1
+
+
+def bytes_to_values(data: bytes, bits: int) -> np.ndarray:
+    """
+    Splits bytes into values of a few bits each.
+
+    The bits of the data are read most significant first and cut into groups,
+    the last group being padded with zeros. Each value is assembled with one
+    shift per bit, as whole-array operations that release the GIL.
+
+    :param data: Bytes to split.
+    :param bits: Bits per value, from 1 to 8.
+    :return: uint8 array of `values_needed(len(data), bits)` values.
+    """
+    data_bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    count = values_needed(len(data), bits)
+    groups = np.zeros(count * bits, dtype=np.uint8)
+    groups[:data_bits.size] = data_bits
+    groups = groups.reshape((count, bits))
+    values = groups[:, 0].copy()
+    for column in range(1, bits):
+        values <<= np.uint8(1)
+        values |= groups[:, column]
+    return values
+
+
+def values_to_bytes(values: np.ndarray, bits: int) -> bytes:
+    """
+    Joins values of a few bits each back into bytes, inverting `bytes_to_values`.
+
+    :param values: uint8 array of values. Bits left over after the last whole byte are dropped.
+    :param bits: Bits per value, from 1 to 8.
+    :return: The joined bytes.
+    """
+    values = np.asarray(values, dtype=np.uint8).ravel()
+    groups = np.empty((values.size, bits), dtype=np.uint8)
+    for column in range(bits):
+        np.right_shift(values, bits - 1 - column, out=groups[:, column])
+    groups &= np.uint8(1)
+    data_bits = groups.ravel()
+    return np.packbits(data_bits[:data_bits.size - data_bits.size % 8]).tobytes()
+
+
+def values_between(data: bytes, bits: int, start: int, end: int) -> np.ndarray:
+    """
+    Splits only the part of some bytes holding a range of their values, see `bytes_to_values`.
+
+    :param data: Bytes to split.
+    :param bits: Bits per value, from 1 to 8.
+    :param start: Index of the first value.
+    :param end: Index after the last value.
+    :return: uint8 array of `end - start` values, padded with zeros past the end of the data.
+    """
+    if bits == 8:
+        values = np.frombuffer(data[start:end], dtype=np.uint8)
+    else:
+        # Values are split from whole groups of bytes
+        aligned = start - start % (8 // gcd(bits, 8))
+        values = bytes_to_values(data[aligned * bits // 8:-(-end * bits // 8)], bits)[start - aligned:end - aligned]
+    if values.size < end - start:
+        values = np.concatenate((values, np.zeros(end - start - values.size, dtype=np.uint8)))
+    return values
+
+
+def values_needed(nbytes: int, bits: int) -> int:
+    """Number of values of a few bits holding a number of bytes"""
+    return -(-nbytes * 8 // bits)
+
+
+class ValueJoiner:
+    """Joins values of a few bits arriving in chunks of any size back into bytes"""
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        # Number of values making up exactly a whole number of bytes
+        self.group = 8 // gcd(bits, 8)
+        # Values not yet making up whole bytes
+        self.pending = np.empty(0, dtype=np.uint8)
+
+    def join(self, values: np.ndarray) -> bytes:
+        """
+        Adds values and returns the bytes they complete.
+
+        :param values: uint8 array of the next values.
+        :return: Bytes completed so far, not returned before.
+        """
+        values = np.concatenate((self.pending, values))
+        whole = values.size - values.size % self.group
+        self.pending = values[whole:]
+        return values_to_bytes(values[:whole], self.bits)
+
+    def flush(self) -> bytes:
+        """Returns the bytes completed by the values left, once no more values arrive"""
+        values, self.pending = self.pending, self.pending[:0]
+        return values_to_bytes(values, self.bits)
+
+
+def value_bits(density: int) -> int:
+    """Bits of each value read from or written to the pixels at a density"""
+    return CODE_BITS if density == CHARACTER_DENSITY else density
+
+
+def character_layout(mode: PayloadMode, codec: Codec, density: int) -> bool:
+    """Whether a payload is stored as one ASCII character per pixel, as uncompressed text is by default"""
+    return mode is PayloadMode.TEXT and codec is Codec.NONE and density == CHARACTER_DENSITY
+
+
+def payload_pixels(
+    nbytes: int, codec: Codec = Codec.NONE, density: int = CHARACTER_DENSITY, mode: PayloadMode = PayloadMode.TEXT
+) -> int:
+    """
+    Number of pixels holding a payload after its header.
+
+    At the character density, uncompressed ASCII text takes one character per
+    pixel, and other data is packed 7 bits per pixel. At densities from 1 to 4,
+    the data is a continuous bitstream over that many low bits of red, green
+    and blue.
+
+    :param nbytes: Length of the payload as embedded.
+    :param codec: Codec of the payload.
+    :param density: Bits per channel, or `CHARACTER_DENSITY`.
+    :param mode: Kind of payload.
+    :return: Number of pixels.
+    """
+    if character_layout(mode, codec, density):
+        return nbytes
+    if density == CHARACTER_DENSITY:
+        return values_needed(nbytes, CODE_BITS)
+    return values_needed(nbytes, density * N_PLANES)
+
+
+def payload_capacity(
+    pixels: int, codec: Codec = Codec.NONE, density: int = CHARACTER_DENSITY, mode: PayloadMode = PayloadMode.TEXT
+) -> int:
+    """Longest payload, as embedded, fitting in a number of pixels, see `payload_pixels`"""
+    if character_layout(mode, codec, density):
+        return pixels
+    if density == CHARACTER_DENSITY:
+        return pixels * CODE_BITS // 8
+    return pixels * density * N_PLANES // 8
+
+
+class ValueSplitter:
+    """Splits bytes arriving in chunks of any size into values of a few bits, on demand"""
+
+    def __init__(self, chunks: Iterable[bytes], bits: int):
+        self.chunks = iter(chunks)
+        self.bits = bits
+        # Number of bytes making up exactly a whole number of values
+        self.group = bits // gcd(bits, 8)
+        # Bytes not yet split, and values not yet taken
+        self.pending_bytes = b""
+        self.values = np.empty(0, dtype=np.uint8)
+
+    def take(self, count: int) -> np.ndarray:
+        """
+        Takes the next values.
+
+        :param count: Number of values.
+        :return: uint8 array of `count` values, padded with zeros once the chunks run out.
+        """
+        parts, needed = [self.values[:count]], count - min(count, self.values.size)
+        self.values = self.values[count:]
+        while needed:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                # The last bits are padded to whole values, then with zeros
+                values = bytes_to_values(self.pending_bytes, self.bits)
+                self.pending_bytes = b""
+                parts.append(values[:needed])
+                parts.append(np.zeros(needed - min(needed, values.size), dtype=np.uint8))
+                self.values = values[needed:]
+                break
+            data = self.pending_bytes + chunk
+            whole = len(data) - len(data) % self.group
+            self.pending_bytes = data[whole:]
+            values = bytes_to_values(data[:whole], self.bits)
+            parts.append(values[:needed])
+            self.values = values[needed:]
+            needed -= min(needed, values.size)
+        return np.concatenate(parts)
+
+
+def dense_values(data: bytes, density: int) -> np.ndarray:
+    """
+    Splits a payload into the values of the channels of the pixels holding it.
+
+    :param data: Payload, as embedded.
+    :param density: Bits per channel, from 1 to 4.
+    :return: (pixels, 3) uint8 array of values.
+    """
+    values = bytes_to_values(data, density)
+    channels = np.zeros(payload_pixels(len(data), density=density) * N_PLANES, dtype=np.uint8)
+    channels[:values.size] = values
+    return channels.reshape((-1, N_PLANES))
+
+
+def embed_dense(pixels: np.ndarray, values: np.ndarray, density: int) -> None:
+    """
+    Replaces the low bits of the channels of the first pixels of an array, in place.
+
+    :param pixels: Writable (pixels, planes) uint8 array, with at least R, G, and B planes.
+    :param values: (pixels, 3) uint8 array of values, no more than there are pixels.
+    :param density: Bits per channel replaced, from 1 to 4.
+    """
+    used = pixels[:len(values), :N_PLANES]
+    used &= np.uint8(0xFF ^ (2 ** density - 1))
+    used |= values
+
+
+def extract_dense(pixels: np.ndarray, density: int) -> np.ndarray:
+    """
+    Reads the low bits of the channels of an array of pixels, inverting `embed_dense`.
+
+    :param pixels: (pixels, planes) uint8 array, with at least R, G, and B planes.
+    :param density: Bits per channel, from 1 to 4.
+    :return: uint8 array of values, red, green then blue of each pixel.
+    """
+    return (pixels[:, :N_PLANES] & np.uint8(2 ** density - 1)).ravel()
@@ -0,0 +1,85 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Iterator, Optional, TypeVar
+
+import numpy as np
+from PIL import Image
+
+from .constant import BAND_PIXELS, STARTING_X
+
+T = TypeVar("T")
+
+# Number of cores, and the most threads a single image is split over
+DEFAULT_THREADS = os.cpu_count() or 1
+
+
+def band_ranges(count: int, band: int = BAND_PIXELS) -> list[tuple[int, int]]:
+    """
+    Splits a run of pixels or rows into consecutive bands.
+
+    :param count: Number of pixels or rows.
+    :param band: Size of each band but the last.
+    :return: List of (start, end) pairs, covering `range(count)` in order.
+    """
+    band = max(1, band)
+    return [(start, min(start + band, count)) for start in range(0, count, band)]
+
+
+@lru_cache(maxsize=None)
+def thread_pool(threads: int) -> ThreadPoolExecutor:
+    """Thread pool shared by all images processed with the same number of threads, up to `DEFAULT_THREADS`"""
+    return ThreadPoolExecutor(threads, thread_name_prefix="bands")
+
+
+def map_bands(func: Callable[[int, int], T], ranges: list[tuple[int, int]], threads: int = 1) -> Iterator[T]:
+    """
+    Calls a function on each band of an image, on several threads.
+
+    The bands are meant to be processed with NumPy and Pillow operations, which
+    release the GIL, each writing to its own part of a shared output, so bands
+    run in parallel and scale with the number of cores.
+
+    :param func: Function of the start and end of a band.
+    :param ranges: Bands, as returned by `band_ranges`.
+    :param threads: Number of threads, at most `DEFAULT_THREADS`. With 1, or a single band,
+    bands are processed in the calling thread, one at a time as the results are consumed.
+    :return: Iterator of the results of each band, in order. Exceptions raised by
+    `func` are raised when its result is reached.
+    """
+    # Threads beyond the cores would not run at once, and each count keeps a pool of its own
+    threads = min(threads, DEFAULT_THREADS)
+    if threads <= 1 or len(ranges) <= 1:
+        return (func(start, end) for start, end in ranges)
+    return thread_pool(threads).map(lambda bounds: func(*bounds), ranges)
+
+
+def run_bands(func: Callable[[int, int], None], ranges: list[tuple[int, int]], threads: int = 1) -> None:
+    """Calls a function on each band of an image, on several threads, and waits for all of them, see `map_bands`"""
+    for _ in map_bands(func, ranges, threads):
+        pass
+
+
+def image_array(image: Image.Image, threads: int = 1, rows: Optional[int] = None) -> np.ndarray:
+    """
+    Copies the top rows of an image into a new writable array, a band of rows per thread.
+
+    :param image: Pillow image to copy.
+    :param threads: Number of threads copying bands.
+    :param rows: Number of rows to copy, all of them by default.
+    :return: uint8 array of (rows, width, planes), or (rows, width) for single-band images.
+    """
+    width, height = image.size
+    rows = height if rows is None else min(rows, height)
+    if threads <= 1:
+        return np.array(image.crop((STARTING_X, 0, width, rows)) if rows < height else image, dtype=np.uint8)
+    # Loaded before bands are cropped from several threads
+    image.load()
+    first = np.asarray(image.crop((STARTING_X, 0, width, min(1, rows))), dtype=np.uint8)
+    pixels = np.empty((rows,) + first.shape[1:], dtype=np.uint8)
+
+    def copy(top: int, bottom: int):
+        pixels[top:bottom] = np.asarray(image.crop((STARTING_X, top, width, bottom)))
+
+    run_bands(copy, band_ranges(rows, BAND_PIXELS // max(1, width)), threads)
+    return pixels
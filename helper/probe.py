@@ -0,0 +1,106 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from PIL.Image import Exif, Image
+
+from .constant import N_PLANES, STARTING_X, PayloadKind, PayloadMode
+from .header import HEADER_PIXELS, Header, parse_header
+from .instrument import staged
+from .utility import (
+    RGB_MODES, FileSource, open_image, open_top_rows, parse_exif,
+    pixels_to_codes
+)
+
+PAYLOAD_KINDS = {PayloadMode.TEXT: PayloadKind.TEXT, PayloadMode.BINARY: PayloadKind.FILE}
+
+
+@dataclass(frozen=True)
+class Probe:
+    """What an image hides, found from its metadata and first pixels only"""
+
+    kind: PayloadKind
+    # Size of the image itself
+    size: tuple[int, int]
+    # Header of a text message or file
+    header: Optional[Header] = None
+    # Size of a hidden image, limited to the image's own size
+    hidden_size: Optional[tuple[int, int]] = None
+
+    @property
+    def version(self) -> Optional[int]:
+        """Format version of the header, if any"""
+        return None if self.header is None else self.header.version
+
+    @property
+    def length(self) -> Optional[int]:
+        """Length in bytes of the text message or file as embedded, if any"""
+        return None if self.header is None else self.header.length
+
+    def summary(self) -> str:
+        """One line description of the findings"""
+        if self.header is not None:
+            return f"{self.kind.value}, {self.length} bytes, {self.header.codec.name.lower()}, format {self.version}"
+        if self.hidden_size is not None:
+            return f"{self.kind.value}, {self.hidden_size[0]}x{self.hidden_size[1]}"
+        return self.kind.value
+
+
+def classify(size: tuple[int, int], pixels: np.ndarray, exif: Optional[Exif]) -> Probe:
+    """
+    Classifies an image from its first pixels and its metadata.
+
+    A header in the first pixels marks a text message or a file. Failing that,
+    the size written in the metadata by `exif_embed_ipp` marks a hidden image.
+
+    :param size: Size of the image.
+    :param pixels: Array of at least the first `HEADER_PIXELS` pixels, whose last axis holds R, G, and B values.
+    :param exif: Metadata of the image, or `None` if it has none.
+    :return: The probe's findings.
+    """
+    header = parse_header(pixels_to_codes(pixels[..., :N_PLANES]).ravel()[:HEADER_PIXELS])
+    if header is not None:
+        return Probe(PAYLOAD_KINDS[header.mode], size, header)
+    if exif is not None and (hidden_size := parse_exif(exif)):
+        hidden_size = (min(hidden_size[0], size[0]), min(hidden_size[1], size[1]))
+        return Probe(PayloadKind.IMAGE, size, hidden_size=hidden_size)
+    return Probe(PayloadKind.UNKNOWN, size)
+
+
+def header_rows(size: tuple[int, int]) -> int:
+    """Number of rows holding the header of an image"""
+    width, height = size
+    return min(height, -(-HEADER_PIXELS // max(1, width)))
+
+
+@staged("probe")
+def probe_image(img: Image) -> Probe:
+    """
+    Finds what an image hides without decrypting it.
+
+    :param img: Pillow image with at least R, G, and B color planes.
+    :return: The probe's findings.
+    """
+    width, _ = img.size
+    pixels = np.asarray(img.crop((STARTING_X, 0, width, header_rows(img.size))))
+    return classify(img.size, pixels, img.getexif())
+
+
+@staged("probe")
+def probe_file(fp: FileSource) -> Probe:
+    """
+    Finds what an image file hides, decoding only its first rows when possible.
+
+    Only the metadata and the rows holding the header are read, which takes well
+    under a millisecond for PNG files, whatever their size.
+
+    :param fp: Path or binary file object of the image.
+    :return: The probe's findings.
+    """
+    with open_image(fp) as image:
+        size = image.size
+        # Metadata after the pixels of a PNG file would only be found by decoding them, and is never written there
+        exif = image.getexif() if "exif" in image.info or image.format != "PNG" else None
+    with open_top_rows(fp, header_rows(size)) as top:
+        pixels = np.asarray(top if top.mode in RGB_MODES else top.convert("RGB"))
+    return classify(size, pixels, exif)
@@ -0,0 +1,231 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+import PIL.Image
+
+from .batch import InvalidFileError, Job, Source, open_source
+from .constant import Operation
+from .utility import reads_top_rows
+
+# Memory held per pixel while a job runs: the decoded image, its array, the output image and the encoded file
+JOB_BYTES_PER_PIXEL = 16
+DEFAULT_MAX_QUEUED = 64
+# Duration assumed for jobs before any has finished
+DEFAULT_JOB_SECONDS = 1.0
+# Weight of the latest job in the average duration of jobs
+DURATION_SMOOTHING = 0.2
+
+
+def default_memory_budget() -> int:
+    """Half of the physical memory, or 2 GiB if it cannot be found"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (ValueError, OSError, AttributeError):
+        return 2 << 30
+
+
+def estimate_bytes(
+    operation: Operation, pixels: int, secret_pixels: int = 0, payload_bytes: int = 0, rows_only: bool = False
+) -> int:
+    """
+    Estimates the peak memory of a job from the sizes of its images.
+
+    :param operation: Operation of the job.
+    :param pixels: Pixels of the cover, or of the image to decrypt.
+    :param secret_pixels: Pixels of the image to hide, if any.
+    :param payload_bytes: Length of the text message or file to hide, if any.
+    :param rows_only: Whether the image's first rows decode on their own, see `reads_top_rows`.
+    :return: Estimated bytes, 0 for probes of images whose first rows decode on their own.
+    """
+    if operation is Operation.PROBE and rows_only:
+        return 0
+    return JOB_BYTES_PER_PIXEL * (pixels + secret_pixels) + payload_bytes
+
+
+def source_pixels(source: Optional[Source]) -> int:
+    """Number of pixels of an image file, read from its header only, or 0 if it is not an image"""
+    if source is None:
+        return 0
+    try:
+        with PIL.Image.open(open_source(source)) as image:
+            width, height = image.size
+    except InvalidFileError:
+        return 0
+    return width * height
+
+
+def source_reads_top_rows(source: Source) -> bool:
+    """Whether the first rows of an image file decode on their own, see `reads_top_rows`"""
+    try:
+        return reads_top_rows(open_source(source))
+    except InvalidFileError:
+        return False
+
+
+def job_bytes(job: Job) -> int:
+    """Estimates the peak memory of a batch job, see `estimate_bytes`"""
+    if job.operation is Operation.PROBE:
+        return estimate_bytes(job.operation, source_pixels(job.cover), rows_only=source_reads_top_rows(job.cover))
+    if job.operation is Operation.ENCRYPT_IMAGE:
+        return estimate_bytes(job.operation, source_pixels(job.cover), source_pixels(job.payload))
+    payload = job.text.encode() if job.text is not None else job.payload
+    return estimate_bytes(job.operation, source_pixels(job.cover), payload_bytes=len(payload or b""))
+
+
+class QueueFullError(Exception):
+    """Raised when a job is refused because too many jobs are already waiting"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"The server is busy! Please try again in {retry_after} s.")
+        # Seconds after which a slot has likely freed up
+        self.retry_after = retry_after
+
+
+@dataclass(eq=False)
+class Ticket:
+    """Slot and memory reserved for a job, from when it is admitted until it is released"""
+
+    client: str
+    cost: int
+    future: Optional[asyncio.Future] = None
+    started: float = field(default_factory=time.monotonic)
+    released: bool = False
+
+
+class JobScheduler:
+    """
+    Admits heavy jobs within CPU slots and a memory budget, queueing the rest fairly between clients.
+
+    A job starts once a slot is free and its estimated memory fits in what the
+    running jobs leave of the budget; a job larger than the whole budget runs
+    alone. Waiting jobs are started one client at a time in turn, so a client
+    sending a burst does not hold up the others, and each client's jobs start in
+    order. A job that does not fit yet holds up the jobs behind it rather than
+    being overtaken forever. Once `max_queued` jobs are waiting, more are refused
+    with an estimate of when to retry.
+    """
+
+    def __init__(
+        self, slots: Optional[int] = None, max_bytes: Optional[int] = None, max_queued: int = DEFAULT_MAX_QUEUED
+    ):
+        self.slots = max(1, slots or os.cpu_count() or 1)
+        self.max_bytes = default_memory_budget() if max_bytes is None else max_bytes
+        self.max_queued = max_queued
+        self.running = 0
+        self.reserved_bytes = 0
+        # Waiting tickets of each client, clients in the order they take turns
+        self.waiting: OrderedDict[str, deque[Ticket]] = OrderedDict()
+        self.queued = 0
+        self.job_seconds = DEFAULT_JOB_SECONDS
+
+    def fits(self, cost: int) -> bool:
+        """Whether a job could start now"""
+        if self.running >= self.slots:
+            return False
+        return self.running == 0 or self.reserved_bytes + cost <= self.max_bytes
+
+    def retry_after(self) -> int:
+        """Seconds until the jobs running and waiting now have likely started"""
+        return max(1, math.ceil(self.job_seconds * (self.running + self.queued) / self.slots))
+
+    async def acquire(self, client: str, cost: int) -> Ticket:
+        """
+        Waits until a job may start, and reserves its slot and memory.
+
+        :param client: Identifier of the client the job is for, e.g. a session or an address.
+        :param cost: Estimated peak memory of the job, see `estimate_bytes`.
+        :return: Ticket to release once the job is done.
+        :raises QueueFullError: If too many jobs are already waiting.
+        """
+        ticket = Ticket(client, cost)
+        if not self.queued and self.fits(cost):
+            self.start(ticket)
+            return ticket
+        if self.queued >= self.max_queued:
+            raise QueueFullError(self.retry_after())
+        ticket.future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(client, deque()).append(ticket)
+        self.queued += 1
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # Started just as the waiting was cancelled
+                self.release(ticket)
+            else:
+                self.forget(ticket)
+            raise
+        return ticket
+
+    def start(self, ticket: Ticket):
+        """Reserves a job's slot and memory"""
+        self.running += 1
+        self.reserved_bytes += ticket.cost
+        ticket.started = time.monotonic()
+
+    def forget(self, ticket: Ticket):
+        """Removes a waiting ticket from the queue"""
+        tickets = self.waiting.get(ticket.client)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            self.queued -= 1
+            if not tickets:
+                del self.waiting[ticket.client]
+        self.dispatch()
+
+    def release(self, ticket: Ticket):
+        """Frees a job's slot and memory once it is done, and starts the jobs that now fit"""
+        if ticket.released:
+            return
+        ticket.released = True
+        self.running -= 1
+        self.reserved_bytes -= ticket.cost
+        elapsed = time.monotonic() - ticket.started
+        self.job_seconds += DURATION_SMOOTHING * (elapsed - self.job_seconds)
+        self.dispatch()
+
+    def dispatch(self):
+        """Starts waiting jobs, taking clients in turn, while the next one fits"""
+        while self.waiting:
+            client, tickets = next(iter(self.waiting.items()))
+            if not tickets[0].future.cancelled() and not self.fits(tickets[0].cost):
+                return
+            ticket = tickets.popleft()
+            self.queued -= 1
+            # The client goes to the back of the line
+            if tickets:
+                self.waiting.move_to_end(client)
+            else:
+                del self.waiting[client]
+            if ticket.future.cancelled():
+                # Its waiting was cancelled, and it is being forgotten
+                continue
+            self.start(ticket)
+            ticket.future.set_result(None)
+
+    @asynccontextmanager
+    async def admit(self, client: str, cost: int) -> AsyncIterator[Ticket]:
+        """Holds a slot for a job while the block runs, see `acquire`"""
+        ticket = await self.acquire(client, cost)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def snapshot(self) -> dict:
+        """Current load, e.g. for monitoring"""
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "slots": self.slots,
+            "clients_waiting": len(self.waiting),
+            "reserved_bytes": self.reserved_bytes,
+            "max_bytes": self.max_bytes,
+            "retry_after": self.retry_after(),
+        }
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from typing import Optional
+
+# Total size of all sessions kept in memory
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+@dataclass
+class Session:
+    """Uploaded inputs and results of one client, kept in memory"""
+
+    cover: Optional[bytes] = None
+    secret: Optional[bytes] = None
+    # Contents of the uploaded message file, text or not
+    message_file: Optional[bytes] = None
+    output_image: Optional[bytes] = None
+    output_text: Optional[str] = None
+    output_file: Optional[bytes] = None
+    # Incremented whenever the outputs change
+    revision: int = 0
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the session's buffers"""
+        values = (getattr(self, f.name) for f in fields(self))
+        return sum(len(value) for value in values if isinstance(value, (bytes, str)))
+
+    def set_outputs(self, image: Optional[bytes] = None, text: Optional[str] = None, file: Optional[bytes] = None):
+        """Keeps the results of an encryption or decryption"""
+        self.output_image = image
+        self.output_text = text
+        self.output_file = file
+        self.revision += 1
+
+    def clear_outputs(self):
+        """Forgets the results of a previous encryption or decryption"""
+        self.set_outputs()
+
+
+class SessionStore:
+    """
+    Sessions keyed by client, evicted least recently used first.
+
+    Whenever the sessions hold more than `max_bytes` in total, the least
+    recently used ones are dropped. The session being accessed is never
+    dropped, even if it is larger than the budget on its own.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by all sessions"""
+        return sum(session.nbytes for session in self.sessions.values())
+
+    def get(self, key: str) -> Session:
+        """
+        Gets a client's session, creating it if needed, and marks it as recently used.
+
+        :param key: Client identifier.
+        :return: The client's session.
+        """
+        if key not in self.sessions:
+            self.sessions[key] = Session()
+        self.sessions.move_to_end(key)
+        return self.sessions[key]
+
+    def trim(self) -> list[str]:
+        """
+        Evicts least recently used sessions until the store fits its budget.
+
+        Call after adding data to a session.
+
+        :return: Keys of the evicted sessions.
+        """
+        evicted = []
+        total = self.nbytes
+        while total > self.max_bytes and len(self.sessions) > 1:
+            key, session = self.sessions.popitem(last=False)
+            total -= session.nbytes
+            evicted.append(key)
+        return evicted
+
+    def discard(self, key: str):
+        """Drops a client's session, if it exists"""
+        self.sessions.pop(key, None)
@@ -0,0 +1,494 @@
+import io
+import struct
+import zlib
+from typing import IO, Iterator, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image, TiffImagePlugin, TiffTags
+from PIL.Image import Exif
+
+from .compression import compressed_stream
+from .constant import (
+    BITS_4, CHARACTER_DENSITY, N_PLANES, STARTING_X, TILE_PIXELS, Codec,
+    OutputProfile, PayloadMode
+)
+from .decrypt import (
+    TextStream, hidden_size_from_exif, stream_bytes_from_bands,
+    stream_text_from_bands, write_payload
+)
+from .encrypt import (
+    PayloadEmbedder, embed_segments, hide_band, text_to_segments
+)
+from .header import Header
+from .output import png_compression
+from .utility import (
+    PNG_SIGNATURE, FileSource, PngRows, check_pixel_limit, exif_embed_ipp,
+    open_file, open_image, raw_tile
+)
+
+# Uncompressed pixel layouts that can be read straight from disk,
+# as bytes per pixel and the byte indices of red, green and blue
+RAW_LAYOUTS = {
+    "RGB": (3, [0, 1, 2]),
+    "BGR": (3, [2, 1, 0]),
+    "RGBA": (4, [0, 1, 2]),
+    "BGRA": (4, [2, 1, 0]),
+    "RGBX": (4, [0, 1, 2]),
+    "BGRX": (4, [2, 1, 0]),
+}
+# 8 bits per sample, truecolor, default compression, filter and interlace methods
+PNG_RGB_HEADER = (8, 2, 0, 0, 0)
+# TIFF tags not copied to the single strip files, because they hold offsets into the original file or its size
+TIFF_STRIP_TAGS = {
+    TiffImagePlugin.IMAGELENGTH,
+    TiffImagePlugin.STRIPOFFSETS,
+    TiffImagePlugin.ROWSPERSTRIP,
+    TiffImagePlugin.STRIPBYTECOUNTS,
+    TiffImagePlugin.EXIFIFD,
+    # GPS information and sub-images
+    34853,
+    330,
+}
+
+
+class RawLayout(NamedTuple):
+    """Where and how the pixels of an uncompressed image are stored in its file"""
+
+    offset: int
+    stride: int
+    bytes_per_pixel: int
+    channels: list[int]
+    # 1 for rows stored top-down, -1 for bottom-up
+    orientation: int
+
+
+def raw_layout(image: Image.Image) -> Optional[RawLayout]:
+    """
+    Finds the pixel layout of an opened image file, if its pixels can be read without decoding.
+
+    This holds for uncompressed PPM, BMP and TIFF files stored in one block of rows.
+
+    :param image: A Pillow Image object returned by `open_image`, not yet loaded.
+    :return: The layout, or `None` if the image must be decoded by Pillow.
+    """
+    if (tile := raw_tile(image)) is None:
+        return None
+    offset, (rawmode, stride, orientation) = tile
+    if rawmode not in RAW_LAYOUTS or orientation not in (1, -1):
+        return None
+    bytes_per_pixel, channels = RAW_LAYOUTS[rawmode]
+    return RawLayout(offset, stride or image.width * bytes_per_pixel, bytes_per_pixel, channels, orientation)
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    """A PNG chunk with its length and checksum"""
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)))
+
+
+class TiffStrips:
+    """
+    Decodes the rows of a TIFF file stored in strips, a strip at a time, whatever their compression.
+
+    Each strip is decoded by Pillow as a TIFF file of its own, made of the
+    original tags and that strip's data. Strips with more pixels than Pillow's
+    limit against decompression bombs are refused, as whole images are.
+    """
+
+    def __init__(self, fp: FileSource, image: Image.Image):
+        self.file, self.owns_file = open_file(fp)
+        self.tags = image.tag_v2
+        self.width, self.height = image.size
+        self.offsets = self.tags[TiffImagePlugin.STRIPOFFSETS]
+        self.counts = self.tags[TiffImagePlugin.STRIPBYTECOUNTS]
+        self.strip_rows = min(self.tags.get(TiffImagePlugin.ROWSPERSTRIP, self.height), self.height)
+        # Last strip decoded, as (index, pixels)
+        self.cached: tuple[int, Optional[np.ndarray]] = (-1, None)
+
+    @classmethod
+    def open(cls, image: Image.Image, fp: FileSource) -> Optional["TiffStrips"]:
+        """
+        Prepares to decode an opened image file in strips, if it is a TIFF file stored in strips of whole rows.
+
+        :param image: A Pillow Image object returned by `open_image`, not yet loaded.
+        :param fp: Path or binary file object the image was opened from.
+        :return: The decoder, or `None` if the image must be decoded whole.
+        """
+        if image.format != "TIFF" or getattr(image, "is_animated", False):
+            return None
+        tags = image.tag_v2
+        if TiffImagePlugin.STRIPOFFSETS not in tags or tags.get(TiffImagePlugin.PLANAR_CONFIGURATION, 1) != 1:
+            return None
+        return cls(fp, image)
+
+    def close(self):
+        """Closes the file if it was opened here"""
+        if self.owns_file:
+            self.file.close()
+
+    def strip(self, index: int) -> np.ndarray:
+        """
+        Decodes a strip.
+
+        :return: (rows, width, 3) uint8 array of RGB pixels.
+        """
+        if self.cached[0] == index:
+            return self.cached[1]
+        rows = min(self.strip_rows, self.height - index * self.strip_rows)
+        directory = TiffImagePlugin.ImageFileDirectory_v2(prefix=self.tags.prefix)
+        for tag, value in self.tags.items():
+            if tag not in TIFF_STRIP_TAGS:
+                directory[tag] = value
+                directory.tagtype[tag] = self.tags.tagtype[tag]
+        directory[TiffImagePlugin.IMAGELENGTH] = rows
+        directory[TiffImagePlugin.ROWSPERSTRIP] = rows
+        # Strip offsets are written relative to the end of the directory, where the strip goes
+        for tag, value in ((TiffImagePlugin.STRIPOFFSETS, 0), (TiffImagePlugin.STRIPBYTECOUNTS, self.counts[index])):
+            directory[tag] = (value,)
+            directory.tagtype[tag] = TiffTags.LONG
+        self.file.seek(self.offsets[index])
+        data = self.file.read(self.counts[index])
+        order = "<" if self.tags.prefix == b"II" else ">"
+        header = self.tags.prefix + struct.pack(order + "HL", 42, 8)
+        with Image.open(io.BytesIO(header + directory.tobytes(8) + data)) as strip:
+            strip.load()
+            pixels = np.asarray(strip if strip.mode == "RGB" else strip.convert("RGB"))
+        self.cached = (index, pixels)
+        return pixels
+
+    def read(self, top: int, bottom: int) -> np.ndarray:
+        """
+        Decodes a band of rows, from the strips it covers.
+
+        :param top: First row of the band.
+        :param bottom: Row after the last row of the band.
+        :return: (rows, width, 3) uint8 array of RGB pixels.
+        """
+        first, last = top // self.strip_rows, (bottom - 1) // self.strip_rows
+        strips = [self.strip(index) for index in range(first, last + 1)]
+        start = top - first * self.strip_rows
+        return np.concatenate(strips)[start:start + bottom - top]
+
+
+class BandReader:
+    """
+    Reads an image file as RGB in bands of rows.
+
+    Uncompressed files (see `raw_layout`) are read straight from disk one band
+    at a time, non-interlaced PNG files are inflated as far as each band needs
+    (see `PngRows`) and TIFF files are decoded a strip at a time (see `TiffStrips`),
+    so the image never has to fit in memory. Other formats are decoded once by
+    Pillow and split into bands. Pillow's limit against decompression bombs
+    does not apply to the formats read in bands.
+    """
+
+    def __init__(self, fp: FileSource):
+        self.fp = fp
+        self.image = open_image(fp)
+        self.size = self.image.size
+        self.layout = raw_layout(self.image)
+        # Decoder of the bands of formats decoded band by band
+        self.rows = None
+        if self.layout is None:
+            self.rows = PngRows.open(self.image, fp) or TiffStrips.open(self.image, fp)
+        # Metadata after the pixels of a PNG file would only be found by decoding them, and is never written there
+        streamed_png = isinstance(self.rows, PngRows) and "exif" not in self.image.info
+        self.exif = Image.Exif() if streamed_png else self.image.getexif()
+        if self.layout is None and self.rows is None:
+            # Decoded whole, so held to Pillow's limit as any image it opens
+            check_pixel_limit(self.size)
+            self.image.load()
+            if self.image.mode != "RGB":
+                self.image = self.image.convert("RGB")
+        else:
+            self.close()
+
+    def __enter__(self) -> "BandReader":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+        if self.rows is not None:
+            self.rows.close()
+
+    def close(self):
+        """Releases the decoded image, if any, leaving file objects given by the caller open"""
+        # Closing an image opened from a file object would close the file object too
+        if self.image is not None and isinstance(self.fp, str):
+            self.image.close()
+        self.image = None
+
+    def bands(self, band_pixels: int = TILE_PIXELS, height: Optional[int] = None) -> Iterator[tuple[int, int]]:
+        """
+        Splits the image into bands of whole rows.
+
+        :param band_pixels: Approximate number of pixels per band. A band always holds at least one row.
+        :param height: Number of rows to split, the whole image by default.
+        :return: Iterator of (top, bottom) row bounds.
+        """
+        width, image_height = self.size
+        height = image_height if height is None else height
+        band_rows = max(1, band_pixels // max(1, width))
+        for top in range(0, height, band_rows):
+            yield top, min(top + band_rows, height)
+
+    def read(self, top: int, bottom: int) -> np.ndarray:
+        """
+        Reads a band of rows.
+
+        :param top: First row of the band.
+        :param bottom: Row after the last row of the band.
+        :return: Writable (rows, width, 3) uint8 array of RGB pixels.
+        """
+        width, height = self.size
+        if bottom <= top:
+            return np.empty((0, width, N_PLANES), dtype=np.uint8)
+        if self.rows is not None:
+            return np.array(self.rows.read(top, bottom), dtype=np.uint8)
+        if self.layout is None:
+            return np.array(self.image.crop((STARTING_X, top, width, bottom)), dtype=np.uint8)
+        rows = bottom - top
+        offset, stride, bytes_per_pixel, channels, orientation = self.layout
+        first = top if orientation > 0 else height - bottom
+        if isinstance(self.fp, str):
+            data = np.fromfile(self.fp, dtype=np.uint8, count=rows * stride, offset=offset + first * stride)
+        else:
+            self.fp.seek(offset + first * stride)
+            data = np.frombuffer(self.fp.read(rows * stride), dtype=np.uint8)
+        band = data.reshape((rows, stride))[:, :width * bytes_per_pixel].reshape((rows, width, bytes_per_pixel))
+        if orientation < 0:
+            band = band[::-1]
+        # Indexing with a list copies the channels in RGB order
+        return band[..., channels]
+
+
+class PngBandWriter:
+    """
+    Writes an RGB PNG file band by band, without holding the whole image in memory.
+
+    Writing to a binary file object instead of a path sends each compressed band
+    on as soon as it is ready, e.g. to a network stream, and leaves the file object open.
+    """
+
+    def __init__(
+        self,
+        fp: str | IO[bytes],
+        size: tuple[int, int],
+        exif: Optional[Exif] = None,
+        compress_level: int = 6,
+        strategy: int = zlib.Z_DEFAULT_STRATEGY,
+    ):
+        self.file = open(fp, "wb") if isinstance(fp, str) else fp
+        # Files opened here are closed here
+        self.owns_file = isinstance(fp, str)
+        self.closed = False
+        self.size = size
+        self.compressor = zlib.compressobj(compress_level, strategy=strategy)
+        self.file.write(PNG_SIGNATURE)
+        self.write_chunk(b"IHDR", struct.pack(">II5B", *size, *PNG_RGB_HEADER))
+        if exif is not None and len(exif):
+            data = exif.tobytes(8)
+            if data.startswith(b"Exif\x00\x00"):
+                data = data[6:]
+            self.write_chunk(b"eXIf", data)
+
+    def __enter__(self) -> "PngBandWriter":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @classmethod
+    def for_profile(
+        cls, fp: str | IO[bytes], size: tuple[int, int], profile: OutputProfile, exif: Optional[Exif] = None
+    ) -> "PngBandWriter":
+        """
+        Creates a writer compressing as a PNG output profile does.
+
+        :raises ValueError: If the profile does not write PNG files.
+        """
+        compress_level, strategy = png_compression(profile)
+        return cls(fp, size, exif, compress_level, strategy)
+
+    def write_chunk(self, kind: bytes, data: bytes):
+        """Writes a PNG chunk with its length and checksum"""
+        self.file.write(png_chunk(kind, data))
+
+    def write(self, band: np.ndarray):
+        """
+        Appends a band of rows to the image.
+
+        :param band: (rows, width, 3) uint8 array of RGB pixels.
+        """
+        rows, width = band.shape[:2]
+        # Each row starts with its filter type, 0 for none
+        scanlines = np.zeros((rows, 1 + width * N_PLANES), dtype=np.uint8)
+        scanlines[:, 1:] = band.reshape((rows, -1))
+        if data := self.compressor.compress(scanlines.tobytes()):
+            self.write_chunk(b"IDAT", data)
+
+    def close(self):
+        """Finishes the image, and closes the file if it was opened here"""
+        if self.closed:
+            return
+        self.closed = True
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+        if self.owns_file:
+            self.file.close()
+
+
+def encrypt_text_tiled(
+    text: str,
+    cover_fp: FileSource,
+    output_fp: str | IO[bytes],
+    band_pixels: int = TILE_PIXELS,
+    codec: Optional[Codec] = Codec.NONE,
+    density: int = CHARACTER_DENSITY,
+    profile: OutputProfile = OutputProfile.PNG,
+) -> bool:
+    """
+    Encrypts a text message in an image file, one band of rows at a time.
+
+    The output PNG has the same pixels as `encrypt_text_to_image` gives the RGB cover.
+
+    :param text: Message to encrypt.
+    :param cover_fp: Path or binary file object of the cover image.
+    :param output_fp: Path or binary file object of the PNG file to write.
+    :param band_pixels: Approximate number of pixels per band.
+    :param codec: Compression of the message, see `encrypt_text_to_image`.
+    :param density: Bits per color plane holding the message, see `encrypt_text_to_image`.
+    :param profile: PNG output profile, see `helper.output`.
+    :return: False if the message is too long for the cover, True otherwise.
+    """
+    segments = text_to_segments(text, codec, density)
+    with BandReader(cover_fp) as cover:
+        width, height = cover.size
+        if segments[-1].end > width * height:
+            return False
+        with PngBandWriter.for_profile(output_fp, cover.size, profile) as writer:
+            for top, bottom in cover.bands(band_pixels):
+                band = cover.read(top, bottom)
+                embed_segments(band.reshape((-1, N_PLANES)), segments, offset=top * width)
+                writer.write(band)
+    return True
+
+
+def encrypt_file_tiled(
+    source: IO[bytes],
+    cover_fp: FileSource,
+    output_fp: str | IO[bytes],
+    band_pixels: int = TILE_PIXELS,
+    codec: Optional[Codec] = Codec.NONE,
+    density: int = CHARACTER_DENSITY,
+    profile: OutputProfile = OutputProfile.PNG,
+) -> bool:
+    """
+    Encrypts arbitrary bytes, read in chunks from a binary file, in an image file, one band of rows at a time.
+
+    The output PNG has the same pixels as `encrypt_file_to_image` gives the RGB cover.
+
+    :param source: Binary file object of the payload, read from its current position.
+    :param cover_fp: Path or binary file object of the cover image.
+    :param output_fp: Path or binary file object of the PNG file to write.
+    :param band_pixels: Approximate number of pixels per band.
+    :param codec: Compression of the payload, see `encrypt_file_to_image`.
+    :param density: Bits per color plane holding the payload, see `encrypt_file_to_image`.
+    :param profile: PNG output profile, see `helper.output`.
+    :return: False if the payload is too long for the cover, True otherwise.
+    """
+    with BandReader(cover_fp) as cover, compressed_stream(source, codec, density) as (codec, length, chunks):
+        width, height = cover.size
+        try:
+            embedder = PayloadEmbedder(Header(PayloadMode.BINARY, length, codec, density), chunks)
+        except ValueError:
+            return False
+        if embedder.end > width * height:
+            return False
+        with PngBandWriter.for_profile(output_fp, cover.size, profile) as writer:
+            for top, bottom in cover.bands(band_pixels):
+                band = cover.read(top, bottom)
+                embedder.embed(band.reshape((-1, N_PLANES)), offset=top * width)
+                writer.write(band)
+    return True
+
+
+def encrypt_image_tiled(
+    cover_fp: FileSource,
+    secret_fp: FileSource,
+    output_fp: str | IO[bytes],
+    band_pixels: int = TILE_PIXELS,
+    profile: OutputProfile = OutputProfile.PNG,
+):
+    """
+    Encrypts an image file in a cover image file, one band of rows at a time.
+
+    The output PNG has the same pixels as `encrypt_image_to_image` gives the RGB
+    cover and secret. The secret image is not resized: only its top left region
+    fitting in the cover is hidden, and that region's size is embedded in the
+    output's metadata.
+
+    :param cover_fp: Path or binary file object of the cover image.
+    :param secret_fp: Path or binary file object of the image to hide.
+    :param output_fp: Path or binary file object of the PNG file to write.
+    :param band_pixels: Approximate number of pixels per band.
+    :param profile: PNG output profile, see `helper.output`.
+    """
+    with BandReader(cover_fp) as cover, BandReader(secret_fp) as secret:
+        width, height = (min(cover_side, secret_side) for cover_side, secret_side in zip(cover.size, secret.size))
+        exif = exif_embed_ipp(secret.exif, (width, height))
+        with PngBandWriter.for_profile(output_fp, cover.size, profile, exif) as writer:
+            for top, bottom in cover.bands(band_pixels):
+                band = cover.read(top, bottom)
+                secret_bottom = max(top, min(bottom, height))
+                hide_band(band, secret.read(top, secret_bottom)[:, :width])
+                writer.write(band)
+
+
+def decrypt_image_tiled(
+    image_fp: FileSource,
+    output_fp: str | IO[bytes],
+    band_pixels: int = TILE_PIXELS,
+    profile: OutputProfile = OutputProfile.PNG,
+):
+    """
+    Decrypts the secret image from an image file, one band of rows at a time.
+
+    The output PNG has the same pixels as `decrypt_image_from_image` gives the RGB image.
+
+    :param image_fp: Path or binary file object of the image containing the encrypted image.
+    :param output_fp: Path or binary file object of the PNG file to write.
+    :param band_pixels: Approximate number of pixels per band.
+    :param profile: PNG output profile, see `helper.output`.
+    """
+    with BandReader(image_fp) as image:
+        width, height = hidden_size_from_exif(image.exif, image.size)
+        with PngBandWriter.for_profile(output_fp, (width, height), profile) as writer:
+            for top, bottom in image.bands(band_pixels, height):
+                writer.write(np.left_shift(image.read(top, bottom)[:, :width], BITS_4))
+
+
+def stream_text_tiled(image_fp: FileSource, band_pixels: int = TILE_PIXELS) -> TextStream:
+    """
+    Decrypts text from an image file, one band of rows at a time.
+
+    :param image_fp: Path or binary file object of the image containing the message.
+    :param band_pixels: Approximate number of pixels per band.
+    :return: Generator of decrypted text chunks, see `stream_text_from_bands`.
+    """
+    with BandReader(image_fp) as image:
+        bands = (image.read(top, bottom).reshape((-1, N_PLANES)) for top, bottom in image.bands(band_pixels))
+        return (yield from stream_text_from_bands(bands))
+
+
+def decrypt_bytes_tiled(image_fp: FileSource, sink: IO[bytes], band_pixels: int = TILE_PIXELS) -> bool:
+    """
+    Decrypts the payload of an image file into a binary file object, one band of rows at a time.
+
+    :param image_fp: Path or binary file object of the image containing the payload.
+    :param sink: Writable binary file object receiving the payload as it is decrypted.
+    :param band_pixels: Approximate number of pixels per band.
+    :return: Whether the whole payload was found.
+    """
+    with BandReader(image_fp) as image:
+        bands = (image.read(top, bottom).reshape((-1, N_PLANES)) for top, bottom in image.bands(band_pixels))
+        return write_payload(stream_bytes_from_bands(bands), sink)
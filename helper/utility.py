@@ -1,22 +1,53 @@
+import io
+import math
 import re
+import struct
+import zlib
 from glob import glob
 from os.path import join
-from typing import Any, Optional, TypeVar
+from typing import IO, Any, Callable, Iterator, Optional, TypeVar
 
 import numpy as np
-from PIL import Image
+from PIL import (
+    BmpImagePlugin, Image, PngImagePlugin, PpmImagePlugin, TiffImagePlugin
+)
 from PIL.Image import Exif
 
 from helper.constant import N_PLANES
 
 from .constant import (
-    DESCRIPTION, EXIF_MAKE, SOFTWARE_TITLE, STARTING_X, STARTING_Y,
-    TEAM_MEMBERS, Direction, ExifData, ResizeMode, Sizing
+    BAND_PIXELS, DESCRIPTION, EXIF_MAKE, SOFTWARE_TITLE, STARTING_X,
+    STARTING_Y, TEAM_MEMBERS, TILE_PIXELS, Direction, ExifData, ResizeMode,
+    Sizing
 )
+from .instrument import staged
 
 T = TypeVar("T", int, np.signedinteger[Any])
+FileSource = str | IO[bytes]
+
+# Modes whose arrays hold R, G, and B values first
+RGB_MODES = ("RGB", "RGBA", "RGBX")
+
+# Integer pre-reduction keeps at least this many times the target size for the final filter
+RESIZE_REDUCING_GAP = 2.0
 
 EXIF_MODEL_PATTERN = re.compile(r"I(?P<width>\d*)P(?P<height>\d*)P")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Samples per pixel of the PNG color types: gray, truecolor, palette, gray and alpha, truecolor and alpha
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# Modes of PNG files with 8 bits per sample
+PNG_MODES = ("L", "LA", "P", "RGB", "RGBA")
+# Compressed bytes read from a file at a time
+READ_BYTES = 1 << 16
+# Formats whose pixels can be read a band at a time, by the signature starting their files, see `open_image`
+BAND_FORMATS = (
+    (PNG_SIGNATURE, PngImagePlugin.PngImageFile),
+    (b"II*\x00", TiffImagePlugin.TiffImageFile),
+    (b"MM\x00*", TiffImagePlugin.TiffImageFile),
+    (b"BM", BmpImagePlugin.BmpImageFile),
+    (b"P5", PpmImagePlugin.PpmImageFile),
+    (b"P6", PpmImagePlugin.PpmImageFile),
+)
 
 
 def pixels_to_binary(img: Image.Image) -> list[tuple[str, str, str]]:
@@ -45,6 +76,348 @@ def pixels_to_binary(img: Image.Image) -> list[tuple[str, str, str]]:
     return pixellist
 
 
+def iter_pixel_bands(
+    img: Image.Image, band_pixels: int = BAND_PIXELS
+) -> Iterator[np.ndarray]:
+    """
+    Yields an image's RGB pixels in bands of whole rows, top to bottom.
+
+    Only one band is converted to an array at a time, so a caller that stops
+    iterating early never touches the rest of the image.
+
+    :param img: A Pillow Image object with at least R, G, and B color planes.
+    :param band_pixels: Approximate number of pixels per band. A band always
+    holds at least one row.
+    :return: Iterator of (pixels, 3) uint8 arrays, left to right then down.
+    """
+    width, height = img.size
+    band_rows = max(1, band_pixels // max(1, width))
+    for top in range(0, height, band_rows):
+        band = img.crop((STARTING_X, top, width, min(top + band_rows, height)))
+        yield np.asarray(band)[..., :N_PLANES].reshape(-1, N_PLANES)
+
+
+def open_file(fp: FileSource) -> tuple[IO[bytes], bool]:
+    """Opens a path for reading, returning file objects as they are, and whether the file was opened here"""
+    return (open(fp, "rb"), True) if isinstance(fp, str) else (fp, False)
+
+
+def open_image(fp: FileSource) -> Image.Image:
+    """
+    Opens an image file without decoding it, as `Image.open` does.
+
+    PNG, TIFF, BMP and binary PPM files, whose pixels can be read a band at a
+    time, are opened whatever their size, and must be checked with
+    `check_pixel_limit` before being decoded whole. Other formats are held to
+    Pillow's limit against decompression bombs straight away.
+
+    :param fp: Path or binary file object of the image.
+    :return: A Pillow Image object, not yet loaded.
+    """
+    file, owns_file = open_file(fp)
+    try:
+        file.seek(0)
+        prefix = file.read(len(PNG_SIGNATURE))
+        file.seek(0)
+    finally:
+        if owns_file:
+            file.close()
+    for signature, factory in BAND_FORMATS:
+        if prefix.startswith(signature):
+            try:
+                return factory(fp)
+            except SyntaxError:
+                # Not a valid file of that format, which `Image.open` reports as for any other file
+                break
+    return Image.open(fp)
+
+
+def check_pixel_limit(size: tuple[int, int]):
+    """
+    Holds an image about to be decoded whole to Pillow's limit against decompression bombs.
+
+    :param size: Width and height of the image.
+    :raises Image.DecompressionBombError: If the image has more than twice `Image.MAX_IMAGE_PIXELS`
+    pixels, as `Image.open` would.
+    """
+    limit = Image.MAX_IMAGE_PIXELS
+    if limit is not None and size[0] * size[1] > 2 * limit:
+        raise Image.DecompressionBombError(
+            f"Image size ({size[0] * size[1]} pixels) exceeds limit of {2 * limit} pixels, "
+            "could be decompression bomb DOS attack."
+        )
+
+
+def raw_tile(image: Image.Image) -> Optional[tuple[int, tuple[str, int, int]]]:
+    """
+    Finds where an opened image file stores its pixels, if they are uncompressed in one block of rows.
+
+    :param image: A Pillow Image object returned by `open_image`, not yet loaded.
+    :return: Tuple of the offset of the pixels and of the raw decoder's arguments: the raw mode,
+    the stride, 0 if rows are not padded, and 1 for rows stored top-down or -1 for bottom-up.
+    `None` if the pixels must be decoded.
+    """
+    if len(image.tile) != 1 or getattr(image, "is_animated", False):
+        return None
+    codec, extents, offset, args = image.tile[0]
+    if codec != "raw" or tuple(extents) != (0, 0) + image.size:
+        return None
+    # The last arguments may be missing
+    args = (args,) if isinstance(args, str) else tuple(args)
+    if len(args) > 3:
+        return None
+    return offset, args + (0, 1)[len(args) - 1:]
+
+
+def raw_row_bytes(image: Image.Image) -> Optional[int]:
+    """
+    Finds the length of each row of an opened image file, if they are uncompressed and stored top-down.
+
+    :param image: A Pillow Image object returned by `open_image`, not yet loaded.
+    :return: Bytes per row, or `None` if the rows must be decoded or are stored bottom-up.
+    """
+    if (tile := raw_tile(image)) is None:
+        return None
+    rawmode, stride, orientation = tile[1]
+    if orientation != 1:
+        return None
+    try:
+        # A row packed as it is stored, unless padded to the stride
+        return stride or len(Image.new(image.mode, (image.width, 1)).tobytes("raw", rawmode))
+    except ValueError:
+        return None
+
+
+class PngRows:
+    """
+    Decodes the rows of a non-interlaced 8-bit PNG file in order, one band at a time.
+
+    The compressed data is inflated as far as each band needs. Pillow's PNG decoder
+    then unfilters each band's rows after the previous row, which the filters of the
+    first row refer to.
+    """
+
+    def __init__(self, fp: FileSource, image: Image.Image):
+        self.file, self.owns_file = open_file(fp)
+        self.mode, self.rawmode = image.mode, image.tile[0].args
+        self.width = image.size[0]
+        self.palette = None
+        self.file.seek(len(PNG_SIGNATURE))
+        while True:
+            length, kind = struct.unpack(">I4s", self.file.read(8))
+            if kind == b"IDAT":
+                break
+            data = self.file.read(length)
+            self.file.seek(4, io.SEEK_CUR)
+            if kind == b"IHDR":
+                color_type = data[9]
+            elif kind == b"PLTE":
+                self.palette = data
+        self.row_bytes = 1 + self.width * PNG_CHANNELS[color_type]
+        # Where the data starts, and how much of its first chunk is left
+        self.start = self.file.tell(), length
+        self.rewind()
+
+    @staticmethod
+    def accepts(image: Image.Image) -> bool:
+        """
+        Checks whether an opened image file is a PNG file this class can decode.
+
+        :param image: A Pillow Image object returned by `open_image`, not yet loaded.
+        """
+        if image.format != "PNG" or image.info.get("interlace") or getattr(image, "is_animated", False):
+            return False
+        # Samples of other bit depths are packed in other raw modes
+        return image.mode in PNG_MODES and image.tile[0].codec_name == "zip" and image.tile[0].args == image.mode
+
+    @classmethod
+    def open(cls, image: Image.Image, fp: FileSource) -> Optional["PngRows"]:
+        """
+        Prepares to decode an opened image file in bands, if it is a PNG file this class can decode.
+
+        :param image: A Pillow Image object returned by `open_image`, not yet loaded.
+        :param fp: Path or binary file object the image was opened from.
+        :return: The decoder, or `None` if the image must be decoded whole.
+        """
+        return cls(fp, image) if cls.accepts(image) else None
+
+    def close(self):
+        """Closes the file if it was opened here"""
+        if self.owns_file:
+            self.file.close()
+
+    def rewind(self):
+        """Goes back to the first row"""
+        self.position, self.chunk_left = self.start
+        self.inflater = zlib.decompressobj()
+        self.row = 0
+        # Unfiltered bytes of the row before the next one
+        self.previous = None
+
+    def compressed(self) -> bytes:
+        """Reads the next compressed bytes, across data chunks, or nothing at the end of the data"""
+        self.file.seek(self.position)
+        while not self.chunk_left:
+            # Checksum of the chunk, then the header of the next one
+            self.file.seek(4, io.SEEK_CUR)
+            length, kind = struct.unpack(">I4s", self.file.read(8))
+            if kind != b"IDAT":
+                return b""
+            self.chunk_left = length
+        data = self.file.read(min(READ_BYTES, self.chunk_left))
+        self.chunk_left -= len(data)
+        self.position = self.file.tell()
+        return data
+
+    def inflate(self, size: int) -> bytes:
+        """
+        Inflates the next bytes of filtered rows.
+
+        :raises OSError: If the data ends before `size` bytes.
+        """
+        parts = []
+        while size:
+            data = self.inflater.unconsumed_tail or self.compressed()
+            if not data:
+                raise OSError("Truncated PNG data")
+            parts.append(self.inflater.decompress(data, size))
+            size -= len(parts[-1])
+        return b"".join(parts)
+
+    def decode(self, bottom: int) -> np.ndarray:
+        """
+        Decodes the rows from the next one to `bottom`.
+
+        :return: (rows, width, 3) uint8 array of RGB pixels.
+        """
+        rows = bottom - self.row
+        data = self.inflate(rows * self.row_bytes)
+        if self.previous is not None:
+            # Unfiltered, with filter type 0
+            data = b"\x00" + self.previous + data
+        height = rows + (self.previous is not None)
+        # Decoded straight from the filtered rows, so Pillow's limit against decompression bombs does not apply
+        band = Image.frombytes(self.mode, (self.width, height), zlib.compress(data, 0), "zip", self.rawmode)
+        if self.palette is not None:
+            band.putpalette(self.palette)
+        self.previous = band.tobytes("raw", self.rawmode)[-(self.row_bytes - 1):]
+        self.row = bottom
+        return np.asarray(band if band.mode == "RGB" else band.convert("RGB"))[height - rows:]
+
+    def read(self, top: int, bottom: int, band_pixels: int = TILE_PIXELS) -> np.ndarray:
+        """
+        Decodes a band of rows, fastest when bands are read in order.
+
+        :param top: First row of the band.
+        :param bottom: Row after the last row of the band.
+        :param band_pixels: Approximate number of pixels per band decoded to reach `top`.
+        :return: (rows, width, 3) uint8 array of RGB pixels.
+        """
+        if top < self.row:
+            self.rewind()
+        while self.row < top:
+            self.decode(min(top, self.row + max(1, band_pixels // self.width)))
+        return self.decode(bottom)
+
+
+def supports_row_reads(image: Image.Image) -> bool:
+    """
+    Checks whether the top rows of an opened image file can be decoded on their own.
+
+    This holds for the PNG files `PngRows` decodes and for uncompressed,
+    top-down files (see `raw_row_bytes`), whose rows are stored in order
+    from the top.
+
+    :param image: A Pillow Image object returned by `open_image`, not yet loaded.
+    :return: True if `open_top_rows` can skip the rest of the image.
+    """
+    return PngRows.accepts(image) or raw_row_bytes(image) is not None
+
+
+def reads_top_rows(fp: FileSource) -> bool:
+    """Checks whether `open_top_rows` decodes only the top rows of an image file, see `supports_row_reads`"""
+    with open_image(fp) as image:
+        return supports_row_reads(image)
+
+
+def open_top_rows(fp: FileSource, rows: int) -> Image.Image:
+    """
+    Decodes the top rows of an image file.
+
+    Formats accepted by `supports_row_reads` stop decoding after `rows` rows,
+    whatever the size of the image. Any other format is fully decoded, within
+    Pillow's limit against decompression bombs, and then cropped.
+
+    :param fp: Path or binary file object of the image.
+    :param rows: Number of rows to decode.
+    :return: Loaded Image object of at most `rows` rows.
+    """
+    with open_image(fp) as image:
+        width, height = image.size
+        rows = min(rows, height)
+        if rows < height and PngRows.accepts(image):
+            return Image.fromarray(PngRows(image.fp, image).read(0, rows))
+        if rows < height and (row_bytes := raw_row_bytes(image)) is not None:
+            offset, args = raw_tile(image)
+            image.fp.seek(offset)
+            top = Image.frombytes(image.mode, (width, rows), image.fp.read(rows * row_bytes), "raw", args)
+            if top.mode == "P" and image.palette is not None:
+                top.putpalette(image.palette)
+            return top
+        check_pixel_limit(image.size)
+        image.load()
+    return image if rows == height else image.crop((STARTING_X, STARTING_Y, width, rows))
+
+
+def iter_file_bands(fp: FileSource, band_pixels: int = BAND_PIXELS) -> Iterator[np.ndarray]:
+    """
+    Yields an image file's RGB pixels in bands of whole rows, top to bottom.
+
+    Unlike `iter_pixel_bands`, the image does not need to be decoded up front.
+    For formats accepted by `supports_row_reads`, each band decodes only the
+    rows read so far, and the number of rows doubles from one band to the
+    next, so stopping early costs about twice the rows actually used.
+    Other formats are decoded once and split into bands.
+
+    :param fp: Path or binary file object of the image.
+    :param band_pixels: Approximate number of pixels in the first band.
+    :return: Iterator of (pixels, 3) uint8 arrays, left to right then down.
+    """
+    with open_image(fp) as image:
+        if not supports_row_reads(image):
+            check_pixel_limit(image.size)
+            image.load()
+            yield from iter_pixel_bands(image if image.mode in RGB_MODES else image.convert("RGB"), band_pixels)
+            return
+        width, height = image.size
+    rows_read = 0
+    band_rows = max(1, band_pixels // max(1, width))
+    while rows_read < height:
+        rows = min(height, rows_read + max(band_rows, rows_read))
+        with open_top_rows(fp, rows) as top:
+            band = np.asarray(top if top.mode in RGB_MODES else top.convert("RGB"))[rows_read:rows, :, :N_PLANES]
+        yield band.reshape(-1, N_PLANES)
+        rows_read = rows
+
+
+def pixels_to_codes(pixels: np.ndarray) -> np.ndarray:
+    """
+    Recovers the ASCII codes hidden in an array of RGB pixels.
+
+    Each code is rebuilt from the three least significant bits of red,
+    the three least significant bits of green and the least significant
+    bit of blue, from least to most significant.
+
+    :param pixels: Array whose last axis holds at least R, G, and B values.
+    :return: uint8 array of ASCII codes, one per pixel.
+    """
+    red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    codes = red & 0b111
+    codes |= (green & 0b111) << N_PLANES
+    codes |= (blue & 0b1) << (2 * N_PLANES)
+    return codes
+
+
 def clear_least_significant_bits(bits: T, n: int) -> T:
     """
     Replaces an integer's `n` least significant bits with zeroes.
@@ -74,6 +447,7 @@ def shift_image_bits_asarray(
             return np.right_shift(image_array, bit_amount)
 
 
+@staged("exif")
 def exif_embed_ipp(image_exif: Exif, data: tuple[int, int]) -> Exif:
     """
     Embeds In Plain Pixel metadata in an image's Exif data.
@@ -125,6 +499,7 @@ def parse_exif(image_exif: Exif) -> Optional[tuple[int, int]]:
     return (width, height)
 
 
+@staged("resize")
 def image_resize(
     image: Image.Image,
     max_dimension: tuple[int, int],
@@ -142,44 +517,107 @@ def image_resize(
     :param resize_mode: Resize mode
     :return: Resized Image object. Returns the same image if smaller than max dimensions
     """
-    current_image_width, current_image_height = image.size
+    size = resized_size(image.size, max_dimension, resize_mode)
+    if size == image.size:
+        return image
+    if resize_mode is ResizeMode.DEFAULT:
+        return image.crop((STARTING_X, STARTING_Y, *size))
+    # Pillow first reduces by an integer factor, then filters, as `Image.thumbnail` does
+    return image.resize(size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+
+
+@staged("resize")
+def load_resized(
+    fp: FileSource,
+    max_dimension: tuple[int, int],
+    resize_mode: ResizeMode = ResizeMode.DEFAULT,
+) -> Image.Image:
+    """
+    Loads an image file as RGB at the size `image_resize` would give it, decoding as little as possible.
+
+    JPEG files are decoded at a reduced scale when shrinking (see `Image.draft`),
+    and the files accepted by `supports_row_reads` only decode the rows kept when cropping.
+
+    :param fp: Path or binary file object of the image
+    :param max_dimension: Dimensions image cannot exceed
+    :param resize_mode: Resize mode
+    :return: Loaded and resized RGB Image object
+    """
+    if not isinstance(fp, str):
+        fp.seek(0)
+    with Image.open(fp) as image:
+        size = resized_size(image.size, max_dimension, resize_mode)
+        if resize_mode is ResizeMode.DEFAULT and size[1] < image.height and supports_row_reads(image):
+            image = open_top_rows(fp, size[1])
+        elif resize_mode is ResizeMode.SHRINK_TO_SCALE and size != image.size:
+            # Only JPEG files can be decoded smaller, and never below the requested size
+            image.draft("RGB", size)
+        image.load()
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+    if image.size == size:
+        return image
+    if resize_mode is ResizeMode.DEFAULT:
+        return image.crop((STARTING_X, STARTING_Y, *size))
+    return image.resize(size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+
+
+def resized_size(
+    size: tuple[int, int],
+    max_dimension: tuple[int, int],
+    resize_mode: ResizeMode = ResizeMode.DEFAULT,
+) -> tuple[int, int]:
+    """
+    Computes the size `image_resize` gives an image, without needing its pixels.
+
+    :param size: Width and height of the image
+    :param max_dimension: Dimensions image cannot exceed
+    :param resize_mode: Resize mode
+    :return: Width and height of the resized image
+    """
+    current_image_width, current_image_height = size
     max_width, max_height = max_dimension
-    image_copy = image.copy()
     sizing_mode = image_size_compare(
         current_image_width, current_image_height, max_width, max_height
     )
-    match resize_mode:
-        case ResizeMode.DEFAULT:
-            match sizing_mode:
-                case Sizing.SMALLER:
-                    pass
-                case Sizing.BIGGER:
-                    image_copy = image_copy.crop(
-                        (STARTING_X, STARTING_Y, max_width, max_height)
-                    )
-                case Sizing.TALLER:
-                    image_copy.crop(
-                        (STARTING_X, STARTING_Y, current_image_width, max_height)
-                    )
-                case Sizing.WIDER:
-                    image_copy.crop(
-                        (STARTING_X, STARTING_Y, max_width, current_image_height)
-                    )
-        case ResizeMode.SHRINK_TO_SCALE:
-            match sizing_mode:
-                case Sizing.SMALLER:
-                    pass
-                case Sizing.BIGGER:
-                    image_copy.thumbnail((max_width, max_height), Image.LANCZOS)
-                case Sizing.TALLER:
-                    height_ratio = current_image_height / max_height
-                    new_width = int(current_image_width // height_ratio)
-                    image_copy.thumbnail((new_width, max_height), Image.LANCZOS)
-                case Sizing.WIDER:
-                    width_ratio = current_image_width / max_width
-                    new_height = int(current_image_height // width_ratio)
-                    image_copy.thumbnail((max_width, new_height), Image.LANCZOS)
-    return image_copy
+    match resize_mode, sizing_mode:
+        case _, Sizing.SMALLER:
+            return size
+        case ResizeMode.DEFAULT, _:
+            return min(current_image_width, max_width), min(current_image_height, max_height)
+        case ResizeMode.SHRINK_TO_SCALE, Sizing.BIGGER:
+            box = (max_width, max_height)
+        case ResizeMode.SHRINK_TO_SCALE, Sizing.TALLER:
+            height_ratio = current_image_height / max_height
+            box = (int(current_image_width // height_ratio), max_height)
+        case ResizeMode.SHRINK_TO_SCALE, Sizing.WIDER:
+            width_ratio = current_image_width / max_width
+            box = (max_width, int(current_image_height // width_ratio))
+    return thumbnail_size(size, box)
+
+
+def thumbnail_size(size: tuple[int, int], box: tuple[int, int]) -> tuple[int, int]:
+    """
+    Computes the size `Image.thumbnail` gives an image, keeping its aspect ratio.
+
+    :param size: Width and height of the image
+    :param box: Dimensions the thumbnail must fit in
+    :return: Width and height of the thumbnail
+    """
+    width, height = size
+    x, y = map(math.floor, box)
+    if x >= width and y >= height:
+        return size
+
+    def round_aspect(number: float, key: Callable[[int], float]) -> int:
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
 
 
 def image_size_compare(
@@ -214,20 +652,11 @@ def strip_non_ascii(text: str) -> str:
     return text.encode().decode("ascii", "replace").replace("\ufffd", "")
 
 
-def to_bytes(text: str) -> list[int]:
-    """
-    Converts a string to a list of its characters' ASCII codes.
-
-    param text: String to convert.
-    :return: List of ASCII codes corresponding to the string's characters.
-    """
-    return list(bytearray(text, "ascii"))
-
-
 def list_images(dir: str) -> list[str]:
-    """Lists all .png or .jpeg images in a directory
+    """Lists all .png or .jpeg images in a directory, and images written by the lossless output profiles
 
     param dir: Directory to list.
     :return: List of paths to images in directory.
     """
-    return glob(join(dir, "*.png")) + glob(join(dir, "*.jp?g"))
+    patterns = ["*.png", "*.jp?g", "*.webp", "*.tif", "*.tiff", "*.bmp", "*.ppm"]
+    return [path for pattern in patterns for path in glob(join(dir, pattern))]
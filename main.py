@@ -1,48 +1,55 @@
+import asyncio
 import io
+import logging
 import os
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Callable, Optional, TypeVar
 
-from nicegui import app, events, ui
+from fastapi import Response
+from nicegui import Client, app, events, ui
 from PIL import Image, UnidentifiedImageError
 
-from helper.constant import ResizeMode
-from helper.decrypt import decrypt_image_from_image, decrypt_text_from_image
-from helper.encrypt import encrypt_image_to_image, encrypt_text_to_image
-from helper.utility import exif_embed_ipp, image_resize
+from helper import instrument
+from helper.api import Api
+from helper.batch import (
+    FILE_TOO_LONG, PAYLOAD_INCOMPLETE, TEXT_TOO_LONG, Job, JobResult, run_job
+)
+from helper.cache import (
+    DEFAULT_MAX_BYTES, DEFAULT_MAX_DISK_BYTES, ResultCache, job_key
+)
+from helper.capacity import plan_image, plan_text
+from helper.constant import MAX_UPLOAD_PIXELS, Operation, OutputProfile
+from helper.output import ENCODERS, check_lossless
+from helper.parallel import DEFAULT_THREADS
+from helper.scheduler import (
+    DEFAULT_MAX_QUEUED, JobScheduler, QueueFullError, job_bytes
+)
+from helper.session import Session, SessionStore
 
 InvalidFileError = (OSError, UnidentifiedImageError)
+T = TypeVar("T")
+# Extensions of uploaded images: JPEG photos and anything this application writes
+ACCEPTABLE_EXTENSIONS = {".jpg", ".jpeg", ".tif"} | {encoder.extension for encoder in ENCODERS.values()}
 
 
 @dataclass
-class Filepaths:
-    """Class that has file paths of user image, cover image, and output files"""
+class UserPage:
+    """Class that has the session and the upload elements of one client's page"""
 
-    user_text_fe = "txt"
-    user_image_fe = ""
-    cover_image_fe = ""
+    client_id: str
+    dropdown_text_or_image: ui.select | None = None
+    text_upload: ui.upload | None = None
+    cover_image_upload_text: ui.upload | None = None
+    cover_image_upload_image: ui.upload | None = None
+    secret_image_upload: ui.upload | None = None
+    decrypt_image_upload: ui.upload | None = None
 
-    def get_user_text_fp(self):
-        """Get file path for user upload text"""
-        return os.path.join("static", f"user_text.{self.user_text_fe}")
-
-    def get_user_image_fp(self):
-        """Get file path for user image"""
-        return os.path.join("static", f"user_image.{self.user_image_fe}")
-
-    def get_cover_image_fp(self):
-        """Get file path for cover image"""
-        return os.path.join("static", f"cover_image.{self.cover_image_fe}")
-
-    def get_encrypted_image_output_path(self):
-        """Get file path for encrypted output image"""
-        return os.path.join("static", f"output.{self.cover_image_fe}")
-
-    def get_decrypted_output_file_path(self, text=False):
-        """Get file path for decrypted output, either an image or text file"""
-        if text:
-            return os.path.join("static", "output.txt")
-        else:
-            return os.path.join("static", f"output.{self.cover_image_fe}")
+    @property
+    def session(self) -> Session:
+        """In-memory inputs and outputs of the client"""
+        return sessions.get(self.client_id)
 
 
 @dataclass
@@ -66,94 +73,152 @@ class TailwindStyling:
 
 
 # GUI callback functions
-def show_output():
+def show_output(page: UserPage):
     """Creates dialog with output"""
-    text_output_fp = file_paths.get_decrypted_output_file_path(text=True)
-    image_output_fp = file_paths.get_decrypted_output_file_path()
+    session = page.session
     # If there is output use that as the content of the markdown
-    if os.path.exists(image_output_fp):
+    if session.output_image is not None:
+        image_output_url = f"/output/{page.client_id}?v={session.revision}"
         with ui.dialog() as dialog, ui.card():
             ui.label("Image Output").tailwind(styles.prompt_text_v)
-            ui.markdown(f"![output]({image_output_fp})")
+            ui.markdown(f"![output]({image_output_url})")
             with ui.row():
-                ui.button("Download", on_click=lambda: ui.download(image_output_fp))
+                ui.button(
+                    "Download",
+                    on_click=lambda: ui.download(image_output_url, "output" + ENCODERS[output_profile].extension),
+                )
                 ui.button("Close", on_click=dialog.close)
         dialog.open()
-    elif os.path.exists(text_output_fp):
-        with open(text_output_fp, "r") as o:
-            text = o.read()
+    elif session.output_text is not None:
         with ui.dialog() as dialog, ui.card():
             ui.label("Text Output").tailwind(styles.prompt_text_v)
-            ui.markdown(f"{text}")
+            ui.markdown(f"{session.output_text}")
             with ui.row():
                 ui.button("Close", on_click=dialog.close)
         dialog.open()
+    elif session.output_file is not None:
+        file_output_url = f"/payload/{page.client_id}?v={session.revision}"
+        with ui.dialog() as dialog, ui.card():
+            ui.label("File Output").tailwind(styles.prompt_text_v)
+            ui.label(f"A file of {len(session.output_file)} bytes was found.")
+            with ui.row():
+                ui.button("Download", on_click=lambda: ui.download(file_output_url, "payload.bin"))
+                ui.button("Close", on_click=dialog.close)
+        dialog.open()
     else:
         ui.notify("Something went wrong, please try again.")
 
 
-def handle_text_file_upload(file: events.UploadEventArguments) -> str | None:
-    """Read a text file selected as an encryption message"""
-    # Try to parse file as text, aborting if this fails
+def handle_text_file_upload(page: UserPage, file: events.UploadEventArguments):
+    """Keep a file selected as an encryption message
+
+    ASCII text files are encrypted as text messages, any other file,
+    including UTF-8 text, is encrypted byte for byte.
+    """
     with file.content as f:
-        bytes = f.read()
-    try:
-        text = bytes.decode("utf-8")
-    except UnicodeDecodeError:
-        ui.notify("File could not be read correctly")
-        text_upload.reset()
-        return
-    # Write to storage file
-    with open(file_paths.get_user_text_fp(), "w") as f:
-        f.write(text)
+        page.session.message_file = f.read()
+    sessions.trim()
 
 
-def handle_image_upload(img: events.UploadEventArguments, cover=False):
+def handle_image_upload(page: UserPage, img: events.UploadEventArguments, cover=False):
     """Handle user image to encrypt.
 
-    This function will take the image that was uploaded by the user
-    and put it in the static file folder of the repository as
-    user_image.(file extension of original image)
-    or
-    cover_image.(file extension of original image)
+    This function will take the image that was uploaded by the user,
+    check its type and size from its header, without decoding its pixels,
+    and keep the file as it is in the client's session as the user image
+    or the cover image. It is decoded once, by the worker that encrypts or
+    decrypts it.
 
+    param page: Page of the client who uploaded the image
     param img: object that has uploaded file
     """
     # Get the binary of the tempfile object
     content = img.content.read()
-    # Create a pillow image object using the binary
+    # Get the extension and check that it is present and valid
+    file_extension = os.path.splitext(img.name)[1].lower()
+    if not file_extension or file_extension not in ACCEPTABLE_EXTENSIONS:
+        ui.notify("Not an acceptable file type!")
+        return
+    # Read the size only, refusing images too large to decode before any work is done
     try:
-        with Image.open(io.BytesIO(content)) as image:
-            image.load()
-            rgb_image = image.convert("RGB")
-    except UnidentifiedImageError:
-        ui.notify("Could not load image!")
+        with instrument.stage("upload_open"), Image.open(io.BytesIO(content)) as image:
+            width, height = image.size
+    except (UnidentifiedImageError, Image.DecompressionBombError):
+        width = height = None
+    if width is None or width * height > max_upload_pixels:
+        if width is None:
+            ui.notify("Could not load image!")
+        else:
+            ui.notify(f"Image is too large! The limit is {max_upload_pixels / 1e6:g} megapixels.")
         if cover:
-            if dropdown_text_or_image.value == "Text":
-                cover_image_upload_text.reset()
+            if page.dropdown_text_or_image.value == "Text":
+                page.cover_image_upload_text.reset()
             else:
-                cover_image_upload_image.reset()
+                page.cover_image_upload_image.reset()
         else:
-            secret_image_upload.reset()
-        return
-    # Get the extension and check that it is present and valid
-    acceptable_extensions = ["jpg", "png", "jpeg"]
-    file_extension = os.path.splitext(img.name)[1]
-    if not file_extension or file_extension[1:] not in acceptable_extensions:
-        ui.notify("Not an acceptable file type!")
+            page.secret_image_upload.reset()
         return
-    file_extension = file_extension[1:]
-    # Save the image locally if the file extension is valid
+    # Keep the image in the client's session
     if cover:
-        file_paths.cover_image_fe = "png"
-        fp = file_paths.get_cover_image_fp()
+        page.session.cover = content
     else:
-        file_paths.user_image_fe = "png"
-        fp = file_paths.get_user_image_fp()
-    rgb_image.save(fp, format="PNG")
+        page.session.secret = content
+    sessions.trim()
 
 
-def encrypt_event(
+async def run_cpu_bound(func: Callable[..., T], *args) -> T:
+    """Runs a function in the worker process pool without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(process_pool, func, *args)
+
+
+async def run_job_in_pool(job: Job, client_id: str) -> Optional[JobResult]:
+    """
+    Runs a job in the worker process pool, reporting its stages when instrumentation is on.
+
+    Results of jobs already run on the same inputs with the same options are returned from `results` instead.
+    Other jobs wait their turn in `scheduler`, and are refused with a notification when too many are waiting.
+
+    :param job: Job to run.
+    :param client_id: Client the job is for, taking turns with other clients.
+    :return: Result of the job, or `None` if it was refused.
+    """
+    job = replace(
+        job, threads=threads, instrument=instrument.enabled(), track_memory=instrument.tracking_memory()
+    )
+    with instrument.stage("cache_lookup"):
+        # Hashing large uploads releases the GIL, so it is left to a thread
+        key = await asyncio.to_thread(job_key, job)
+        if (result := results.get(job, key)) is not None:
+            return result
+    try:
+        with instrument.stage("queue"):
+            ticket = await scheduler.acquire(client_id, job_bytes(job))
+    except QueueFullError as error:
+        ui.notify(str(error))
+        return None
+    try:
+        with instrument.stage("worker"):
+            result = await run_cpu_bound(run_job, job)
+            instrument.forward(result.stages)
+    finally:
+        scheduler.release(ticket)
+    results.put(job, result, key)
+    return result
+
+
+@contextmanager
+def busy(button: ui.button, message: str):
+    """Shows a loading button and a notification while work runs in the background"""
+    ui.notify(message)
+    button.props("loading")
+    try:
+        yield
+    finally:
+        button.props(remove="loading")
+
+
+async def encrypt_event(
+    page: UserPage,
     e: events.ClickEventArguments,
     value: str,
     upload: str,
@@ -165,39 +230,34 @@ def encrypt_event(
     If it is an image it will first check if the user_image is smaller or equal
     in size to cover_image. If user_image is too large it will resize it to be the same
     size as the cover_image. Then, the appropriate function will be called to encrypt
-    either the text or image into the cover_image. The output image will be saved in static
-    folder as output_image.(cover image file extension)
+    either the text or image into the cover_image. The output image is kept in the
+    client's session.
+    The encryption itself runs in the worker process pool, so the GUI stays
+    responsive for every connected user.
 
+    param page: Page of the client who clicked.
     param e: GUI objects for click event.
     param value: String with type of message will be encrypted. Will be "Text" or "Image".
     param text_input: Message to be encrypted into image
     """
-    # File paths for all images
-    user_image_fp = file_paths.get_user_image_fp()
-    cover_image_fp = file_paths.get_cover_image_fp()
-    encrypt_output_image_fp = file_paths.get_encrypted_image_output_path()
-    text_output_fp = file_paths.get_decrypted_output_file_path(text=True)
-    image_output_fp = file_paths.get_decrypted_output_file_path()
-    # Open the cover image
-    try:
-        with Image.open(cover_image_fp) as cimg:
-            cimg.load()
-    except InvalidFileError:
-        ui.notify("Cover image file cannot be read!")
-        cover_image_upload_image.reset()
+    session = page.session
+    if session.cover is None:
+        ui.notify("Please upload a cover image!")
         return
-        # Check if user image is larger than cover image, resize if it is
     if value == "Image":
-        # Open user image
+        if session.secret is None:
+            ui.notify("Please upload an image to encrypt!")
+            return
+        # Check if user image is larger than cover image, resize if it is
         try:
-            with Image.open(user_image_fp) as uimg:
-                uimg.load()
+            capacity = plan_image(io.BytesIO(session.cover), io.BytesIO(session.secret))
         except InvalidFileError:
-            ui.notify("Encryption image file cannot be read!")
-            secret_image_upload.reset()
+            ui.notify("Image files cannot be read!")
+            page.cover_image_upload_image.reset()
+            page.secret_image_upload.reset()
             return
         # Check sizes
-        if uimg.size[0] > cimg.size[0] or uimg.size[1] > cimg.size[1]:
+        if capacity.hidden_size != capacity.secret_size:
             with ui.dialog() as dialog, ui.card():
                 ui.label(
                     "The image you want to encrypt is larger than the cover \
@@ -206,236 +266,323 @@ def encrypt_event(
                 with ui.row():
                     ui.button("Continue", on_click=dialog.close)
             dialog.open()
-        # Call function to encrypt user image into cover image
-        resized_uimg = image_resize(uimg, cimg.size, ResizeMode.SHRINK_TO_SCALE)
-        user_image_exif_data = resized_uimg.getexif()
-        new_exif_data = exif_embed_ipp(user_image_exif_data, resized_uimg.size)
-        output_image = encrypt_image_to_image(cimg, resized_uimg)
-        # Remove output file if it exists
-        if os.path.exists(image_output_fp):
-            os.remove(image_output_fp)
-        elif os.path.exists(text_output_fp):
-            os.remove(text_output_fp)
-        # Save the output image
-        output_image.save(encrypt_output_image_fp, exif=new_exif_data)
+        job = Job(Operation.ENCRYPT_IMAGE, session.cover, None, session.secret, profile=output_profile)
     elif value == "Text":
         # Check if there is text input, possibly from user-provided file
-        if upload == "Read Text from File":
-            try:
-                with open(file_paths.get_user_text_fp()) as f:
-                    text_input = f.read()
-            except FileNotFoundError:
-                ui.notify("Text input file not found!")
-                text_upload.reset()
-                return
-            except OSError:
-                ui.notify("Error reading text input!")
-                text_upload.reset()
+        if upload == "Read from File":
+            if session.message_file is None:
+                ui.notify("Input file not found!")
+                page.text_upload.reset()
                 return
-
-        # Call function to encrypt text into cover image
-        output_image = encrypt_text_to_image(text_input, cimg)
-        # Check return value in case text is too long
-        if output_image is None:
-            ui.notify("Text message is too long for image!")
-            text_upload.reset()
+            if not session.message_file.isascii():
+                return await encrypt_file_event(page, e)
+            text_input = session.message_file.decode("ascii")
+        # Check the text fits before paying for decoding the cover. Compressing it with every codec
+        # takes a while, and releases the GIL, so it is left to a thread.
+        try:
+            capacity = await asyncio.to_thread(plan_text, io.BytesIO(session.cover), text_input, None)
+        except InvalidFileError:
+            ui.notify("Cover image file cannot be read!")
+            page.cover_image_upload_text.reset()
             return
-        # Only remove input if encryption succeeded
-        text_fp = file_paths.get_user_text_fp()
-        if os.path.exists(text_fp):
-            os.remove(text_fp)
-            text_upload.reset()
-        # Remove output file if it exists
-        if os.path.exists(image_output_fp):
-            os.remove(image_output_fp)
-        elif os.path.exists(text_output_fp):
-            os.remove(text_output_fp)
-        # Save the output image
-        output_image.save(encrypt_output_image_fp)
-    show_output()
-
-
-def decrypt_event():
+        if not capacity.fits:
+            ui.notify(TEXT_TOO_LONG)
+            page.text_upload.reset()
+            return
+        # Compress the message with the codec found to need the fewest pixels, instead of trying them all again
+        job = Job(
+            Operation.ENCRYPT_TEXT, session.cover, None, text=text_input, codec=capacity.codec, profile=output_profile
+        )
+    # Forget previous output
+    session.clear_outputs()
+    # Call function to encrypt the message into cover image
+    with busy(e.sender, "Encrypting..."):
+        result = await run_job_in_pool(job, page.client_id)
+    if result is None:
+        return
+    # Check result in case files cannot be read or text is too long
+    if not result.ok:
+        if value == "Text":
+            ui.notify(TEXT_TOO_LONG if result.error == TEXT_TOO_LONG else "Files cannot be read!")
+            page.text_upload.reset()
+        else:
+            ui.notify("Image files cannot be read!")
+            page.secret_image_upload.reset()
+        return
+    page.session.set_outputs(image=result.data)
+    # Only remove text input if encryption succeeded
+    if value == "Text" and page.session.message_file is not None:
+        page.session.message_file = None
+        page.text_upload.reset()
+    sessions.trim()
+    show_output(page)
+
+
+async def encrypt_file_event(page: UserPage, e: events.ClickEventArguments):
+    """Encrypts the uploaded message file byte for byte into the cover image
+
+    param page: Page of the client who clicked.
+    param e: GUI objects for click event.
+    """
+    session = page.session
+    # Compress the file if that needs fewer pixels
+    job = Job(Operation.ENCRYPT_FILE, session.cover, None, session.message_file, codec=None, profile=output_profile)
+    session.clear_outputs()
+    with busy(e.sender, "Encrypting..."):
+        result = await run_job_in_pool(job, page.client_id)
+    if result is None:
+        return
+    if not result.ok:
+        ui.notify(FILE_TOO_LONG if result.error == FILE_TOO_LONG else "Files cannot be read!")
+        page.text_upload.reset()
+        return
+    session.set_outputs(image=result.data)
+    session.message_file = None
+    page.text_upload.reset()
+    sessions.trim()
+    show_output(page)
+
+
+async def decrypt_event(page: UserPage, e: events.ClickEventArguments):
     """Function that does procedures for decryption
 
-    Loads up the cover_image gotten from the user
-    and calls the decrypt functions. If the text function detects text
-    a text file with the decrypted message will be saved as a text file.
-    Otherwise, the decrypted image will be saved.
+    Takes the cover_image gotten from the user
+    and calls the decrypt functions in the worker process pool.
+    The worker probes the image's metadata and first pixels to pick the
+    decoder: a text message is kept as text, a file as a download, and a
+    hidden image as an image.
     """
-    # File path of cover image
-    cover_image_fp = file_paths.get_cover_image_fp()
-    text_output_fp = file_paths.get_decrypted_output_file_path(text=True)
-    image_output_fp = file_paths.get_decrypted_output_file_path()
-    # Open the cover image
-    try:
-        with Image.open(cover_image_fp) as cimg:
-            cimg.load()
-    except InvalidFileError:
-        ui.notify("Cover image file can't be read!")
+    session = page.session
+    if session.cover is None:
+        ui.notify("Please upload an image to decrypt!")
+        return
+    # Forget previous output
+    session.clear_outputs()
+    # Call the function to decrypt text, falling back to decrypting an image
+    with busy(e.sender, "Decrypting..."):
+        job = Job(Operation.DECRYPT, session.cover, None, profile=output_profile)
+        result = await run_job_in_pool(job, page.client_id)
+    if result is None:
+        return
+    if not result.ok:
+        ui.notify(PAYLOAD_INCOMPLETE if result.error == PAYLOAD_INCOMPLETE else "Cover image file can't be read!")
         return
-    # Call the function to decrypt text from image
-    decrypt_text, end_code_found = decrypt_text_from_image(cimg)
-    # Save output as text file
-    if end_code_found:
-        # Remove output file if it exists
-        if os.path.exists(image_output_fp):
-            os.remove(image_output_fp)
-        # Create new output file
-        with open(text_output_fp, "w") as f:
-            f.write(decrypt_text)
-        cover_image_upload_text.reset()
+    page.session.set_outputs(image=result.data, text=result.text, file=result.file)
+    sessions.trim()
+    if result.data is not None:
+        page.cover_image_upload_image.reset()
     else:
-        # Remove output file if it exists
-        if os.path.exists(text_output_fp):
-            os.remove(text_output_fp)
-        # Call the function to decrypt an image from an image
-        # Save output as an image
-        decrypt_image_from_image(cimg).save(image_output_fp)
-        cover_image_upload_image.reset()
+        page.cover_image_upload_text.reset()
     # Flush upload prompts
-    secret_image_upload.reset()
-    decrypt_image_upload.reset()
-    show_output()
+    page.secret_image_upload.reset()
+    page.decrypt_image_upload.reset()
+    show_output(page)
+
+
+@app.get("/output/{client_id}")
+def output_image(client_id: str) -> Response:
+    """Serves a client's output image from memory"""
+    if client_id not in sessions or sessions.get(client_id).output_image is None:
+        return Response(status_code=404)
+    return Response(sessions.get(client_id).output_image, media_type=ENCODERS[output_profile].media_type)
+
+
+@app.get("/payload/{client_id}")
+def output_file(client_id: str) -> Response:
+    """Serves a client's decrypted file from memory"""
+    if client_id not in sessions or sessions.get(client_id).output_file is None:
+        return Response(status_code=404)
+    return Response(sessions.get(client_id).output_file, media_type="application/octet-stream")
 
 
 # GUI Contents
 
-# Create Filepaths object to keep track of file paths
-file_paths = Filepaths()
 # Create TailwindStyling object for components styles
 styles = TailwindStyling()
-
-# Add static files folder
-app.add_static_files("/static", "static")
-# Add dark mode config
-dark_mode = ui.dark_mode()
-
-# Title of the project
-with ui.header(elevated=False) as h:
-    h.tailwind(styles.header_row)
-    ui.label("In Plain Pixel").tailwind(styles.title_text)
-    dark_mode_button = ui.checkbox("Dark Mode").bind_value_to(dark_mode, "value")
-    dark_mode_button.tailwind(styles.dark_mode_switch)
-
-# Prompt user to choose whether to encrypt or decrypt
-with ui.row():
-    ui.label("Select Encrpyt/Decrypt:").tailwind(styles.prompt_text_h)
-    dropdown_encrypt_or_decrypt = ui.select(["Encrypt", "Decrypt"], value="Encrypt")
-
-# Card with user input needed for encrypt with encrypt button
-with ui.card().bind_visibility_from(
-    dropdown_encrypt_or_decrypt, "value", value="Encrypt"
-) as ed:
-    ed.tailwind(styles.center_card)
-    # Prompt the user to select the message type
+# Keep each client's uploads and results in memory
+sessions = SessionStore()
+# Results of recent jobs, so repeated requests skip the work, e.g. RESULT_CACHE_BYTES=0 to turn it off,
+# and RESULT_CACHE_DIR=/tmp/ipp-cache to keep results evicted from memory on disk
+results = ResultCache(
+    int(os.environ.get("RESULT_CACHE_BYTES", DEFAULT_MAX_BYTES)),
+    os.environ.get("RESULT_CACHE_DIR"),
+    int(os.environ.get("RESULT_CACHE_DISK_BYTES", DEFAULT_MAX_DISK_BYTES)),
+)
+# Encoding of output images, e.g. OUTPUT_PROFILE=png-fast for quicker results or webp for smaller ones
+output_profile = OutputProfile(os.environ.get("OUTPUT_PROFILE", OutputProfile.PNG.value))
+check_lossless(output_profile, "RGB")
+# Images encrypted into images keep the size of the secret image in EXIF metadata
+if not ENCODERS[output_profile].holds_exif:
+    raise ValueError(f"Output profile {output_profile.value} cannot hold the size of hidden images")
+# Uploads with more pixels are refused, e.g. MAX_UPLOAD_PIXELS=200000000 for 200 MP
+max_upload_pixels = int(os.environ.get("MAX_UPLOAD_PIXELS", MAX_UPLOAD_PIXELS))
+# Worker processes for encryption and decryption, shut down with the app
+process_pool = ProcessPoolExecutor()
+# Jobs of the GUI and the API run one per core, within MAX_JOB_BYTES of estimated memory (half the RAM by default),
+# and once MAX_QUEUED_JOBS are waiting, more are refused
+scheduler = JobScheduler(
+    max_bytes=int(os.environ["MAX_JOB_BYTES"]) if "MAX_JOB_BYTES" in os.environ else None,
+    max_queued=int(os.environ.get("MAX_QUEUED_JOBS", DEFAULT_MAX_QUEUED)),
+)
+# Threads splitting each image in bands within a worker, one by default as the workers already run a job per core,
+# e.g. THREADS=4 for a few clients sending large images
+threads = int(os.environ.get("THREADS", 1))
+# Log the time of each stage with INSTRUMENT=1, and their memory too with INSTRUMENT=memory
+if os.environ.get("INSTRUMENT"):
+    logging.basicConfig(level=logging.INFO)
+    instrument.add_sink(instrument.log_sink, track_memory=os.environ["INSTRUMENT"] == "memory")
+app.on_shutdown(process_pool.shutdown)
+app.on_shutdown(results.close)
+# HTTP API under /api, streaming PNG outputs with the output profile when it is a PNG one,
+# e.g. API_WORKERS=16 for 16 requests processed at once
+api = Api(
+    output_profile if ENCODERS[output_profile].format == "PNG" else OutputProfile.PNG,
+    max_upload_pixels,
+    int(os.environ.get("API_WORKERS", DEFAULT_THREADS)),
+    scheduler,
+)
+app.include_router(api.router)
+app.on_shutdown(api.shutdown)
+
+
+@ui.page("/")
+def index(client: Client):
+    """Builds the page of one client, with its own session"""
+    page = UserPage(client.id)
+    client.on_disconnect(lambda: sessions.discard(client.id))
+
+    # Add dark mode config
+    dark_mode = ui.dark_mode()
+
+    # Title of the project
+    with ui.header(elevated=False) as h:
+        h.tailwind(styles.header_row)
+        ui.label("In Plain Pixel").tailwind(styles.title_text)
+        dark_mode_button = ui.checkbox("Dark Mode").bind_value_to(dark_mode, "value")
+        dark_mode_button.tailwind(styles.dark_mode_switch)
+
+    # Prompt user to choose whether to encrypt or decrypt
     with ui.row():
-        ui.label("Choose message type:").tailwind(styles.prompt_text_h)
-        dropdown_text_or_image = ui.select(["Text", "Image"], value="Text")
-    # User input needed if text message type is chosen
-    with ui.column().bind_visibility_from(
-        dropdown_text_or_image, "value", value="Text"
-    ):
-        # Prompt the user for the text they want to encrypt into cover image
+        ui.label("Select Encrpyt/Decrypt:").tailwind(styles.prompt_text_h)
+        dropdown_encrypt_or_decrypt = ui.select(["Encrypt", "Decrypt"], value="Encrypt")
+
+    # Card with user input needed for encrypt with encrypt button
+    with ui.card().bind_visibility_from(
+        dropdown_encrypt_or_decrypt, "value", value="Encrypt"
+    ) as ed:
+        ed.tailwind(styles.center_card)
+        # Prompt the user to select the message type
         with ui.row():
-            ui.label("Choose message source:").tailwind(styles.prompt_text_h)
-            enter_text_or_upload = ui.select(
-                ["Enter Text", "Read Text from File"], value="Enter Text"
-            )
+            ui.label("Choose message type:").tailwind(styles.prompt_text_h)
+            page.dropdown_text_or_image = ui.select(["Text", "Image"], value="Text")
+        # User input needed if text message type is chosen
         with ui.column().bind_visibility_from(
-            enter_text_or_upload, "value", value="Enter Text"
+            page.dropdown_text_or_image, "value", value="Text"
         ):
+            # Prompt the user for the text they want to encrypt into cover image
+            with ui.row():
+                ui.label("Choose message source:").tailwind(styles.prompt_text_h)
+                enter_text_or_upload = ui.select(
+                    ["Enter Text", "Read from File"], value="Enter Text"
+                )
+            with ui.column().bind_visibility_from(
+                enter_text_or_upload, "value", value="Enter Text"
+            ):
+                with ui.row():
+                    with ui.column():
+                        ui.label("Enter Text:").tailwind(styles.prompt_text_h)
+                    with ui.column():
+                        text_to_encrypt = ui.textarea(
+                            label="Message", placeholder="Hello World"
+                        )
+
+            with ui.column().bind_visibility_from(
+                enter_text_or_upload, "value", value="Read from File"
+            ):
+                with ui.row():
+                    with ui.column():
+                        ui.label("Select File:").tailwind(styles.prompt_text_v)
+                        page.text_upload = ui.upload(
+                            auto_upload=True,
+                            on_upload=lambda e: handle_text_file_upload(page, e),
+                            max_files=1,
+                        )
+            # Prompt the user for the image they want to encrypt a message into
             with ui.row():
                 with ui.column():
-                    ui.label("Enter Text:").tailwind(styles.prompt_text_h)
-                with ui.column():
-                    text_entry = text_to_encrypt = ui.textarea(
-                        label="Message", placeholder="Hello World"
+                    ui.label("Enter Cover Image:").tailwind(styles.prompt_text_v)
+                    page.cover_image_upload_text = ui.upload(
+                        auto_upload=True,
+                        on_upload=lambda e: handle_image_upload(page, e, cover=True),
+                        max_files=1,
                     )
-
+            with ui.row() as et:
+                et.tailwind(styles.button_row)
+                encrypt_text_button = ui.button(
+                    "Encrypt",
+                    on_click=lambda e: encrypt_event(
+                        page,
+                        e,
+                        page.dropdown_text_or_image.value,
+                        enter_text_or_upload.value,
+                        (
+                            text_to_encrypt
+                            if isinstance(text_to_encrypt, str)
+                            else text_to_encrypt.value
+                        ),
+                    ),
+                )
+                encrypt_text_button.tailwind(styles.button_center)
+        # User input needed if image message type is chosen
         with ui.column().bind_visibility_from(
-            enter_text_or_upload, "value", value="Read Text from File"
+            page.dropdown_text_or_image, "value", value="Image"
         ):
+            # Prompt the user for the image they want to encrypt into cover image
             with ui.row():
                 with ui.column():
-                    ui.label("Select Text File:").tailwind(styles.prompt_text_v)
-                    text_upload = ui.upload(
-                        auto_upload=True, on_upload=handle_text_file_upload, max_files=1
+                    ui.label("Enter Image to Encrypt:").tailwind(styles.prompt_text_v)
+                    page.secret_image_upload = ui.upload(
+                        auto_upload=True,
+                        on_upload=lambda e: handle_image_upload(page, e),
+                        max_files=1,
                     )
-        # Prompt the user for the image they want to encrypt a message into
-        with ui.row():
-            with ui.column():
-                ui.label("Enter Cover Image:").tailwind(styles.prompt_text_v)
-                cover_image_upload_text = ui.upload(
-                    auto_upload=True,
-                    on_upload=lambda e: handle_image_upload(e, cover=True),
-                    max_files=1,
-                )
-        with ui.row() as et:
-            et.tailwind(styles.button_row)
-            encrypt_text_button = ui.button(
-                "Encrypt",
-                on_click=lambda e: encrypt_event(
-                    e,
-                    dropdown_text_or_image.value,
-                    enter_text_or_upload.value,
-                    (
-                        text_to_encrypt
-                        if isinstance(text_to_encrypt, str)
-                        else text_to_encrypt.value
-                    ),
-                ),
-            )
-            encrypt_text_button.tailwind(styles.button_center)
-    # User input needed if image message type is chosen
-    with ui.column().bind_visibility_from(
-        dropdown_text_or_image, "value", value="Image"
-    ):
-        # Prompt the user for the image they want to encrypt into cover image
-        with ui.row():
-            with ui.column():
-                ui.label("Enter Image to Encrypt:").tailwind(styles.prompt_text_v)
-                secret_image_upload = ui.upload(
-                    auto_upload=True,
-                    on_upload=handle_image_upload,
-                    max_files=1,
-                )
-        # Prompt the user for the image they want to encrypt a message into
-        with ui.row():
-            with ui.column():
-                ui.label("Enter Cover Image:").tailwind(styles.prompt_text_v)
-                cover_image_upload_image = ui.upload(
-                    auto_upload=True,
-                    on_upload=lambda e: handle_image_upload(e, cover=True),
-                    max_files=1,
-                )
-        with ui.row() as ei:
-            ei.tailwind(styles.button_row)
-            encrypt_image_button = ui.button(
-                "Encrypt",
-                on_click=lambda e: encrypt_event(e, dropdown_text_or_image.value, None),
-            )
-            encrypt_image_button.tailwind(styles.button_center)
-
-# Card with user input needed for decrypt with decrypt button
-with ui.card().bind_visibility_from(
-    dropdown_encrypt_or_decrypt, "value", value="Decrypt"
-) as de:
-    de.tailwind(styles.center_card)
-    with ui.column():
-        # Prompt the user for the image they want to decrypt
-        with ui.row():
-            with ui.column():
-                ui.label("Enter Image to Decrypt:").tailwind(styles.prompt_text_v)
-                decrypt_image_upload = ui.upload(
-                    auto_upload=True,
-                    on_upload=lambda e: handle_image_upload(e, cover=True),
-                    max_files=1,
+            # Prompt the user for the image they want to encrypt a message into
+            with ui.row():
+                with ui.column():
+                    ui.label("Enter Cover Image:").tailwind(styles.prompt_text_v)
+                    page.cover_image_upload_image = ui.upload(
+                        auto_upload=True,
+                        on_upload=lambda e: handle_image_upload(page, e, cover=True),
+                        max_files=1,
+                    )
+            with ui.row() as ei:
+                ei.tailwind(styles.button_row)
+                encrypt_image_button = ui.button(
+                    "Encrypt",
+                    on_click=lambda e: encrypt_event(page, e, page.dropdown_text_or_image.value, None),
                 )
-        with ui.row() as di:
-            di.tailwind(styles.button_row)
-            decrypt_image_button = ui.button("Decrypt", on_click=decrypt_event)
-            decrypt_image_button.tailwind(styles.button_center)
+                encrypt_image_button.tailwind(styles.button_center)
+
+    # Card with user input needed for decrypt with decrypt button
+    with ui.card().bind_visibility_from(
+        dropdown_encrypt_or_decrypt, "value", value="Decrypt"
+    ) as de:
+        de.tailwind(styles.center_card)
+        with ui.column():
+            # Prompt the user for the image they want to decrypt
+            with ui.row():
+                with ui.column():
+                    ui.label("Enter Image to Decrypt:").tailwind(styles.prompt_text_v)
+                    page.decrypt_image_upload = ui.upload(
+                        auto_upload=True,
+                        on_upload=lambda e: handle_image_upload(page, e, cover=True),
+                        max_files=1,
+                    )
+            with ui.row() as di:
+                di.tailwind(styles.button_row)
+                decrypt_image_button = ui.button("Decrypt", on_click=lambda e: decrypt_event(page, e))
+                decrypt_image_button.tailwind(styles.button_center)
+
 
 # Initialize and run the GUI
 ui.run()
@@ -0,0 +1,89 @@
+import asyncio
+import io
+
+import numpy as np
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from helper import encrypt
+from helper.api import Api
+from helper.scheduler import JobScheduler
+
+
+def png_bytes(image: Image.Image) -> bytes:
+    """Encodes an image as PNG"""
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def client(**options) -> TestClient:
+    """Client of an app serving only the API"""
+    app = FastAPI()
+    app.include_router(Api(workers=2, **options).router)
+    return TestClient(app)
+
+
+def test_encode_decode_probe() -> None:
+    """Checks that text, files and images round trip through the endpoints"""
+    api = client()
+    rng = np.random.default_rng(0)
+    cover = Image.fromarray(rng.integers(0, 256, (120, 150, 3), dtype=np.uint8))
+    secret = Image.fromarray(rng.integers(0, 256, (60, 80, 3), dtype=np.uint8))
+    files = {"cover": ("cover.png", png_bytes(cover))}
+
+    response = api.post("/api/encode", files=files, data={"text": "Hello World", "codec": "none"})
+    assert response.status_code == 200 and response.headers["content-type"] == "image/png"
+    with Image.open(io.BytesIO(response.content)) as output:
+        assert np.array_equal(np.asarray(output), np.asarray(encrypt.encrypt_text_to_image("Hello World", cover)))
+    assert api.post("/api/decode", files={"image": ("o.png", response.content)}).json() == {
+        "kind": "text", "text": "Hello World"
+    }
+    probe = api.post("/api/probe", files={"image": ("o.png", response.content)}).json()
+    assert probe["kind"] == "text" and probe["size"] == [150, 120] and probe["length"] == 11
+
+    payload = bytes(range(256)) * 20
+    response = api.post("/api/encode", files={**files, "file": ("a.bin", payload)}, data={"density": "2"})
+    decoded = api.post("/api/decode", files={"image": ("o.png", response.content)})
+    assert decoded.headers["content-type"] == "application/octet-stream" and decoded.content == payload
+
+    response = api.post("/api/encode", files={**files, "secret": ("s.png", png_bytes(secret))})
+    decoded = api.post("/api/decode", files={"image": ("o.png", response.content)})
+    with Image.open(io.BytesIO(decoded.content)) as output:
+        assert np.array_equal(np.asarray(output), np.asarray(secret) & 0xF0)
+
+
+def test_errors() -> None:
+    """Checks that bad requests are refused with a JSON error before any work is done"""
+    api = client(max_pixels=100 * 100)
+    cover = {"cover": ("cover.png", png_bytes(Image.new("RGB", (40, 30))))}
+    assert api.post("/api/encode", files=cover).status_code == 400
+    assert api.post("/api/encode", files=cover, data={"text": "a", "profile": "webp"}).status_code == 400
+    assert api.post("/api/encode", files=cover, data={"text": "a", "codec": "gzip"}).status_code == 400
+    response = api.post("/api/encode", files=cover, data={"text": "a" * 5000, "codec": "none"})
+    assert response.status_code == 422 and "too long" in response.json()["error"]
+    assert api.post("/api/probe", files={"image": ("a.png", b"not an image")}).status_code == 400
+    large = png_bytes(Image.new("RGB", (200, 100)))
+    assert api.post("/api/decode", files={"image": ("a.png", large)}).status_code == 413
+
+
+def test_busy() -> None:
+    """Checks that requests are refused with a hint to retry while every slot is taken and the queue is full"""
+    scheduler = JobScheduler(1, max_queued=0)
+    api = client(scheduler=scheduler)
+    cover = {"cover": ("cover.png", png_bytes(Image.new("RGB", (40, 30))))}
+    # A job of another client holds the only slot
+    ticket = asyncio.run(scheduler.acquire("other", 0))
+    response = api.post("/api/encode", files=cover, data={"text": "a"})
+    assert response.status_code == 503 and int(response.headers["Retry-After"]) >= 1
+    assert api.get("/api/queue").json()["running"] == 1
+    # Probes decoding only the first rows skip the queue, others wait for a slot as decryption does
+    assert api.post("/api/probe", files={"image": ("a.png", cover["cover"][1])}).status_code == 200
+    jpeg = io.BytesIO()
+    Image.new("RGB", (40, 30)).save(jpeg, "JPEG")
+    assert api.post("/api/probe", files={"image": ("a.jpg", jpeg.getvalue())}).status_code == 503
+    scheduler.release(ticket)
+    assert api.post("/api/probe", files={"image": ("a.jpg", jpeg.getvalue())}).status_code == 200
+    assert api.post("/api/encode", files=cover, data={"text": "a"}).status_code == 200
+    assert api.get("/api/queue").json()["running"] == 0
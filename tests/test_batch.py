@@ -0,0 +1,60 @@
+import pytest
+from PIL import Image
+
+from helper import batch
+from helper.constant import Operation
+
+
+def test_encrypt_decrypt_directory(tmp_path) -> None:
+    """Checks that a directory of covers can be encrypted and decrypted in a batch"""
+    covers, outputs, decrypted = (tmp_path / name for name in ("covers", "outputs", "decrypted"))
+    for path in (covers, outputs, decrypted):
+        path.mkdir()
+    for i in range(3):
+        Image.new("RGB", (40 + i, 30), (i, 100, 200)).save(covers / f"cover{i}.png")
+    message = tmp_path / "message.txt"
+    message.write_text("Hello World")
+
+    jobs = batch.jobs_from_directory(Operation.ENCRYPT_TEXT, str(covers), str(outputs), str(message))
+    report = batch.run_batch(jobs, workers=2)
+    assert len(report.results) == 3 and not report.failed
+
+    report = batch.run_batch(batch.jobs_from_directory(Operation.DECRYPT, str(outputs), str(decrypted)))
+    assert not report.failed
+    for result in report.results:
+        with open(result.output) as f:
+            assert f.read() == "Hello World"
+
+
+def test_manifest(tmp_path) -> None:
+    """Checks that manifest rows are resolved relative to the manifest"""
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("a.png,b.png\n\nc.jpg, d.jpg, out/e.png\n")
+    jobs = batch.jobs_from_manifest(Operation.ENCRYPT_IMAGE, str(manifest), "outputs")
+    assert [(job.cover, job.payload, job.output) for job in jobs] == [
+        (str(tmp_path / "a.png"), str(tmp_path / "b.png"), "outputs/a.png"),
+        (str(tmp_path / "c.jpg"), str(tmp_path / "d.jpg"), str(tmp_path / "out/e.png")),
+    ]
+
+
+def test_missing_cover(tmp_path) -> None:
+    """Checks that an unreadable cover fails its job instead of the batch"""
+    job = batch.Job(Operation.DECRYPT, str(tmp_path / "missing.png"), str(tmp_path / "out.png"))
+    result = batch.run_job(job)
+    assert not result.ok and result.error
+
+
+def test_manifest_rows_checked(tmp_path) -> None:
+    """Checks that rows without a payload fail their job, and that outputs named after covers do not collide"""
+    cover = tmp_path / "a.png"
+    Image.new("RGB", (40, 30)).save(cover)
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("a.png\na.jpg,b.txt\nc.png,b.txt\n")
+    jobs = batch.jobs_from_manifest(Operation.ENCRYPT_TEXT, str(manifest), "outputs")
+    assert [job.output for job in jobs] == ["outputs/a.png.png", "outputs/a.jpg.png", "outputs/c.png"]
+    result = batch.run_job(jobs[0])
+    assert not result.ok and result.error == batch.NO_PAYLOAD
+
+    manifest.write_text("a.png\nother/a.png\n")
+    with pytest.raises(ValueError):
+        batch.jobs_from_manifest(Operation.DECRYPT, str(manifest), "outputs")
@@ -0,0 +1,97 @@
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from helper import batch, compression, decrypt, encrypt, probe, tiled
+from helper.constant import CHARACTER_DENSITY, MAX_DENSITY, Codec, Operation
+
+payloads = [os.urandom(3000), "Grüße, 世界\n".encode("utf-8") * 100, b""]
+
+
+def random_cover(width: int = 120, height: int = 100) -> Image.Image:
+    """Creates an RGB cover of random pixels"""
+    pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+
+def test_binary_round_trip() -> None:
+    """Checks that bytes are recovered as they are, with every codec and density"""
+    cover = random_cover()
+    for data in payloads:
+        for codec in [None, *Codec]:
+            for density in range(CHARACTER_DENSITY, MAX_DENSITY + 1):
+                encrypted = encrypt.encrypt_file_to_image(io.BytesIO(data), cover, codec, density)
+                assert encrypted
+                sink = io.BytesIO()
+                assert decrypt.decrypt_bytes_from_image(encrypted, sink)
+                assert sink.getvalue() == data
+                # A file is not a text message
+                assert decrypt.decrypt_text_from_image(encrypted) == ("", False)
+
+
+def test_binary_too_long() -> None:
+    """Checks that encryption fails if the file does not fit in the cover"""
+    assert encrypt.encrypt_file_to_image(io.BytesIO(os.urandom(20000)), random_cover(), Codec.NONE) is None
+
+
+def test_binary_files(tmp_path) -> None:
+    """Checks that bytes streamed from and to files match the in-memory encryption"""
+    cover, output = tmp_path / "cover.png", tmp_path / "output.png"
+    random_cover(200, 150).save(cover)
+    data = os.urandom(20000)
+    for density in (CHARACTER_DENSITY, 3):
+        assert tiled.encrypt_file_tiled(io.BytesIO(data), str(cover), str(output), 3000, None, density)
+        expected = encrypt.encrypt_file_to_image(io.BytesIO(data), random_cover(200, 150), None, density)
+        with Image.open(output) as image:
+            assert np.array_equal(np.asarray(image), np.asarray(expected))
+        for decrypt_bytes in (decrypt.decrypt_bytes_from_file, tiled.decrypt_bytes_tiled):
+            sink = io.BytesIO()
+            assert decrypt_bytes(str(output), sink)
+            assert sink.getvalue() == data
+
+
+def test_batch_file(tmp_path) -> None:
+    """Checks that a batch decryption writes a hidden file next to its output"""
+    cover, output = tmp_path / "cover.png", tmp_path / "output.png"
+    random_cover().save(cover)
+    data = payloads[1]
+    assert batch.run_job(batch.Job(Operation.ENCRYPT_FILE, str(cover), str(output), data, codec=None)).ok
+    result = batch.run_job(batch.Job(Operation.DECRYPT, str(output), str(tmp_path / "decrypted.png")))
+    assert result.ok and result.output.endswith(".bin")
+    with open(result.output, "rb") as f:
+        assert f.read() == data
+
+
+def test_decompression_limit(tmp_path, monkeypatch) -> None:
+    """Checks that payloads decompressing past the limit are left uncompressed, and refused when decrypted"""
+    monkeypatch.setattr(compression, "MIN_DECOMPRESSED_LIMIT", 0)
+    cover, output = tmp_path / "cover.png", tmp_path / "output.png"
+    random_cover().save(cover)
+    # Zeros shrink far more than 50 times
+    zeros = bytes(10_000)
+    for codec in (Codec.ZLIB, Codec.LZMA, Codec.BZ2):
+        monkeypatch.setattr(compression, "MAX_EXPANSION", 50)
+        for compressed in (encrypt.encrypt_text_to_image("a" * 5000, random_cover(), codec, MAX_DENSITY),
+                           encrypt.encrypt_file_to_image(io.BytesIO(zeros), random_cover(), codec, MAX_DENSITY)):
+            assert probe.probe_image(compressed).header.codec is Codec.NONE
+        sink = io.BytesIO()
+        assert decrypt.decrypt_bytes_from_image(compressed, sink) and sink.getvalue() == zeros
+        # Text compressing less is still compressed
+        compressed = encrypt.encrypt_file_to_image(io.BytesIO(payloads[1]), random_cover(), codec)
+        assert probe.probe_image(compressed).header.codec is codec
+
+        # Payloads embedded with a higher limit are refused, without inflating them further or writing any output
+        monkeypatch.setattr(compression, "MAX_EXPANSION", 1000)
+        job = batch.Job(Operation.ENCRYPT_FILE, str(cover), str(output), zeros, codec=codec, density=MAX_DENSITY)
+        assert batch.run_job(job).ok
+        monkeypatch.setattr(compression, "MAX_EXPANSION", 50)
+        with Image.open(output) as image:
+            header = probe.probe_image(image).header
+            sink = io.BytesIO()
+            assert not decrypt.decrypt_bytes_from_image(image, sink)
+        assert len(sink.getvalue()) <= compression.decompressed_limit(header.length)
+        result = batch.run_job(batch.Job(Operation.DECRYPT, str(output), str(tmp_path / "decrypted.png")))
+        assert result.error == batch.PAYLOAD_INCOMPLETE and not (tmp_path / "decrypted.bin").exists()
+        assert not (tmp_path / "decrypted.bin.tmp").exists()
@@ -0,0 +1,77 @@
+import io
+import os
+from dataclasses import replace
+
+from PIL import Image
+
+from helper.batch import Job, JobResult, run_job
+from helper.cache import ResultCache, job_key
+from helper.constant import Operation
+
+
+def png_bytes(color: tuple[int, int, int]) -> bytes:
+    """Encodes a small solid cover as PNG"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (40, 30), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_repeated_job_hits() -> None:
+    """Checks that a job on the same inputs and options is served from the cache, and others are not"""
+    cache = ResultCache()
+    job = Job(Operation.ENCRYPT_TEXT, png_bytes((1, 2, 3)), None, text="Hello World")
+    assert cache.get(job) is None
+    result = run_job(job)
+    cache.put(job, result)
+    again = cache.get(Job(Operation.ENCRYPT_TEXT, png_bytes((1, 2, 3)), None, text="Hello World"))
+    assert again is not None and again.data == result.data
+    assert cache.get(Job(Operation.ENCRYPT_TEXT, png_bytes((1, 2, 3)), None, text="Hello")) is None
+    assert cache.get(Job(Operation.ENCRYPT_TEXT, png_bytes((1, 2, 4)), None, text="Hello World")) is None
+    assert cache.get(Job(Operation.ENCRYPT_TEXT, job.cover, None, text="Hello World", density=2)) is None
+    assert (cache.hits, cache.misses) == (1, 4)
+    # Failed jobs are run again
+    long_job = Job(Operation.ENCRYPT_TEXT, job.cover, None, text="x" * 5000)
+    cache.put(long_job, run_job(long_job))
+    assert job_key(long_job) not in cache
+    # Results written to files are not kept, as the files may change
+    file_job = replace(job, output="output.png")
+    cache.put(file_job, replace(result, output="output.png"))
+    assert job_key(file_job) not in cache and cache.get(file_job) is None
+
+
+def test_eviction_and_spill(tmp_path) -> None:
+    """Checks that results over budget are moved to disk, read back on use, and deleted past the disk budget"""
+    cache = ResultCache(max_bytes=150, spill_dir=str(tmp_path), max_disk_bytes=10_000)
+    jobs = [Job(Operation.DECRYPT, bytes([i]), None) for i in range(3)]
+    for job in jobs:
+        cache.put(job, JobResult(job, True, data=bytes(100)))
+    assert len(cache) == 1 and cache.nbytes == 100
+    assert all(job_key(job) in cache for job in jobs)
+    # Reading a spilled result back spills the one in memory
+    assert cache.get(jobs[0]).data == bytes(100)
+    assert job_key(jobs[0]) in cache.results and job_key(jobs[2]) not in cache.results
+
+    # Spilled results go to a directory of their own
+    assert [path.name for path in tmp_path.iterdir()] == [os.path.basename(cache.spill_dir)]
+    cache.max_disk_bytes = 0
+    cache.put(jobs[1], cache.get(jobs[1]))
+    assert len(os.listdir(cache.spill_dir)) == 0
+    cache.clear()
+    assert cache.get(jobs[1]) is None
+    cache.close()
+    assert len(list(tmp_path.iterdir())) == 0
+
+
+def test_retained_bytes() -> None:
+    """Checks that the bytes the cache actually holds, inputs included, stay within its budget"""
+    cache = ResultCache(max_bytes=100_000)
+    for i in range(5):
+        job = Job(Operation.ENCRYPT_TEXT, png_bytes((i, 0, 0)) + bytes(50_000), None, text="Hello World")
+        result = run_job(Job(Operation.ENCRYPT_TEXT, png_bytes((i, 0, 0)), None, text="Hello World"))
+        cache.put(job, result)
+        assert cache.get(job).job is job
+    retained = 0
+    for result in cache.results.values():
+        assert result.job is None
+        retained += sum(len(value) for value in vars(result).values() if isinstance(value, (bytes, str)))
+    assert len(cache) > 1 and retained <= cache.max_bytes
@@ -0,0 +1,35 @@
+import io
+
+from PIL import Image
+
+from helper import encrypt
+from helper.capacity import plan_image, plan_text
+from helper.constant import ResizeMode
+from helper.utility import image_resize, load_resized
+
+
+def test_text_capacity() -> None:
+    """Checks that the planner agrees with the encrypter on which messages fit"""
+    cover = Image.new("RGB", (10, 5))
+    buffer = io.BytesIO()
+    cover.save(buffer, format="PNG")
+    for length in (0, 36, 37, 38):
+        message = "a" * length
+        capacity = plan_text(buffer, message)
+        assert capacity.bytes_available == 37
+        assert capacity.fits == (encrypt.encrypt_text_to_image(message, cover) is not None)
+
+
+def test_image_capacity() -> None:
+    """Checks that the planner predicts the size image_resize gives secret images"""
+    cover = (300, 200)
+    for secret in ((100, 100), (600, 100), (100, 900), (1234, 567), (300, 200)):
+        capacity = plan_image(cover, secret)
+        resized = image_resize(Image.new("RGB", secret), cover, ResizeMode.SHRINK_TO_SCALE)
+        assert capacity.resized_size == resized.size
+        for image_format in ("JPEG", "PNG"):
+            buffer = io.BytesIO()
+            Image.new("RGB", secret).save(buffer, format=image_format)
+            assert load_resized(buffer, cover, ResizeMode.SHRINK_TO_SCALE).size == resized.size
+        assert capacity.resized == (resized.size != secret)
+        assert 0 < capacity.quality <= 0.5
@@ -33,3 +33,15 @@ def test_image_encryption(all_images: list[str]) -> None:
         verify_encryption(secret, secret)
         verify_encryption(cover, secret)
         verify_encryption(secret, cover)
+
+
+def test_decrypt_into_buffer() -> None:
+    """Checks that decrypting into a reused buffer matches decrypting to a new image"""
+    rng = np.random.default_rng(0)
+    buffer = np.zeros((200, 300, 3), dtype=np.uint8)
+    for size in ((300, 200), (120, 80)):
+        cover = Image.fromarray(rng.integers(0, 256, (200, 300, 3), dtype=np.uint8))
+        secret = Image.fromarray(rng.integers(0, 256, size[::-1] + (3,), dtype=np.uint8))
+        encryption = encrypt.encrypt_image_to_image(cover, secret)
+        expected = np.array(decrypt.decrypt_image_from_image(encryption))
+        assert np.all(decrypt.decrypt_image_into(encryption, buffer) == expected)
@@ -0,0 +1,33 @@
+from PIL import Image
+
+from helper import instrument
+from helper.batch import Job, run_job
+from helper.constant import Operation
+from helper.encrypt import encrypt_text_to_image
+
+
+def test_stages_recorded():
+    """Nested stages are recorded with their paths only while a sink is added"""
+    cover = Image.new("RGB", (64, 64))
+    encrypt_text_to_image("unrecorded", cover)
+    with instrument.recording(track_memory=True) as recorder:
+        with instrument.stage("request"):
+            encrypt_text_to_image("hello", cover)
+    encrypt_text_to_image("unrecorded", cover)
+    assert [record.path for record in recorder.records] == ["request/embed_text", "request"]
+    inner, outer = recorder.records
+    assert outer.wall_seconds >= inner.wall_seconds
+    # The request's peak includes the nested stage's image copy
+    assert outer.peak_bytes >= inner.peak_bytes >= 64 * 64 * 3
+
+
+def test_job_stages(tmp_path):
+    """Jobs measured in a worker report their stages in the result"""
+    cover = tmp_path / "cover.png"
+    Image.new("RGB", (32, 32)).save(cover)
+    result = run_job(Job(Operation.ENCRYPT_TEXT, str(cover), None, text="hi", instrument=True))
+    assert result.ok
+    paths = [record.path for record in result.stages]
+    assert paths == ["encrypt-text/load", "encrypt-text/embed_text", "encrypt-text/save", "encrypt-text"]
+    assert all(record.peak_bytes is None for record in result.stages)
+    assert not run_job(Job(Operation.ENCRYPT_TEXT, str(cover), None, text="hi")).stages
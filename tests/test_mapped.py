@@ -0,0 +1,86 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from helper import batch, decrypt, encrypt, mapped
+from helper.constant import Operation, PayloadKind
+
+
+def load_pixels(path: str) -> np.ndarray:
+    """Reads the RGB pixels of a cover file"""
+    if path.endswith(".npy"):
+        return np.load(path)
+    with Image.open(path) as image:
+        return np.array(image)
+
+
+def test_in_place_matches_full_frame(tmp_path) -> None:
+    """Checks that mapped covers are encrypted in place with the same pixels as the full-frame functions"""
+    rng = np.random.default_rng(0)
+    # Rows of 45 BMP pixels are padded, and BMP rows are stored bottom-up
+    pixels = rng.integers(0, 256, (37, 45, 3), dtype=np.uint8)
+    cover = Image.fromarray(pixels)
+    secret = Image.fromarray(rng.integers(0, 256, (20, 30, 3), dtype=np.uint8))
+    secret_fp = str(tmp_path / "secret.png")
+    secret.save(secret_fp)
+    message = "Hello World " * 30
+    for extension in ("npy", "ppm", "bmp", "tif"):
+        cover_fp = str(tmp_path / f"cover.{extension}")
+        if extension == "npy":
+            np.save(cover_fp, pixels)
+        else:
+            cover.save(cover_fp)
+        mapped_pixels = mapped.map_pixels(cover_fp, writable=True)
+        assert np.array_equal(mapped_pixels, pixels)
+
+        assert mapped.encrypt_text_mapped(message, mapped_pixels, density=2)
+        expected = np.array(encrypt.encrypt_text_to_image(message, cover, density=2))
+        assert np.array_equal(load_pixels(cover_fp), expected)
+        assert mapped.probe_mapped(mapped.map_pixels(cover_fp)).kind is PayloadKind.TEXT
+        assert mapped.decrypt_text_mapped(mapped.map_pixels(cover_fp)) == (message.strip(), True)
+
+        mapped.encrypt_image_mapped(mapped_pixels, secret_fp, band_pixels=500)
+        expected = np.array(encrypt.encrypt_image_to_image(Image.fromarray(expected), secret))
+        assert np.array_equal(load_pixels(cover_fp), expected)
+        output = io.BytesIO()
+        mapped.decrypt_image_mapped(mapped.map_pixels(cover_fp), output, band_pixels=500)
+        with Image.open(output) as decrypted:
+            assert np.array_equal(np.array(decrypted), expected << 4)
+
+        payload = bytes(range(256)) * 4
+        assert mapped.encrypt_file_mapped(io.BytesIO(payload), mapped_pixels, density=3)
+        sink = io.BytesIO()
+        assert mapped.decrypt_bytes_mapped(mapped.map_pixels(cover_fp), sink) and sink.getvalue() == payload
+    assert not mapped.encrypt_text_mapped("a" * 37 * 45, mapped_pixels)
+    cover.save(tmp_path / "cover.png")
+    assert mapped.map_pixels(str(tmp_path / "cover.png")) is None
+
+
+def test_reads_only_needed_rows() -> None:
+    """Checks that decrypting a short message stops reading pixels after the message"""
+    pixels = np.zeros((1000, 100, 3), dtype=np.uint8)
+    assert mapped.encrypt_text_mapped("Hello World", pixels)
+    reads = []
+
+    def spans():
+        for band in mapped.iter_mapped_bands(pixels, band_pixels=64):
+            reads.append(len(band))
+            yield band
+
+    assert decrypt.join_text(decrypt.stream_text_from_bands(spans())) == ("Hello World", True)
+    assert sum(reads) <= 128
+
+
+def test_batch_mapped(tmp_path) -> None:
+    """Checks that mapped batch jobs encrypt covers in place and decrypt them"""
+    cover_fp = str(tmp_path / "cover.ppm")
+    Image.new("RGB", (40, 30), "white").save(cover_fp)
+    job = batch.Job(Operation.ENCRYPT_TEXT, cover_fp, None, text="Hello World", mapped=True)
+    result = batch.run_job(job)
+    assert result.ok and result.output == cover_fp
+    result = batch.run_job(batch.Job(Operation.DECRYPT, cover_fp, None, mapped=True))
+    assert result.ok and result.text == "Hello World"
+    png_fp = str(tmp_path / "cover.png")
+    Image.new("RGB", (40, 30)).save(png_fp)
+    assert batch.run_job(batch.Job(Operation.DECRYPT, png_fp, None, mapped=True)).error == batch.NOT_MAPPABLE
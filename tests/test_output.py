@@ -0,0 +1,51 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from helper import batch
+from helper.constant import Operation, OutputProfile
+from helper.output import ENCODERS, check_lossless, write_image
+from helper.tiled import PngBandWriter
+
+
+def test_profiles_lossless() -> None:
+    """Checks that every output profile keeps every bit of an RGB image"""
+    pixels = np.random.default_rng(0).integers(0, 256, (30, 40, 3), dtype=np.uint8)
+    for profile in OutputProfile:
+        buffer = io.BytesIO()
+        write_image(Image.fromarray(pixels), buffer, profile)
+        with Image.open(buffer) as image:
+            assert image.format == ENCODERS[profile].format
+            assert np.array_equal(np.asarray(image.convert("RGB")), pixels)
+
+
+def test_lossy_settings_refused(tmp_path) -> None:
+    """Checks that profiles unable to keep an image or its metadata are refused"""
+    with pytest.raises(ValueError):
+        check_lossless(OutputProfile.PPM, "RGBA")
+    image = Image.new("RGB", (4, 4))
+    with pytest.raises(ValueError):
+        write_image(image, io.BytesIO(), OutputProfile.BMP, image.getexif())
+    with pytest.raises(ValueError):
+        PngBandWriter.for_profile(str(tmp_path / "output.webp"), (4, 4), OutputProfile.WEBP)
+
+
+def test_batch_profile(tmp_path) -> None:
+    """Checks that batch outputs take the extension of their profile"""
+    cover = tmp_path / "cover.png"
+    Image.new("RGB", (40, 30)).save(cover)
+    job = batch.Job(Operation.ENCRYPT_TEXT, str(cover), str(tmp_path / "output.png"), text="Hello",
+                    profile=OutputProfile.WEBP)
+    result = batch.run_job(job)
+    assert result.ok and result.output == str(tmp_path / "output.webp")
+    result = batch.run_job(batch.Job(Operation.DECRYPT, result.output, None))
+    assert result.text == "Hello"
+    # Image encryption needs EXIF metadata, and fails cleanly without it
+    secret = io.BytesIO()
+    Image.new("RGB", (10, 10)).save(secret, "PNG")
+    for profile in (OutputProfile.BMP, OutputProfile.PPM):
+        job = batch.Job(Operation.ENCRYPT_IMAGE, str(cover), None, secret.getvalue(), profile=profile)
+        result = batch.run_job(job)
+        assert not result.ok and result.error == batch.NO_EXIF
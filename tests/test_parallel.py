@@ -0,0 +1,49 @@
+import numpy as np
+from PIL import Image
+
+from helper.constant import Codec
+from helper.decrypt import decrypt_image_from_image, decrypt_text_from_image
+from helper.encrypt import encrypt_image_to_image, encrypt_text_to_image
+from helper.packing import bytes_to_values, values_between
+from helper.parallel import band_ranges
+from helper.utility import exif_embed_ipp
+
+
+def random_image(size: tuple[int, int], seed: int = 0) -> Image.Image:
+    """Creates an RGB image of random pixels"""
+    width, height = size
+    return Image.fromarray(np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def test_band_ranges() -> None:
+    """Checks that bands cover every pixel once, in order"""
+    assert band_ranges(10, 4) == [(0, 4), (4, 8), (8, 10)]
+    assert band_ranges(0, 4) == []
+    assert band_ranges(3, 0) == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_values_between() -> None:
+    """Checks that any range of values can be split without splitting the bytes before it"""
+    data = np.random.default_rng(0).integers(0, 256, 50, dtype=np.uint8).tobytes()
+    for bits in range(1, 9):
+        values = np.concatenate((bytes_to_values(data, bits), np.zeros(10, dtype=np.uint8)))
+        for start, end in ((0, 0), (0, 5), (3, 17), (11, values.size)):
+            assert np.array_equal(values_between(data, bits, start, end), values[start:end])
+
+
+def test_threads_match_serial() -> None:
+    """Checks that splitting bands over threads gives the same pixels as a single thread"""
+    cover = random_image((300, 700))
+    message = "".join(chr(33 + i % 94) for i in range(150_000))
+    for codec, density in ((Codec.NONE, 0), (Codec.ZLIB, 0), (Codec.NONE, 2), (Codec.NONE, 3)):
+        serial = encrypt_text_to_image(message, cover, codec, density)
+        threaded = encrypt_text_to_image(message, cover, codec, density, threads=4)
+        assert np.array_equal(np.asarray(serial), np.asarray(threaded))
+        assert decrypt_text_from_image(threaded, threads=4) == (message, True)
+
+    secret = random_image((200, 500), seed=1)
+    serial = encrypt_image_to_image(cover, secret)
+    threaded = encrypt_image_to_image(cover, secret, threads=4)
+    assert np.array_equal(np.asarray(serial), np.asarray(threaded))
+    threaded.getexif().update(exif_embed_ipp(secret.getexif(), secret.size))
+    assert np.array_equal(np.asarray(decrypt_image_from_image(threaded, threads=4)), np.asarray(secret) & 0xF0)
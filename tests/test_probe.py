@@ -0,0 +1,36 @@
+import io
+
+from PIL import Image
+
+from helper import encrypt, utility
+from helper.constant import FORMAT_VERSION, PayloadKind
+from helper.probe import probe_file, probe_image
+
+
+def saved(image: Image.Image, **params) -> io.BytesIO:
+    """Saves an image as PNG in memory"""
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", **params)
+    return buffer
+
+
+def test_probe_kinds() -> None:
+    """Checks that images are classified from their metadata and first pixels"""
+    cover = Image.new("RGB", (50, 40), (10, 20, 30))
+    secret = Image.new("RGB", (30, 60))
+    exif = utility.exif_embed_ipp(secret.getexif(), secret.size)
+    files = {
+        PayloadKind.TEXT: saved(encrypt.encrypt_text_to_image("Hello World", cover)),
+        PayloadKind.FILE: saved(encrypt.encrypt_file_to_image(io.BytesIO(b"\x00\xff" * 10), cover)),
+        PayloadKind.IMAGE: saved(encrypt.encrypt_image_to_image(cover, secret), exif=exif),
+        PayloadKind.UNKNOWN: saved(cover),
+    }
+    for kind, buffer in files.items():
+        probe = probe_file(buffer)
+        assert probe.kind is kind and probe.size == (50, 40)
+        with Image.open(buffer) as image:
+            assert probe_image(image) == probe
+    assert probe_file(files[PayloadKind.TEXT]).length == len("Hello World")
+    assert probe_file(files[PayloadKind.FILE]).version == FORMAT_VERSION
+    # The hidden size is limited to the cover's
+    assert probe_file(files[PayloadKind.IMAGE]).hidden_size == (30, 40)
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from helper.scheduler import JobScheduler, QueueFullError
+
+
+def test_fair_admission() -> None:
+    """Checks that jobs wait for slots and memory, clients take turns, and a full queue is refused"""
+
+    async def scenario() -> list[str]:
+        scheduler = JobScheduler(slots=2, max_bytes=100, max_queued=4)
+        started = []
+        release = asyncio.Event()
+
+        async def job(client: str, name: str, cost: int = 10):
+            async with scheduler.admit(client, cost):
+                started.append(name)
+                await release.wait()
+
+        # "a" sends a burst, "b" and "c" one job each, after it
+        tasks = [asyncio.create_task(job("a", f"a{i}")) for i in range(4)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(job(client, client)) for client in "bc"]
+        await asyncio.sleep(0)
+        assert started == ["a0", "a1"] and scheduler.snapshot()["queued"] == 4
+        with pytest.raises(QueueFullError):
+            await scheduler.acquire("d", 10)
+        release.set()
+        await asyncio.gather(*tasks)
+        assert scheduler.snapshot()["running"] == scheduler.snapshot()["queued"] == 0
+        return started
+
+    assert asyncio.run(scenario()) == ["a0", "a1", "a2", "b", "c", "a3"]
+
+
+def test_memory_budget() -> None:
+    """Checks that jobs wait until their memory fits, cancelled ones leave the queue, and oversized ones run alone"""
+
+    async def scenario():
+        scheduler = JobScheduler(slots=4, max_bytes=100)
+        first = await scheduler.acquire("a", 80)
+        waiting = asyncio.create_task(scheduler.acquire("b", 30))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        # A client leaving while waiting gives up its place
+        cancelled = asyncio.create_task(scheduler.acquire("c", 30))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.queued == 1
+        scheduler.release(first)
+        scheduler.release(await waiting)
+        huge = await scheduler.acquire("c", 1000)
+        assert scheduler.running == 1
+        scheduler.release(huge)
+
+    asyncio.run(scenario())
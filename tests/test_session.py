@@ -0,0 +1,23 @@
+from helper.session import SessionStore
+
+
+def test_lru_eviction() -> None:
+    """Checks that least recently used sessions are evicted once over budget"""
+    sessions = SessionStore(max_bytes=250)
+    for key in "abc":
+        sessions.get(key).cover = bytes(100)
+    assert sessions.trim() == ["a"]
+    # Using "b" makes "c" the least recently used
+    sessions.get("b").set_outputs(image=bytes(100))
+    assert sessions.trim() == ["c"]
+    assert "b" in sessions and len(sessions) == 1
+
+
+def test_oversized_session_kept() -> None:
+    """Checks that the session in use is kept even if it exceeds the budget on its own"""
+    sessions = SessionStore(max_bytes=10)
+    sessions.get("a").message_file = bytes(100)
+    assert sessions.nbytes == 100
+    assert sessions.trim() == [] and "a" in sessions
+    sessions.discard("a")
+    assert len(sessions) == 0
@@ -1,15 +1,22 @@
 import string
 from random import choices, seed
 
+import numpy as np
 from PIL import Image
 
 from helper import decrypt, encrypt, utility
+from helper.capacity import plan_text
+from helper.constant import (
+    CHARACTER_DENSITY, END_TEXT, FORMAT_VERSION, MAX_DENSITY, Codec,
+    PayloadMode
+)
+from helper.header import HEADER_PIXELS, Header, header_codes
 
 seed(a=1)
 ascii = string.ascii_letters + string.digits + string.punctuation + "\n\t\r"
 non_ascii = "".join(map(chr, range(128, 1000)))
 combined = ascii + non_ascii
-end_length = len(encrypt.END_TEXT)
+overhead = HEADER_PIXELS
 
 img_dir = "static"
 
@@ -50,9 +57,117 @@ def test_messages(all_images) -> None:
     """Checks encrypting-decrypting for messages of various lengths"""
     for file in all_images:
         image = Image.open(file)
-        for length in (0, 1, 5, 10, 100, 1000, 5000, pixel_count(image) - end_length):
+        for length in (0, 1, 5, 10, 100, 1000, 5000, pixel_count(image) - overhead):
             extent = image.size[0] * image.size[1]
             too_long(image)
             if length <= extent:
                 verify(ascii, length, image)
                 verify(combined, length, image)
+
+
+def test_message_across_bands() -> None:
+    """Checks decrypting a message that spans several row bands of a synthetic image"""
+    image = Image.new("RGB", (3, 50_000), (255, 255, 255))
+    for length in (0, 65_530, 65_536, pixel_count(image) - overhead):
+        message = random_message(ascii.strip(), length)
+        encryption = encrypt.encrypt_text_to_image(message, image)
+        decrypted, found = decrypt.decrypt_text_from_image(encryption)
+        assert found
+        assert decrypted == message
+
+
+def test_stream_from_file(tmp_path) -> None:
+    """Checks that decrypting from a file matches decrypting the loaded image"""
+    image = Image.new("RGB", (400, 300), (0, 128, 255))
+    for length in (0, 100, pixel_count(image) - overhead):
+        message = random_message(ascii.strip(), length)
+        encryption = encrypt.encrypt_text_to_image(message, image)
+        for extension in ("png", "tiff"):
+            path = str(tmp_path / f"output.{extension}")
+            encryption.save(path)
+            chunks = list(decrypt.stream_text_from_file(path, band_pixels=1000))
+            assert "".join(chunks) == message
+            assert decrypt.decrypt_text_from_file(path) == (message, True)
+
+
+def test_delimiter_in_message() -> None:
+    """Checks that messages containing the legacy delimiter are recovered whole"""
+    image = Image.new("RGB", (20, 20))
+    message = f"before{END_TEXT}after"
+    assert decrypt.decrypt_text_from_image(encrypt.encrypt_text_to_image(message, image)) == (message, True)
+
+
+def test_legacy_format(tmp_path) -> None:
+    """Checks that images encrypted with the delimiter and no header still decrypt"""
+    image = Image.new("RGB", (300, 200), (10, 20, 30))
+    path = str(tmp_path / "legacy.png")
+    for length in (0, 100, pixel_count(image) - len(END_TEXT)):
+        message = random_message(ascii.strip(), length)
+        pixels = np.array(image)
+        codes = np.frombuffer((message + END_TEXT).encode("ascii"), dtype=np.uint8)
+        encrypt.embed_codes(pixels.reshape((-1, 3)), codes)
+        legacy = Image.fromarray(pixels)
+        legacy.save(path)
+        assert decrypt.decrypt_text_from_image(legacy) == (message, True)
+        assert decrypt.decrypt_text_from_file(path) == (message, True)
+
+
+def test_compressed_messages(tmp_path) -> None:
+    """Checks that compressed messages are recovered, and that repetitive text needs fewer pixels"""
+    image = Image.new("RGB", (100, 60), (7, 7, 1))
+    path = str(tmp_path / "output.png")
+    for message in ("", "x", "2023-07-30 INFO request served\n" * 150):
+        for codec in [None, *Codec]:
+            pixels = encrypt.text_to_segments(message, codec)[-1].end
+            if len(message) > 1000 and codec is not Codec.NONE:
+                assert pixels < len(message) / 4
+            encryption = encrypt.encrypt_text_to_image(message, image, codec)
+            assert decrypt.decrypt_text_from_image(encryption) == (message.strip(), True)
+            encryption.save(path)
+            chunks = list(decrypt.stream_text_from_file(path, band_pixels=100))
+            assert "".join(chunks) == message.strip()
+            assert plan_text(image, message, codec).pixels_used == pixels
+
+
+def test_densities(tmp_path) -> None:
+    """Checks messages at every density, and that planning agrees on which ones fit"""
+    image = Image.new("RGB", (30, 20), (200, 100, 50))
+    path = str(tmp_path / "output.png")
+    for density in range(CHARACTER_DENSITY, MAX_DENSITY + 1):
+        for codec in (Codec.NONE, Codec.ZLIB):
+            for length in (0, 1, 2, 3, 100, 300, 500, 899, 900):
+                message = random_message(ascii.strip(), length)
+                encryption = encrypt.encrypt_text_to_image(message, image, codec, density)
+                capacity = plan_text(image, message, codec, density)
+                assert capacity.fits == (encryption is not None)
+                if encryption is None:
+                    continue
+                assert capacity.pixels_used == encrypt.text_to_segments(message, codec, density)[-1].end
+                # Pixels after the message are untouched
+                assert np.all(np.array(encryption).reshape((-1, 3))[capacity.pixels_used:] == (200, 100, 50))
+                assert decrypt.decrypt_text_from_image(encryption) == (message, True)
+                encryption.save(path)
+                assert "".join(decrypt.stream_text_from_file(path, band_pixels=7)) == message
+
+
+def test_older_headers() -> None:
+    """Checks that messages with headers of earlier format versions still decrypt"""
+    image = Image.new("RGB", (20, 20))
+    message = "written by an older version"
+    for version in range(1, FORMAT_VERSION):
+        header = Header(PayloadMode.TEXT, len(message), version=version)
+        pixels = np.array(image)
+        codes = np.concatenate((header_codes(header), np.frombuffer(message.encode("ascii"), dtype=np.uint8)))
+        encrypt.embed_codes(pixels.reshape((-1, 3)), codes)
+        assert decrypt.decrypt_text_from_image(Image.fromarray(pixels)) == (message, True)
+
+
+def test_other_modes(tmp_path) -> None:
+    """Checks that uploads kept as they are, in any mode, are read as RGB"""
+    path = str(tmp_path / "image.png")
+    encryption = encrypt.encrypt_text_to_image("kept as uploaded", Image.new("RGB", (20, 20)))
+    for mode in ("RGBA", "P", "L"):
+        image = encryption.convert(mode)
+        image.save(path)
+        expected = decrypt.decrypt_text_from_image(image.convert("RGB"))
+        assert decrypt.decrypt_text_from_file(path) == expected
@@ -0,0 +1,103 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from helper import batch, decrypt, encrypt, tiled
+from helper.constant import Operation
+from helper.utility import open_top_rows
+
+
+def test_tiled_matches_full_frame(tmp_path) -> None:
+    """Checks that tiled encryption and decryption give the same pixels as the full-frame functions"""
+    rng = np.random.default_rng(0)
+    cover = Image.fromarray(rng.integers(0, 256, (90, 70, 3), dtype=np.uint8))
+    secret = Image.fromarray(rng.integers(0, 256, (50, 80, 3), dtype=np.uint8))
+    secret_fp, output_fp = str(tmp_path / "secret.png"), str(tmp_path / "output.png")
+    secret.save(secret_fp)
+    message = "Hello World " * 300
+    # Uncompressed covers are read from disk, compressed ones are decoded
+    for extension in ("bmp", "ppm", "tif", "png"):
+        cover_fp = str(tmp_path / f"cover.{extension}")
+        cover.save(cover_fp)
+
+        for density in (0, 3):
+            assert tiled.encrypt_text_tiled(message, cover_fp, output_fp, band_pixels=500, density=density)
+            with Image.open(output_fp) as output:
+                expected = encrypt.encrypt_text_to_image(message, cover, density=density)
+                assert np.all(np.array(output) == np.array(expected))
+            assert decrypt.join_text(tiled.stream_text_tiled(output_fp, 500)) == (message.strip(), True)
+
+        tiled.encrypt_image_tiled(cover_fp, secret_fp, output_fp, band_pixels=500)
+        with Image.open(output_fp) as output:
+            assert np.all(np.array(output) == np.array(encrypt.encrypt_image_to_image(cover, secret)))
+            expected = np.array(decrypt.decrypt_image_from_image(output))
+        decrypted_fp = str(tmp_path / "decrypted.png")
+        tiled.decrypt_image_tiled(output_fp, decrypted_fp, band_pixels=500)
+        with Image.open(decrypted_fp) as decrypted:
+            assert np.all(np.array(decrypted) == expected)
+    assert not tiled.encrypt_text_tiled("a" * 90 * 70, cover_fp, output_fp)
+
+
+def test_file_objects(tmp_path) -> None:
+    """Checks that covers can be read from, and outputs written to, binary file objects"""
+    cover = Image.fromarray(np.random.default_rng(0).integers(0, 256, (40, 30, 3), dtype=np.uint8))
+    for extension in ("bmp", "png"):
+        cover_fp = str(tmp_path / f"cover.{extension}")
+        cover.save(cover_fp)
+        output = io.BytesIO()
+        with open(cover_fp, "rb") as f:
+            assert tiled.encrypt_text_tiled("Hello World", f, output, band_pixels=100)
+        assert not output.closed
+        with Image.open(output) as image:
+            assert np.array_equal(np.asarray(image), np.asarray(encrypt.encrypt_text_to_image("Hello World", cover)))
+
+
+def test_streamed_formats(tmp_path) -> None:
+    """Checks that PNG and TIFF files are decoded band by band, with the pixels Pillow decodes"""
+    pixels = np.random.default_rng(0).integers(0, 256, (90, 70, 3), dtype=np.uint8)
+    rgb = Image.fromarray(pixels)
+    covers = {
+        "rgb.png": (rgb, {}),
+        "rgba.png": (rgb.convert("RGBA"), {}),
+        "gray.png": (rgb.convert("L"), {}),
+        "palette.png": (rgb.quantize(), {"transparency": 0}),
+        "deflate.tif": (rgb, {"compression": "tiff_adobe_deflate"}),
+        "lzw.tif": (rgb.convert("L"), {"compression": "tiff_lzw"}),
+    }
+    for name, (image, options) in covers.items():
+        cover_fp = str(tmp_path / name)
+        image.save(cover_fp, **options)
+        with Image.open(cover_fp) as cover:
+            expected = np.asarray(cover.convert("RGB"))
+        with tiled.BandReader(cover_fp) as reader:
+            assert reader.rows is not None and reader.image is None
+            # Bands out of order restart or reuse the decoder
+            for top, bottom in [*reader.bands(500), (10, 30), (0, 90)]:
+                assert np.array_equal(reader.read(top, bottom), expected[top:bottom])
+
+
+def test_above_pixel_limit(tmp_path, monkeypatch) -> None:
+    """Checks that covers with more pixels than Pillow allows are read in bands, leaving the limit in place"""
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    cover = Image.fromarray(np.random.default_rng(0).integers(0, 256, (90, 70, 3), dtype=np.uint8))
+    output_fp = str(tmp_path / "output.png")
+    for extension in ("bmp", "ppm", "png", "tif"):
+        cover_fp = str(tmp_path / f"cover.{extension}")
+        # Strips of 10 rows, each below the limit
+        cover.save(cover_fp, **({"compression": "tiff_lzw", "strip_size": 10 * 70 * 3} if extension == "tif" else {}))
+        result = batch.run_job(batch.Job(Operation.ENCRYPT_TEXT, cover_fp, output_fp, text="Hello World", tiled=True))
+        assert result.ok
+        result = batch.run_job(batch.Job(Operation.DECRYPT, output_fp, None, tiled=True))
+        assert result.ok and result.text == "Hello World"
+        if extension in ("ppm", "png"):
+            # Their first rows decode on their own, see `supports_row_reads`
+            with open_top_rows(cover_fp, 5) as top:
+                assert np.array_equal(np.asarray(top), np.asarray(cover)[:5])
+        assert Image.MAX_IMAGE_PIXELS == 1000
+    # Decoded whole, so held to the limit
+    cover.save(tmp_path / "cover.jpg")
+    cover.convert("I;16").save(tmp_path / "deep.png")
+    for name in ("cover.jpg", "deep.png"):
+        result = batch.run_job(batch.Job(Operation.DECRYPT, str(tmp_path / name), None, tiled=True))
+        assert not result.ok and Image.MAX_IMAGE_PIXELS == 1000